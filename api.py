@@ -0,0 +1,225 @@
+"""JSON API for Warbler, mounted under /api."""
+
+from flask import (Blueprint, request, g, jsonify, current_app, Response,
+                   stream_with_context)
+
+from models import User
+from readmodels import (following_ids, followers_page, following_page,
+                        timeline_cards_since, timeline_count_since,
+                        message_cards_by_ids, user_cards_by_ids)
+from availability import username_available
+from ratelimit import rate_limit
+from realtime import timeline_stream
+import autocomplete
+import export
+import trending
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+
+def user_card_json(card):
+    """Serialize a `UserCard` for API responses."""
+
+    return {
+        'id': card.id,
+        'username': card.username,
+        'image_url': card.image_url,
+        'header_image_url': card.header_image_url,
+        'bio': card.bio,
+    }
+
+
+@bp.route('/users/<int:user_id>/following')
+def api_following(user_id):
+    """One page of users this user follows; pass `after` to continue."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    User.query.get_or_404(user_id)
+    users, next_cursor = following_page(user_id, request.args.get('after'))
+
+    return jsonify(users=[user_card_json(u) for u in users], next=next_cursor)
+
+
+@bp.route('/users/<int:user_id>/followers')
+def api_followers(user_id):
+    """One page of this user's followers; pass `after` to continue."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    User.query.get_or_404(user_id)
+    users, next_cursor = followers_page(user_id, request.args.get('after'))
+
+    return jsonify(users=[user_card_json(u) for u in users], next=next_cursor)
+
+
+@bp.route('/users/autocomplete')
+def api_users_autocomplete():
+    """Usernames starting with the `q` query param, for type-ahead."""
+
+    prefix = request.args.get('q', '').strip().lstrip('@')
+    if not prefix:
+        return jsonify(users=[])
+
+    limit = max(1, min(request.args.get('limit', autocomplete.DEFAULT_LIMIT,
+                                        type=int), autocomplete.MAX_LIMIT))
+    users = autocomplete.complete(prefix, limit)
+
+    return jsonify(users=[{'id': id, 'username': username}
+                          for id, username in users])
+
+
+@bp.route('/username-available')
+@rate_limit('username_available', limit=30, per=60, key='ip')
+def api_username_available():
+    """Is the `username` query param free to sign up with (or rename to)?"""
+
+    username = request.args.get('username', '').strip()
+    if not username:
+        return jsonify(error="username is required"), 400
+
+    return jsonify(username=username,
+                   available=username_available(username, g.user,
+                                                exact=True))
+
+
+def message_card_json(card):
+    """Serialize a `MessageCard` for API responses."""
+
+    return {
+        'id': card.id,
+        'text': card.text,
+        'timestamp': card.timestamp.isoformat(),
+        'like_count': card.like_count,
+        'user': {
+            'id': card.user.id,
+            'username': card.user.username,
+            'image_url': card.user.image_url,
+        },
+    }
+
+
+@bp.route('/timeline/since')
+def api_timeline_since():
+    """Timeline messages newer than message id `after`, oldest first.
+
+    Poll with the returned `latest` as the next `after`.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    after = request.args.get('after', type=int)
+    if after is None:
+        return jsonify(error="after is required"), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), 100))
+
+    user_ids = following_ids(g.user.id) + [g.user.id]
+    cards = timeline_cards_since(user_ids, after, limit)
+
+    return jsonify(messages=[message_card_json(c) for c in cards],
+                   latest=cards[-1].id if cards else after)
+
+
+@bp.route('/timeline/since/count')
+def api_timeline_since_count():
+    """How many timeline messages are newer than message id `after`.
+
+    Counts are capped at 100 (`more` is true when there may be others).
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    after = request.args.get('after', type=int)
+    if after is None:
+        return jsonify(error="after is required"), 400
+
+    user_ids = following_ids(g.user.id) + [g.user.id]
+    count = timeline_count_since(user_ids, after, cap=100)
+
+    return jsonify(count=count, more=count >= 100)
+
+
+@bp.route('/timeline/stream')
+def api_timeline_stream():
+    """Server-Sent Events stream of new messages for the home timeline.
+
+    Resumes after the `Last-Event-ID` header (sent by EventSource when it
+    reconnects) or the `after` query param (the newest id on the page).
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('after', type=int)
+
+    stream = timeline_stream(g.user.id, last_event_id,
+                             max_age=current_app.config['REALTIME_MAX_AGE'])
+
+    return Response(stream_with_context(stream),
+                    mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/trending')
+def api_trending():
+    """Trending messages and active users, with their decayed scores."""
+
+    top_messages = trending.top_messages(20)
+    top_users = trending.top_users(10)
+    message_scores = dict(top_messages)
+    user_scores = dict(top_users)
+
+    messages = message_cards_by_ids([id for id, _ in top_messages])
+    users = user_cards_by_ids([id for id, _ in top_users])
+
+    return jsonify(
+        messages=[dict(message_card_json(c), score=message_scores[c.id])
+                  for c in messages],
+        users=[dict(user_card_json(c), score=user_scores[c.id])
+               for c in users])
+
+
+@bp.route('/users/<int:user_id>/export')
+def api_user_export(user_id):
+    """Stream the logged-in user's data as NDJSON (default) or CSV.
+
+    Query params: `format` ('ndjson' or 'csv'), `data` (the dataset for
+    CSV: users, follows, likes or messages), `after`/`before` (a message id
+    range; resume a cut-off download with `after`) and `gzip=1` for a
+    .gz file.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+    if g.user.id != user_id:
+        return jsonify(error="Access unauthorized."), 403
+
+    fmt = request.args.get('format', 'ndjson')
+    dataset = request.args.get('data', 'messages')
+    if fmt not in ('ndjson', 'csv') or dataset not in export.DATASETS:
+        return jsonify(error="Unknown format or data."), 400
+    gzip = request.args.get('gzip') == '1'
+
+    chunks = export.export_chunks(
+        user_id, fmt, dataset,
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        gzip=gzip)
+
+    filename = f"warbler-{user_id}" + (f"-{dataset}.csv" if fmt == 'csv'
+                                        else '.ndjson')
+    if gzip:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{filename}"'})
@@ -1,386 +1,172 @@
-import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message, Likes, Follows
-
-CURR_USER_KEY = "curr_user"
-
-app = Flask(__name__)
-app.app_context().push()
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
-
-##############################################################################
-# User signup/login/logout
-
-
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
-        g.user = None
-
-
-def do_login(user):
-    """Log in user."""
-
-    session[CURR_USER_KEY] = user.id
-
-
-def do_logout():
-    """Logout user."""
-
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-
-
-@app.route('/signup', methods=["GET", "POST"])
-def signup():
-    """Handle user signup.
-
-    Create new user and add to DB. Redirect to home page.
-
-    If form not valid, present form.
-
-    If the there already is a user with that username: flash message
-    and re-present form.
-    """
-
-    form = UserAddForm()
-
-    if form.validate_on_submit():
-        try:
-            user = User.signup(
-                username=form.username.data,
-                password=form.password.data,
-                email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
-            )
-            db.session.commit()
-
-        except IntegrityError:
-            flash("Username already taken", 'danger')
-            return render_template('users/signup.html', form=form)
-
-        do_login(user)
-
-        return redirect("/")
-
-    else:
-        return render_template('users/signup.html', form=form)
-
-
-@app.route('/login', methods=["GET", "POST"])
-def login():
-    """Handle user login."""
-
-    form = LoginForm()
-
-    if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
-
-        if user:
-            do_login(user)
-            flash(f"Hello, {user.username}!", "success")
-            return redirect("/")
-
-        flash("Invalid credentials.", 'danger')
-
-    return render_template('users/login.html', form=form)
-
-
-@app.route('/logout')
-def logout():
-    """Handle logout of user."""
-
-    do_logout()
-    flash('Logged out', 'success')
-    return redirect('/login')
-
-
-##############################################################################
-# General user routes:
-
-@app.route('/users')
-def list_users():
-    """Page with listing of users.
-
-    Can take a 'q' param in querystring to search by that username.
-    """
-
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
-
-@app.route('/users/add_like/<int:message_id>', methods=["POST"])
-def add_like(message_id):
-    if not g.user:
-        flash("Must be logged in", "danger")
-        return redirect("/")
-
-    liked = Message.query.get(message_id)
-    if liked.user_id != g.user.id:
-        db.session.add(g.user)
-        db.session.commit()
-        if liked not in g.user.likes:
-            g.user.likes.append(liked)
-            db.session.add(g.user)
-            db.session.commit()
-            return redirect('/')
-        g.user.likes.remove(liked)
-        db.session.add(g.user)
-        db.session.commit()
-    
-    return redirect('/')
-
-@app.route('/users/<int:user_id>/likes')
-def likes(user_id):
-    """Show user's liked messages"""
-
-    user = User.query.get_or_404(user_id)
-
-    liked = [l.id for l in user.likes]
-    messages = db.session.query(Message).filter(Message.id.in_(liked)).order_by((Message.timestamp.desc())).limit(100).all()    
+"""Warbler application factory.
 
-    return render_template('/users/liked.html', messages=messages, user=user)
+Build an app with ``create_app('production')`` (or 'development' /
+'testing'). Dev-only extensions and the view modules are only imported
+inside the factory, so tools that just need the database (seeding, the
+`flask` CLI) can skip them with ``create_app(views=False)``. Optional
+features (partitions, shards, the slow-query log, template caching) are only
+imported when configured, and each `flask` CLI group only when it is run.
 
+For backwards compatibility, ``from app import app`` still works: the first
+access builds an app from WARBLER_ENV (default 'development') and pushes an
+app context for it, as this module used to do at import.
+"""
 
+import importlib
+import os
+import time
 
-@app.route('/users/<int:user_id>')
-def users_show(user_id):
-    """Show user profile."""
-
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
-
-
-@app.route('/users/<int:user_id>/following')
-def show_following(user_id):
-    """Show list of people this user is following."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
-
-
-@app.route('/users/<int:user_id>/followers')
-def users_followers(user_id):
-    """Show list of followers of this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    followers = user.followers
-    return render_template('users/followers.html', user=user)
-
-
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
-def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
-def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/profile', methods=["GET", "POST"])
-def profile():
-    """Update profile for current user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    form = UserUpdateForm(obj=g.user)
-
-    if form.validate_on_submit():
-        user = User.authenticate(g.user.username,
-                                 form.password.data)
-        if user:
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.image_url = form.image_url.data
-            g.user.header_image_url = form.header_image_url.data
-            g.user.bio = form.bio.data
-
-            db.session.commit()
-            flash(f'{g.user.username} updated', 'success')
-            return redirect(f'/users/{g.user.id}')
-        
-        flash('Invalid credentials', 'danger')
-        return redirect('/')
-
-    return render_template('/users/edit.html', form=form)
-
-
-@app.route('/users/delete', methods=["POST"])
-def delete_user():
-    """Delete user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    do_logout()
-
-    db.session.delete(g.user)
-    db.session.commit()
-
-    return redirect("/signup")
-
-
-##############################################################################
-# Messages routes:
-
-@app.route('/messages/new', methods=["GET", "POST"])
-def messages_add():
-    """Add a message:
-
-    Show form if GET. If valid, update message and redirect to user page.
-    """
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    form = MessageForm()
-
-    if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
-
-        return redirect(f"/users/{g.user.id}")
-
-    return render_template('messages/new.html', form=form)
-
-
-@app.route('/messages/<int:message_id>', methods=["GET"])
-def messages_show(message_id):
-    """Show a message."""
-
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
-
-
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
-def messages_destroy(message_id):
-    """Delete a message."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    msg = Message.query.get(message_id)
-    if msg.user_id == g.user.id:
-        db.session.delete(msg)
-        db.session.commit()
-
-        return redirect(f"/users/{g.user.id}")
-    
-    flash("Access unauthorized.", "danger")
-    return redirect("/")
-
+import click
+from flask import Flask
 
+from config import PROFILES
+from models import connect_db
 
-##############################################################################
-# Homepage and error pages
+CURR_USER_KEY = "curr_user"
 
 
-@app.route('/')
-def homepage():
-    """Show homepage:
+def create_app(config=None, views=True):
+    """Create a Warbler app.
 
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    `config` is a profile name from config.PROFILES, a config object, or
+    None for the WARBLER_ENV profile. `views=False` skips registering
+    blueprints (and importing the view modules behind them).
     """
 
-    if g.user:
-        db.session.add(g.user)
-        db.session.commit()
-        following = [f.id for f in g.user.following]+[g.user.id]
-        messages = db.session.query(Message).filter(Message.user_id.in_(following)).order_by((Message.timestamp.desc())).limit(100).all()
-    
-
-        return render_template('home.html', messages=messages)
+    started = time.perf_counter()
+
+    app = Flask(__name__)
+
+    if config is None or isinstance(config, str):
+        name = config or os.environ.get('WARBLER_ENV', 'development')
+        config = PROFILES[name]()
+    app.config.from_object(config)
+
+    connect_db(app)
+
+    # request hooks every app needs; other features are only imported when
+    # configured, and CLI groups when run
+    import metrics
+    import profiling
+    metrics.init_app(app)
+    profiling.init_app(app)
+    if app.config.get('SLOW_QUERY_MS') is not None:
+        import slowlog
+        slowlog.init_app(app)
+    if app.config.get('MESSAGES_PARTITIONED'):
+        import partitions
+        partitions.init_app(app)
+    if app.config.get('MESSAGE_SHARDS'):
+        import sharding
+        sharding.init_app(app)
+
+    register_commands(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    if views:
+        register_blueprints(app)
+        if (app.config.get('TEMPLATE_BYTECODE_CACHE')
+                or app.config.get('TEMPLATE_WARM')):
+            # after the blueprints, which register the templates' filters
+            import jinjacache
+            jinjacache.init_app(app)
+
+    from compression import CompressionMiddleware
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        level=app.config['COMPRESS_LEVEL'],
+        brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+    )
+
+    proxies = app.config.get('TRUSTED_PROXIES')
+    if proxies:
+        # outermost, so everything sees the client's address and scheme
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    app.config['STARTUP_MS'] = elapsed_ms
+    if elapsed_ms > app.config['STARTUP_BUDGET_MS']:
+        app.logger.warning("App startup took %.0fms (budget %dms)",
+                           elapsed_ms, app.config['STARTUP_BUDGET_MS'])
+
+    return app
+
+
+def register_blueprints(app):
+    """Import and register Warbler's views."""
+
+    import api
+    import autocomplete
+    import availability
+    import likecounts
+    import querycache
+    import views
+
+    app.register_blueprint(views.bp)
+    app.register_blueprint(api.bp)
+    autocomplete.init_app(app)
+    availability.init_app(app)
+    likecounts.init_app(app)
+    querycache.init_app(app)
+
+
+class LazyGroup(click.Group):
+    """A CLI group whose commands are imported from `import_name`
+    ("module:attribute") only when it is used."""
+
+    def __init__(self, name, import_name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.import_name = import_name
+
+    def _group(self):
+        module, attribute = self.import_name.split(':')
+        return getattr(importlib.import_module(module), attribute)
+
+    def list_commands(self, ctx):
+        return self._group().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._group().get_command(ctx, name)
+
+
+# (name, group, help) for each `flask` CLI group
+COMMANDS = (
+    ('assets', 'assets:assets_cli', "Build fingerprinted static assets."),
+    ('export', 'export:export_cli', "Export account data."),
+    ('likes', 'likecounts:likes_cli', "Maintain message like counts."),
+    ('partitions', 'partitions:partitions_cli',
+     "Manage monthly partitions of messages."),
+    ('profile', 'profiling:profile_cli', "Profile individual requests."),
+    ('shards', 'sharding:shards_cli', "Manage message shards."),
+    ('slowlog', 'slowlog:slowlog_cli', "Inspect the slow-query log."),
+    ('tags', 'tags:tags_cli', "Maintain the hashtag and mention index."),
+    ('templates', 'jinjacache:templates_cli', "Precompile Jinja templates."),
+)
+
+
+def register_commands(app):
+    """Add Warbler's CLI groups to `app.cli`, without importing them."""
+
+    for name, import_name, help in COMMANDS:
+        app.cli.add_command(LazyGroup(name, import_name, help=help))
 
-    else:
-        return render_template('home-anon.html')
 
+_default_app = None
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+def __getattr__(name):
+    # lazily build the module-level `app` (see module docstring)
+    global _default_app
+
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    if _default_app is None:
+        _default_app = create_app()
+        _default_app.app_context().push()
+    return _default_app
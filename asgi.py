@@ -0,0 +1,12 @@
+"""ASGI entry point, e.g. ``uvicorn asgi:app``: the async read API under
+/api/async (see asyncapi.py), and the Flask app, run in a thread pool, for
+everything else."""
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app
+import asyncapi
+
+flask_app = create_app('production')
+
+app = asyncapi.mount(flask_app, WsgiToAsgi(flask_app))
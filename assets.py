@@ -0,0 +1,299 @@
+"""Static asset pipeline for Warbler.
+
+``flask assets build`` turns the CDN stylesheets/scripts that base.html used
+to pull on every page, plus our own static/stylesheets/style.css, into:
+
+- one minified CSS bundle and one JS bundle;
+- copies of every file those bundles reference (fonts, background images)
+  and of the images templates link directly;
+- all with content-hashed file names under static/dist/ (or
+  ASSETS_DIST_DIR), listed in manifest.json there, with .gz (and .br, if the `brotli` package is
+  installed) precompressed siblings for text files.
+
+Remote sources are downloaded once into static/vendor/ and reused by later
+builds, so only the first build needs the network.
+
+At runtime, templates call ``asset_url('app.css')`` to get the hashed URL
+(or None if no build has been done, so base.html can fall back to the CDN),
+and `send_asset` serves files from static/dist with immutable caching,
+picking the precompressed variant the client accepts.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import re
+from hashlib import sha256
+from urllib.parse import urljoin, urlparse
+from urllib.request import Request, urlopen
+
+import click
+from flask import abort, current_app, send_file
+from flask.cli import with_appcontext
+from werkzeug.security import safe_join
+
+from compression import encoding_quality
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+FAR_FUTURE = 365 * 24 * 60 * 60
+
+# logical bundle name -> sources, in order. Remote sources are pinned to
+# versions so builds are reproducible.
+BUNDLES = {
+    'app.css': [
+        'https://unpkg.com/bootstrap@4.6.2/dist/css/bootstrap.min.css',
+        'https://use.fontawesome.com/releases/v5.3.1/css/all.css',
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.5/font/bootstrap-icons.css',
+        '/static/stylesheets/style.css',
+    ],
+    'app.js': [
+        'https://unpkg.com/jquery@3.7.1/dist/jquery.min.js',
+        'https://unpkg.com/popper.js@1.16.1/dist/umd/popper.min.js',
+        'https://unpkg.com/bootstrap@4.6.2/dist/js/bootstrap.min.js',
+    ],
+}
+
+# files templates link to directly (rather than via CSS)
+IMAGES = [
+    '/static/favicon.ico',
+    '/static/images/warbler-logo.png',
+    '/static/images/warbler-hero.jpg',
+    '/static/images/default-pic.png',
+]
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.eot', '.json', '.ico')
+
+# don't bother keeping compressed copies smaller than this
+MIN_COMPRESS_BYTES = 512
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _dist_dir(app=None):
+    app = app or current_app
+    return (app.config.get('ASSETS_DIST_DIR')
+            or os.path.join(app.static_folder, 'dist'))
+
+
+def _vendor_dir(app=None):
+    app = app or current_app
+    return os.path.join(app.static_folder, 'vendor')
+
+
+##############################################################################
+# Reading sources
+
+
+def read_source(location):
+    """Bytes of a '/static/...' path or a (vendored) remote URL."""
+
+    if location.startswith('/static/'):
+        path = os.path.join(current_app.static_folder,
+                            location[len('/static/'):])
+        with open(path, 'rb') as f:
+            return f.read()
+
+    parsed = urlparse(location)
+    path = os.path.join(_vendor_dir(), parsed.netloc,
+                        parsed.path.lstrip('/'))
+    if not os.path.exists(path):
+        click.echo(f"  vendoring {location}")
+        req = Request(location, headers={'User-Agent': 'Warbler assets'})
+        with urlopen(req, timeout=30) as resp:
+            data = resp.read()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+##############################################################################
+# Transforms
+
+
+def minify_css(css):
+    """Conservative CSS minifier: drop comments and redundant whitespace."""
+
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    # not ':', where whitespace can be significant ("a :hover")
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def hashed_name(name, data):
+    """'dir/file.ext' -> 'dir/file.<hash>.ext' for the given content."""
+
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{sha256(data).hexdigest()[:12]}{ext}"
+
+
+class Builder:
+    """One run of the pipeline, writing into `dist_dir`."""
+
+    def __init__(self, dist_dir):
+        self.dist_dir = dist_dir
+        self.manifest = {}
+        # source location -> hashed file name, so shared files are written once
+        self._written = {}
+
+    def write(self, name, data):
+        """Write `data` under a content-hashed version of `name`."""
+
+        out_name = hashed_name(name, data)
+        path = os.path.join(self.dist_dir, out_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        if out_name.endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_BYTES:
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+
+        return out_name
+
+    def copy(self, location, folder):
+        """Copy a referenced file into dist/`folder`; returns its new name."""
+
+        if location not in self._written:
+            name = os.path.basename(urlparse(location).path)
+            self._written[location] = self.write(f"{folder}/{name}",
+                                                 read_source(location))
+        return self._written[location]
+
+    def rewrite_css_urls(self, css, base):
+        """Copy files `css` (loaded from `base`) references; point at copies."""
+
+        def replace(match):
+            ref = match.group(2).strip()
+            if ref.startswith(('data:', '#')):
+                return match.group(0)
+
+            location, sep, fragment = urljoin(base, ref).partition('#')
+            location = location.split('?')[0]
+            ext = os.path.splitext(urlparse(location).path)[1].lower()
+            folder = 'images' if ext in ('.png', '.jpg', '.jpeg', '.gif',
+                                         '.svg', '.ico', '.webp') else 'fonts'
+            # bundles live at the root of dist/, so this is relative to them
+            new = self.copy(location, folder)
+            return f'url("{new}{sep}{fragment}")'
+
+        return CSS_URL_RE.sub(replace, css)
+
+    def build_bundle(self, name, sources):
+        parts = []
+        for location in sources:
+            text = read_source(location).decode('utf-8')
+            if name.endswith('.css'):
+                text = minify_css(self.rewrite_css_urls(text, location))
+            else:
+                # guard against sources missing a trailing semicolon
+                text = text.strip().rstrip(';') + ';'
+            parts.append(text)
+
+        self.manifest[name] = self.write(name, '\n'.join(parts).encode())
+
+    def build(self, bundles=BUNDLES, images=IMAGES):
+        for name, sources in bundles.items():
+            click.echo(f"  bundling {name}")
+            self.build_bundle(name, sources)
+
+        for location in images:
+            self.manifest[location[len('/static/'):]] = self.copy(
+                location, os.path.dirname(location[len('/static/'):]))
+
+        with open(os.path.join(self.dist_dir, 'manifest.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+        return self.manifest
+
+
+##############################################################################
+# Runtime
+
+
+_manifests = {}
+
+
+def load_manifest(app=None):
+    """The build manifest for `app` ({} if assets haven't been built)."""
+
+    app = app or current_app
+    path = os.path.join(_dist_dir(app), 'manifest.json')
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = _manifests[path] = (mtime, json.load(f))
+    return cached[1]
+
+
+def asset_url(name):
+    """Template global: fingerprinted URL for `name`, or None if unbuilt."""
+
+    built = load_manifest().get(name)
+    return f"/assets/{built}" if built else None
+
+
+def send_asset(filename, accept_encoding):
+    """Response for a dist/ file, using a precompressed variant if possible."""
+
+    path = safe_join(_dist_dir(), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    encoding = None
+    # the client's favourite first; sorted() keeps br first on a tie
+    candidates = sorted((('br', '.br'), ('gzip', '.gz')),
+                        key=lambda c: -encoding_quality(accept_encoding, c[0]))
+    for candidate, ext in candidates:
+        if (encoding_quality(accept_encoding, candidate)
+                and os.path.exists(path + ext)):
+            encoding, path = candidate, path + ext
+            break
+
+    resp = send_file(path, mimetype=mimetype, max_age=FAR_FUTURE)
+    if encoding:
+        resp.content_encoding = encoding
+    resp.cache_control.immutable = True
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+##############################################################################
+# CLI
+
+
+@click.group('assets')
+def assets_cli():
+    """Build fingerprinted static assets."""
+
+
+@assets_cli.command('build')
+@with_appcontext
+def build_command():
+    """Vendor, bundle, minify, fingerprint and precompress static assets."""
+
+    dist_dir = _dist_dir()
+    click.echo(f"Building assets into {dist_dir}")
+    manifest = Builder(dist_dir).build()
+    for name, built in sorted(manifest.items()):
+        click.echo(f"  {name} -> {built}")
@@ -0,0 +1,331 @@
+"""Asynchronous read endpoints for Warbler, served under /api/async.
+
+A Flask view holds its worker thread for as long as its queries take, so a
+process serves at most as many slow reads at once as it has threads. The
+hottest reads are also served by this small ASGI app, which runs on an
+asyncio event loop with an async SQLAlchemy engine (asyncpg). One process
+then keeps thousands of reads in flight, limited by its connection pool
+rather than its threads. Queries that don't depend on each other, like a
+profile's counts and its messages, run at the same time on separate
+connections.
+
+Endpoints (JSON, in the same shapes as /api):
+
+- ``GET /api/async/timeline``: the logged-in user's home timeline (the
+  user comes from the Flask session cookie);
+- ``GET /api/async/users/<id>``: a profile, with its counts and recent
+  messages;
+- ``GET /api/async/messages/<id>``;
+- ``GET /api/async/users?q=...``: username search.
+
+``asgi.py`` serves these next to the Flask app (``uvicorn asgi:app``).
+
+The statements and cards are those of readmodels, only executed
+asynchronously. With MESSAGE_SHARDS set, message reads go through the
+synchronous shard set in the default thread pool.
+"""
+
+import asyncio
+import json
+import re
+import time
+from datetime import datetime
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from models import db, User, Message, Likes, Follows
+from readmodels import (MESSAGE_CARD_COLUMNS, USER_CARD_COLUMNS,
+                        RECENT_WINDOW, message_card_from_row,
+                        user_card_from_row)
+from api import message_card_json, user_card_json
+import metrics
+import readmodels
+
+PREFIX = '/api/async'
+
+# sync driver -> asyncio driver, by database backend
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(url):
+    """`url` with its driver swapped for an asyncio one."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend} databases")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def _message_select():
+    return (db.select(*MESSAGE_CARD_COLUMNS)
+            .join(User, Message.user_id == User.id))
+
+
+def _count(*where):
+    return db.select(db.func.count()).where(*where)
+
+
+##############################################################################
+# Queries
+
+
+class AsyncReads:
+    """The async read queries, against `app`'s database."""
+
+    def __init__(self, app):
+        self.app = app
+        url = async_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        options = {}
+        if url.get_backend_name() == 'postgresql':
+            options = dict(pool_size=app.config['ASYNC_POOL_SIZE'],
+                           max_overflow=app.config['ASYNC_POOL_OVERFLOW'])
+        self.engine = create_async_engine(url, **options)
+        self.sharded = 'message_shards' in app.extensions
+
+    async def _rows(self, stmt):
+        async with self.engine.connect() as conn:
+            return (await conn.execute(stmt)).all()
+
+    async def _scalar(self, stmt):
+        async with self.engine.connect() as conn:
+            return await conn.scalar(stmt)
+
+    async def _cards(self, stmt):
+        return [message_card_from_row(row) for row in await self._rows(stmt)]
+
+    async def _sync(self, fn, *args):
+        """Run a readmodels function in the thread pool."""
+
+        def call():
+            with self.app.app_context():
+                return fn(*args)
+
+        return await asyncio.to_thread(call)
+
+    async def _recent_first(self, stmt, limit):
+        # readmodels.recent_first, awaited
+        if not self.app.config.get('MESSAGES_PARTITIONED'):
+            return await self._cards(stmt.limit(limit))
+
+        cutoff = datetime.utcnow() - RECENT_WINDOW
+        cards = await self._cards(
+            stmt.where(Message.timestamp >= cutoff).limit(limit))
+        if len(cards) < limit:
+            cards += await self._cards(
+                stmt.where(Message.timestamp < cutoff)
+                .limit(limit - len(cards)))
+        return cards
+
+    async def timeline(self, user_id, limit=100):
+        """Most recent messages by `user_id` and the users they follow."""
+
+        following = (db.select(Follows.user_being_followed_id)
+                     .where(Follows.user_following_id == user_id))
+
+        if self.sharded:
+            ids = [id for id, in await self._rows(following)] + [user_id]
+            return await self._sync(readmodels.timeline_cards, ids, limit)
+
+        stmt = (_message_select()
+                .where(db.or_(Message.user_id == user_id,
+                              Message.user_id.in_(following)))
+                .order_by(Message.timestamp.desc()))
+        return await self._recent_first(stmt, limit)
+
+    async def user_messages(self, user_id, limit=100):
+        if self.sharded:
+            return await self._sync(readmodels.user_message_cards, user_id,
+                                    limit)
+
+        stmt = (_message_select()
+                .where(Message.user_id == user_id)
+                .order_by(Message.timestamp.desc()))
+        return await self._recent_first(stmt, limit)
+
+    async def message_count(self, user_id):
+        if self.sharded:
+            return await self._sync(readmodels.message_count, user_id)
+        return await self._scalar(_count(Message.user_id == user_id))
+
+    async def user(self, user_id):
+        rows = await self._rows(
+            db.select(*USER_CARD_COLUMNS).where(User.id == user_id))
+        return user_card_from_row(rows[0]) if rows else None
+
+    async def profile(self, user_id, limit=100):
+        """(user card, counts, message cards), or None for no such user.
+
+        All six queries run concurrently.
+        """
+
+        user, messages, following, followers, likes, recent = (
+            await asyncio.gather(
+                self.user(user_id),
+                self.message_count(user_id),
+                self._scalar(_count(Follows.user_following_id == user_id)),
+                self._scalar(_count(Follows.user_being_followed_id == user_id)),
+                self._scalar(_count(Likes.user_id == user_id)),
+                self.user_messages(user_id, limit)))
+
+        if user is None:
+            return None
+        counts = dict(messages=messages, following=following,
+                      followers=followers, likes=likes)
+        return user, counts, recent
+
+    async def message(self, message_id):
+        if self.sharded:
+            return await self._sync(readmodels.message_card, message_id)
+
+        cards = await self._cards(
+            _message_select().where(Message.id == message_id))
+        return cards[0] if cards else None
+
+    async def search(self, q=None):
+        stmt = db.select(*USER_CARD_COLUMNS)
+        if q:
+            stmt = stmt.where(User.username.like(f"%{q}%"))
+        return [user_card_from_row(row) for row in await self._rows(stmt)]
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+
+##############################################################################
+# ASGI app
+
+
+class AsyncAPI:
+    """ASGI app answering the read endpoints above for `app`."""
+
+    def __init__(self, app):
+        self.app = app
+        self.reads = AsyncReads(app)
+        self.routes = [
+            (re.compile(r'/timeline'), self.timeline),
+            (re.compile(r'/users/(\d+)'), self.profile),
+            (re.compile(r'/messages/(\d+)'), self.message),
+            (re.compile(r'/users'), self.search),
+        ]
+
+    def current_user_id(self, scope):
+        """User id from the Flask session cookie, or None."""
+
+        from app import CURR_USER_KEY
+
+        cookies = SimpleCookie()
+        for name, value in scope.get('headers', ()):
+            if name == b'cookie':
+                try:
+                    cookies.load(value.decode('latin-1'))
+                except CookieError:
+                    return None
+
+        morsel = cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+        serializer = self.app.session_interface.get_signing_serializer(
+            self.app)
+        if morsel is None or serializer is None:
+            return None
+
+        max_age = int(self.app.permanent_session_lifetime.total_seconds())
+        try:
+            session = serializer.loads(morsel.value, max_age=max_age)
+        except BadSignature:
+            return None
+        return session.get(CURR_USER_KEY)
+
+    async def timeline(self, scope, query):
+        user_id = self.current_user_id(scope)
+        if user_id is None:
+            return 401, {'error': "Access unauthorized."}
+
+        cards = await self.reads.timeline(user_id)
+        return 200, {'messages': [message_card_json(c) for c in cards]}
+
+    async def profile(self, scope, query, user_id):
+        profile = await self.reads.profile(int(user_id))
+        if profile is None:
+            return 404, {'error': "Not found."}
+
+        user, counts, messages = profile
+        return 200, {'user': user_card_json(user), 'counts': counts,
+                     'messages': [message_card_json(c) for c in messages]}
+
+    async def message(self, scope, query, message_id):
+        card = await self.reads.message(int(message_id))
+        if card is None:
+            return 404, {'error': "Not found."}
+        return 200, {'message': message_card_json(card)}
+
+    async def search(self, scope, query):
+        users = await self.reads.search(query.get('q', [None])[0])
+        return 200, {'users': [user_card_json(u) for u in users]}
+
+    async def handle(self, scope):
+        path = scope['path'][len(PREFIX):]
+        if scope['method'] not in ('GET', 'HEAD'):
+            return 'unknown', 405, {'error': "Method not allowed."}
+
+        query = parse_qs(scope.get('query_string', b'').decode())
+        for pattern, handler in self.routes:
+            match = pattern.fullmatch(path)
+            if match:
+                status, body = await handler(scope, query, *match.groups())
+                return pattern.pattern, status, body
+        return 'unknown', 404, {'error': "Not found."}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        started = time.perf_counter()
+        route, status, body = await self.handle(scope)
+
+        endpoint = f"async:{route}"
+        metrics.request_duration.observe(time.perf_counter() - started,
+                                         endpoint)
+        metrics.requests_total.inc(endpoint, scope['method'], str(status))
+
+        data = json.dumps(body).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(data)).encode())]})
+        await send({'type': 'http.response.body',
+                    'body': b'' if scope['method'] == 'HEAD' else data})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.reads.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def mount(app, wsgi_app):
+    """ASGI app serving /api/async from `AsyncAPI` and everything else from
+    `wsgi_app` (an ASGI wrapper around the Flask app)."""
+
+    async_api = AsyncAPI(app)
+
+    async def dispatch(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await async_api(scope, receive, send)
+        if scope['type'] == 'http' and (
+                scope['path'] == PREFIX
+                or scope['path'].startswith(PREFIX + '/')):
+            return await async_api(scope, receive, send)
+        return await wsgi_app(scope, receive, send)
+
+    dispatch.async_api = async_api
+    return dispatch
@@ -0,0 +1,251 @@
+"""Username prefix autocomplete for Warbler.
+
+The search box's type-ahead asks for the first few usernames starting with
+what's been typed so far. `list_users()`'s ``LIKE '%q%'`` can't use an index
+and returns whole cards, so instead:
+
+- `UsernameIndex` keeps every (lower-cased username, username, id) in a
+  sorted array in memory; a prefix is two binary searches, and the first N
+  matches are a slice.
+- The array is built in a background thread at startup (`init_app`, if
+  AUTOCOMPLETE_WARM), or else the first time it's needed. Until it's
+  ready, lookups fall back to ``lower(username) LIKE 'prefix%'``, which
+  Postgres answers from the text_pattern_ops index
+  ix_users_username_lower_pattern.
+- Signups, renames and deletions are applied when their transaction
+  commits (collected by mapper events, applied by a session after_commit
+  hook), so a rolled-back signup never shows up.
+
+Like the availability filters the index is per-process; bulk deletes that
+bypass the ORM (``User.query.delete()``) aren't seen until `reset`.
+"""
+
+import threading
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+import metrics
+from models import db, User
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 25
+
+# the first code point after every username character, for "prefix end"
+_HIGH = '\U0010ffff'
+
+
+class UsernameIndex:
+    """Sorted in-memory array of usernames for prefix lookups."""
+
+    def __init__(self):
+        # parallel arrays sorted by (lower-cased username, id)
+        self._keys = []
+        self._users = []
+        self._names = {}
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def load(self, rows):
+        """Replace the contents with (id, username) `rows`."""
+
+        entries = sorted(((username.lower(), id), (id, username))
+                         for id, username in rows)
+        with self._lock:
+            self._keys = [key for key, _ in entries]
+            self._users = [user for _, user in entries]
+            self._names = dict(self._users)
+            self.ready = True
+
+    def add(self, id, username):
+        """Add a user, or update their username."""
+
+        with self._lock:
+            self._remove(id)
+            key = (username.lower(), id)
+            i = bisect_left(self._keys, key)
+            self._keys.insert(i, key)
+            self._users.insert(i, (id, username))
+            self._names[id] = username
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        username = self._names.pop(id, None)
+        if username is not None:
+            i = bisect_left(self._keys, (username.lower(), id))
+            del self._keys[i]
+            del self._users[i]
+
+    def complete(self, prefix, limit=DEFAULT_LIMIT):
+        """[(id, username)] of up to `limit` users whose name starts with
+        `prefix` (case-insensitively), in alphabetical order."""
+
+        prefix = prefix.lower()
+        with self._lock:
+            start = bisect_left(self._keys, (prefix,))
+            end = min(start + limit,
+                      bisect_left(self._keys, (prefix + _HIGH,)))
+            return self._users[start:end]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+index = UsernameIndex()
+
+_build_lock = threading.Lock()
+_building = False
+# changes committed while a build was reading the table
+_missed = []
+
+
+def sql_complete(prefix, limit=DEFAULT_LIMIT):
+    """The cold-start fallback: a prefix range scan in the database."""
+
+    lower = db.func.lower(User.username)
+    stmt = (db.select(User.id, User.username)
+            .where(lower.startswith(prefix.lower(), autoescape=True))
+            .order_by(lower, User.id)
+            .limit(limit))
+    return [tuple(row) for row in db.session.execute(stmt)]
+
+
+def build():
+    """(Re)load the index from the users table."""
+
+    global _building
+
+    with _build_lock:
+        _building = True
+        del _missed[:]
+
+    try:
+        rows = db.session.execute(db.select(User.id, User.username)).all()
+        with _build_lock:
+            index.load(rows)
+            for change in _missed:
+                _apply(*change)
+    finally:
+        with _build_lock:
+            _building = False
+            del _missed[:]
+
+
+def _build_in_background(app):
+    """Start `build` in a thread, unless one is already running.
+
+    Returns the thread (or None).
+    """
+
+    global _building
+
+    with _build_lock:
+        if _building:
+            return None
+        # claimed here, so concurrent callers don't each start a build
+        _building = True
+
+    def run():
+        with app.app_context():
+            try:
+                build()
+            except Exception:
+                app.logger.exception("Building the username index failed")
+            finally:
+                db.session.remove()
+
+    thread = threading.Thread(target=run, name='autocomplete-build',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def init_app(app):
+    """Start building the index in the background, if AUTOCOMPLETE_WARM.
+
+    Returns the thread doing it (or None).
+    """
+
+    if not app.config.get('AUTOCOMPLETE_WARM'):
+        return None
+    return _build_in_background(app)
+
+
+def complete(prefix, limit=DEFAULT_LIMIT):
+    """Usernames starting with `prefix`, from memory once the index is built."""
+
+    if index.ready:
+        metrics.cache_hit('autocomplete')
+        return index.complete(prefix, limit)
+
+    metrics.cache_miss('autocomplete')
+    _build_in_background(current_app._get_current_object())
+
+    return sql_complete(prefix, limit)
+
+
+def reset():
+    """Forget the index; it is rebuilt on next use."""
+
+    global index
+    index = UsernameIndex()
+
+
+##############################################################################
+# Keeping the index current
+#
+# Changes are noted per session during flush and applied on commit.
+
+
+def _note(user, change):
+    session = object_session(user)
+    if session is not None:
+        session.info.setdefault('autocomplete', []).append(change)
+
+
+def _apply(action, id, username):
+    if action == 'add':
+        index.add(id, username)
+    else:
+        index.remove(id)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, user):
+    _note(user, ('add', user.id, user.username))
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, user):
+    if inspect(user).attrs.username.history.added:
+        _note(user, ('add', user.id, user.username))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    _note(user, ('remove', user.id, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('autocomplete', ())
+    if not changes:
+        return
+
+    with _build_lock:
+        if _building:
+            _missed.extend(changes)
+        elif index.ready:
+            for change in changes:
+                _apply(*change)
+        # otherwise the next build will read them from the table
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('autocomplete', None)
@@ -0,0 +1,198 @@
+"""Username / email availability checks for Warbler.
+
+Signup used to find out a username was taken only by hashing the password,
+committing, and catching the IntegrityError. Instead we probe first:
+
+- a Bloom filter of every (lower-cased) username and email answers "never
+  seen it" from memory, which is the common case for a fresh signup;
+- anything the filter *might* contain is confirmed with an indexed
+  ``lower(username) = ...`` existence query.
+
+The filters are built from the users table at startup, in a background
+thread (AVAILABILITY_WARM; otherwise on first use), and kept current by
+mapper events on every User insert/update (signup, profile rename). Bloom
+filters can't forget, so deleted and renamed-away names just cost a DB probe
+until the next rebuild. Filters are per-process; the unique index on
+lower(username)/lower(email) remains the final word, so callers should
+still handle IntegrityError on commit.
+
+Another worker's signups and renames don't reach this process's filters,
+so "never seen it" can be wrong until the next rebuild. Forms only use it as
+a pre-check before that commit; /api/username-available, whose answer is
+final as far as the caller knows, confirms every answer in the database
+(exact=True).
+
+Only usernames can be probed over HTTP (/api/username-available, rate
+limited): an email check would tell anyone which addresses have accounts.
+"""
+
+import math
+import threading
+from hashlib import blake2b
+
+from sqlalchemy import event
+
+import metrics
+from models import db, User
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    Sized for `capacity` items at roughly `error_rate` false positives; it
+    degrades gracefully (more false positives) if over-filled.
+    """
+
+    def __init__(self, capacity=100_000, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate)
+                                   / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        # Kirsch-Mitzenmacher: derive k positions from two 64-bit hashes
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        with self._lock:
+            for pos in self._positions(item):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class AvailabilityIndex:
+    """Bloom-filter-fronted existence checks for one case-insensitive column."""
+
+    def __init__(self, column, error_rate=0.01):
+        self.column = column
+        self.error_rate = error_rate
+        self._filter = None
+        # reentrant: _bloom() rebuilds while holding it
+        self._lock = threading.RLock()
+
+    def rebuild(self):
+        """Reload the filter from the database."""
+
+        with self._lock:
+            values = db.session.scalars(
+                db.select(db.func.lower(self.column))).all()
+            bloom = BloomFilter(capacity=max(len(values) * 2, 1000),
+                                error_rate=self.error_rate)
+            for value in values:
+                bloom.add(value)
+            self._filter = bloom
+
+    def _bloom(self):
+        if self._filter is None:
+            with self._lock:
+                if self._filter is None:
+                    self.rebuild()
+        return self._filter
+
+    def add(self, value):
+        """Record a newly-used value.
+
+        A no-op until the filter has been built, since building it will read
+        the value from the database anyway.
+        """
+
+        bloom = self._filter
+        if bloom is not None and value:
+            bloom.add(value.lower())
+
+    def exists(self, value, exact=False):
+        """Is `value` (case-insensitively) already in use?
+
+        With `exact`, always ask the database rather than trust a negative
+        from this process's filter.
+        """
+
+        value = value.lower()
+        if not exact and value not in self._bloom():
+            metrics.cache_hit('availability_bloom')
+            return False
+
+        metrics.cache_miss('availability_bloom')
+        stmt = db.select(db.exists().where(db.func.lower(self.column) == value))
+        return db.session.scalar(stmt)
+
+    def reset(self):
+        """Drop the filter; it is rebuilt on next use."""
+
+        self._filter = None
+
+
+usernames = AvailabilityIndex(User.username)
+emails = AvailabilityIndex(User.email)
+
+
+def username_available(username, current_user=None, exact=False):
+    """Can `username` be claimed (by `current_user`, if renaming)?
+
+    `exact` as for `AvailabilityIndex.exists`.
+    """
+
+    if current_user and current_user.username.lower() == username.lower():
+        return True
+    return not usernames.exists(username, exact)
+
+
+def email_available(email, current_user=None):
+    """Can `email` be claimed (by `current_user`, if changing it)?"""
+
+    if current_user and current_user.email.lower() == email.lower():
+        return True
+    return not emails.exists(email)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def remember_user(mapper, connection, user):
+    """Add a newly created or renamed user's identifiers to the filters."""
+
+    usernames.add(user.username)
+    emails.add(user.email)
+
+
+def rebuild():
+    """Reload both filters from the database (e.g. at startup)."""
+
+    usernames.rebuild()
+    emails.rebuild()
+
+
+def init_app(app):
+    """Start building the filters in the background, if AVAILABILITY_WARM.
+
+    Returns the thread doing it (or None).
+    """
+
+    if not app.config.get('AVAILABILITY_WARM'):
+        return None
+
+    def build():
+        with app.app_context():
+            try:
+                rebuild()
+            except Exception:
+                app.logger.exception("Building availability filters failed")
+
+    thread = threading.Thread(target=build, name='availability-rebuild',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def reset():
+    """Forget both filters; they are rebuilt on next use."""
+
+    usernames.reset()
+    emails.reset()
@@ -0,0 +1,118 @@
+"""Profile-read throughput at increasing concurrency: sync vs async path.
+
+Each request reads one profile: the user, its four counts and its latest
+messages.
+
+- sync: the readmodels queries one after another, on a pool of THREADS
+  threads (a threaded WSGI worker), each with its own session;
+- async: `asyncapi.AsyncReads.profile`, the same queries gathered
+  concurrently, as tasks on one event loop.
+
+Every concurrency level is that many clients each sending its next request
+as soon as the previous one is answered; latencies include any wait for a
+thread or a connection.
+
+Against the default scratch SQLite file both sides mostly measure Python
+overhead (aiosqlite runs each connection in a thread). Point DATABASE_URL
+at Postgres to see the async path multiplexing network round trips.
+"""
+
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import app, seed
+from models import db, User, Likes, Follows
+from readmodels import user_cards_by_ids, message_count, user_message_cards
+from asyncapi import AsyncReads
+
+NUM_USERS = 300
+REQUESTS = 2000
+THREADS = 16
+CONCURRENCY = [1, 16, 64, 256]
+
+
+def sync_profile(user_id):
+    with app.app_context():
+        count = db.select(db.func.count())
+        return (user_cards_by_ids([user_id]),
+                message_count(user_id),
+                db.session.scalar(count.where(
+                    Follows.user_following_id == user_id)),
+                db.session.scalar(count.where(
+                    Follows.user_being_followed_id == user_id)),
+                db.session.scalar(count.where(Likes.user_id == user_id)),
+                user_message_cards(user_id))
+
+
+def _clients(user_ids, concurrency):
+    """`user_ids` dealt out to `concurrency` clients."""
+
+    return [user_ids[i::concurrency] for i in range(concurrency)]
+
+
+def run_sync(user_ids, concurrency):
+    latencies = []
+
+    with ThreadPoolExecutor(THREADS) as workers:
+        def client(ids):
+            for user_id in ids:
+                started = time.perf_counter()
+                workers.submit(sync_profile, user_id).result()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as clients:
+            list(clients.map(client, _clients(user_ids, concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return elapsed, latencies
+
+
+async def run_async(user_ids, concurrency):
+    reads = AsyncReads(app)
+    latencies = []
+
+    async def client(ids):
+        for user_id in ids:
+            started = time.perf_counter()
+            await reads.profile(user_id)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(ids)
+                           for ids in _clients(user_ids, concurrency)))
+    elapsed = time.perf_counter() - started
+
+    await reads.dispose()
+    return elapsed, latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    seed(num_users=NUM_USERS)
+    rng = random.Random(0)
+    user_ids = [rng.randint(1, NUM_USERS) for _ in range(REQUESTS)]
+    assert db.session.get(User, user_ids[0]) is not None
+
+    print(f"{REQUESTS} profile reads, sync on {THREADS} threads\n")
+    print(f"{'concurrency':<13}{'path':<7}{'req/s':>9}{'p50 ms':>9}"
+          f"{'p99 ms':>9}")
+    for concurrency in CONCURRENCY:
+        for path, run in [
+                ('sync', lambda: run_sync(user_ids, concurrency)),
+                ('async', lambda: asyncio.run(
+                    run_async(user_ids, concurrency)))]:
+            elapsed, latencies = run()
+            print(f"{concurrency:<13}{path:<7}{REQUESTS / elapsed:>9.0f}"
+                  f"{percentile(latencies, 0.5) * 1000:>9.2f}"
+                  f"{percentile(latencies, 0.99) * 1000:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
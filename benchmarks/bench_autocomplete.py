@@ -0,0 +1,35 @@
+"""Latency of username prefix lookups: in-memory index vs SQL.
+
+Compares, for prefixes of increasing length:
+
+- `autocomplete.UsernameIndex.complete` (the built index);
+- `autocomplete.sql_complete` (the cold-start LIKE 'prefix%' fallback);
+- the substring search `list_users()` does (LIKE '%q%').
+"""
+
+from common import seed, timed
+import autocomplete
+from readmodels import user_cards
+
+NUM_USERS = 20_000
+PREFIXES = ['u', 'us', 'user1', 'user12', 'user1234']
+
+
+def main():
+    seed(num_users=NUM_USERS, num_messages=1000, follows_per_user=2,
+         likes_per_user=0)
+
+    wall, _ = timed(autocomplete.build, repeat=3)
+    print(f"build index of {NUM_USERS} users: {wall * 1000:.1f} ms\n")
+
+    print(f"{'prefix':<10}{'index ms':>10}{'sql ms':>10}{'substr ms':>11}")
+    for prefix in PREFIXES:
+        index, _ = timed(lambda: autocomplete.index.complete(prefix), 200)
+        sql, _ = timed(lambda: autocomplete.sql_complete(prefix))
+        substring, _ = timed(lambda: user_cards(prefix), 5)
+        print(f"{prefix:<10}{index * 1000:>10.3f}{sql * 1000:>10.3f}"
+              f"{substring * 1000:>11.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Bytes on the wire and CPU cost of response compression, per route.
+
+For each page, renders it once uncompressed, then times compressing that
+body with gzip and brotli at several levels.
+"""
+
+import gzip
+
+import brotli
+
+from common import seed, logged_in_client, timed
+
+ROUTES = ['/', '/users', '/users/1', '/users/1/following', '/users/1/followers']
+
+SETTINGS = [
+    ('gzip-1', lambda body: gzip.compress(body, 1)),
+    ('gzip-6', lambda body: gzip.compress(body, 6)),
+    ('gzip-9', lambda body: gzip.compress(body, 9)),
+    ('br-1', lambda body: brotli.compress(body, quality=1)),
+    ('br-4', lambda body: brotli.compress(body, quality=4)),
+    ('br-11', lambda body: brotli.compress(body, quality=11)),
+]
+
+
+def main():
+    seed()
+    client = logged_in_client()
+
+    print(f"{'route':<22}{'setting':<10}{'bytes':>10}{'ratio':>8}"
+          f"{'cpu ms':>9}")
+    for route in ROUTES:
+        body = client.get(route).get_data()
+        print(f"{route:<22}{'identity':<10}{len(body):>10}{1:>8.2f}"
+              f"{0:>9.2f}")
+
+        for name, compress in SETTINGS:
+            size = len(compress(body))
+            _, cpu = timed(lambda: compress(body))
+            print(f"{'':<22}{name:<10}{size:>10}{len(body) / size:>8.2f}"
+                  f"{cpu * 1000:>9.2f}")
+
+    # end-to-end check that the middleware is in the request path
+    resp = client.get('/', headers={'Accept-Encoding': 'br, gzip'})
+    print(f"\nGET / with Accept-Encoding: br, gzip -> "
+          f"{resp.headers.get('Content-Encoding')}, "
+          f"{len(resp.get_data())} bytes on the wire")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Cold-start time of the app, per profile, in fresh interpreters.
+
+Measures `import app; create_app(...)` the way a pre-fork worker or a CLI
+command pays for it, and compares against STARTUP_BUDGET_MS.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = """
+import time
+started = time.perf_counter()
+from app import create_app
+app = create_app({profile!r}, views={views})
+total = (time.perf_counter() - started) * 1000
+print(total, app.config['STARTUP_MS'], app.config['STARTUP_BUDGET_MS'])
+"""
+
+CASES = [
+    ('development', True),
+    ('production', True),
+    ('production', False),
+]
+
+
+def run(profile, views, repeat=7):
+    env = dict(os.environ, SECRET_KEY='bench', PYTHONDONTWRITEBYTECODE='')
+    env.setdefault('DATABASE_URL', "sqlite:///" + os.path.join(
+        tempfile.gettempdir(), 'warbler-bench.db'))
+
+    totals, factories = [], []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', SNIPPET.format(profile=profile,
+                                                 views=views)],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+        total, factory, budget = out.stdout.split()
+        totals.append(float(total))
+        factories.append(float(factory))
+    return statistics.median(totals), statistics.median(factories), budget
+
+
+def main():
+    print(f"{'profile':<14}{'views':<7}{'import+create ms':>18}"
+          f"{'create_app ms':>15}{'budget ms':>11}")
+    for profile, views in CASES:
+        total, factory, budget = run(profile, views)
+        print(f"{profile:<14}{str(views):<7}{total:>18.1f}{factory:>15.1f}"
+              f"{budget:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Accuracy and latency of the trending counters against exact answers.
+
+Replays a skewed (Zipf-like) stream of likes over a few simulated hours into
+`trending.Trending`, then compares its top 10 messages with:
+
+- exact decayed scores computed from the same events in Python;
+- the exact SQL a naive /trending would run per request (likes grouped by
+  message; likes aren't timestamped, so it can't decay).
+"""
+
+import random
+
+from common import seed, timed
+from models import db, Likes
+from trending import BUCKET_SECONDS, NUM_BUCKETS, HALF_LIFE_SECONDS, Trending
+
+NUM_MESSAGES = 5000
+EVENTS = 200_000
+HOURS = 3
+TOP = 10
+
+
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def exact_decayed(events, now):
+    """Score per message with the same bucketing and decay as the sketch."""
+
+    horizon = now - BUCKET_SECONDS * NUM_BUCKETS
+    scores = {}
+    for when, message_id in events:
+        start = when // BUCKET_SECONDS * BUCKET_SECONDS
+        if start <= horizon:
+            continue
+        age = max(0, now - start - BUCKET_SECONDS)
+        scores[message_id] = (scores.get(message_id, 0)
+                              + 0.5 ** (age / HALF_LIFE_SECONDS))
+    return sorted(scores.items(), key=lambda pair: -pair[1])
+
+
+def main():
+    seed(num_messages=NUM_MESSAGES)
+    rng = random.Random(1)
+
+    # popularity drifts: each hour a different set of messages is hot
+    events = []
+    for i in range(EVENTS):
+        when = i * HOURS * 3600 / EVENTS
+        hot = int(when // 3600) * 997
+        rank = min(int(rng.paretovariate(1.2)), NUM_MESSAGES) - 1
+        events.append((when, (hot + rank * 7919) % NUM_MESSAGES + 1))
+
+    clock = Clock()
+    tracker = Trending(clock=clock)
+    for when, message_id in events:
+        clock.now = when
+        tracker.record_like(message_id, 1)
+
+    approx = tracker.top_messages(TOP)
+    exact = exact_decayed(events, clock.now)[:TOP]
+
+    exact_ids = {id for id, _ in exact}
+    hits = sum(id in exact_ids for id, _ in approx)
+    exact_scores = dict(exact_decayed(events, clock.now))
+    errors = [abs(score - exact_scores[id]) / exact_scores[id]
+              for id, score in approx]
+
+    print(f"{EVENTS} likes over {HOURS}h, {NUM_MESSAGES} messages")
+    print(f"top-{TOP} overlap with exact decayed ranking: {hits}/{TOP}")
+    print(f"max relative score error in top-{TOP}: {max(errors):.2%}")
+
+    wall, _ = timed(lambda: tracker.messages.top(TOP, clock.now))
+    print(f"\nsketch ranking, uncached:       {wall * 1000:8.3f} ms")
+    wall, _ = timed(lambda: tracker.top_messages(TOP))
+    print(f"sketch top_messages({TOP}), cached: {wall * 1000:8.3f} ms")
+
+    stmt = (db.select(Likes.message_id, db.func.count())
+            .group_by(Likes.message_id)
+            .order_by(db.func.count().desc())
+            .limit(TOP))
+    num_likes = db.session.scalar(
+        db.select(db.func.count()).select_from(Likes))
+    wall, _ = timed(lambda: db.session.execute(stmt).all())
+    print(f"SQL likes GROUP BY ({num_likes} rows): {wall * 1000:8.3f} ms")
+
+    wall, _ = timed(lambda: exact_decayed(events, clock.now), repeat=3)
+    print(f"exact decayed scan of {EVENTS} events: {wall * 1000:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
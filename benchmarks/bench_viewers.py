@@ -0,0 +1,89 @@
+"""Memory and accuracy of per-message unique-viewer sketches.
+
+For messages with 1 to 100,000 distinct viewers, compares a
+`viewers.HyperLogLog` with the exact alternative, a set of viewer keys:
+
+- memory per message in this process (tracemalloc, so Python object
+  overhead included) and the size of the stored blob;
+- relative error of the estimate, over several independent trials (each
+  trial draws different viewer keys);
+- time to count and to merge two sketches, as a page view and a flush do.
+"""
+
+import random
+import tracemalloc
+
+from common import timed
+from viewers import PRECISION, HyperLogLog
+
+SIZES = (1, 10, 100, 1000, 10_000, 100_000)
+TRIALS = 20
+
+
+def viewer_keys(n, rng):
+    return [f"user:{rng.getrandbits(48)}" for _ in range(n)]
+
+
+def allocated(build):
+    """Bytes still allocated by what `build()` returns."""
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def main():
+    rng = random.Random(1)
+    standard_error = 1.04 / (1 << PRECISION) ** 0.5
+    print(f"precision {PRECISION}: {1 << PRECISION} registers, "
+          f"standard error {standard_error:.2%}\n")
+
+    print(f"{'viewers':>8} {'sketch mem':>11} {'blob':>7} {'set mem':>11} "
+          f"{'mean err':>9} {'max err':>8}")
+    for n in SIZES:
+        keys = viewer_keys(n, rng)
+
+        def build_sketch():
+            sketch = HyperLogLog()
+            for key in keys:
+                sketch.add(key)
+            return sketch
+
+        sketch_bytes, sketch = allocated(build_sketch)
+        # the keys themselves already exist; count only the set's table
+        set_bytes, _ = allocated(lambda: set(keys))
+
+        errors = []
+        for _ in range(TRIALS):
+            trial = HyperLogLog()
+            for key in viewer_keys(n, rng):
+                trial.add(key)
+            errors.append(abs(trial.count() - n) / n)
+
+        print(f"{n:>8} {sketch_bytes:>10}B {len(sketch.to_bytes()):>6}B "
+              f"{set_bytes:>10}B {sum(errors) / TRIALS:>9.2%} "
+              f"{max(errors):>8.2%}")
+
+    small, large = HyperLogLog(), HyperLogLog()
+    for key in viewer_keys(50, rng):
+        small.add(key)
+    for key in viewer_keys(50_000, rng):
+        large.add(key)
+    blob = large.to_bytes()
+
+    print()
+    wall, _ = timed(small.count)
+    print(f"count, sparse (50 viewers):   {wall * 1000:8.3f} ms")
+    wall, _ = timed(large.count)
+    print(f"count, dense (50,000):        {wall * 1000:8.3f} ms")
+    wall, _ = timed(lambda: large.copy().merge(large))
+    print(f"copy + merge, dense:          {wall * 1000:8.3f} ms")
+    wall, _ = timed(lambda: HyperLogLog.from_bytes(blob).to_bytes())
+    print(f"blob decode + encode, dense:  {wall * 1000:8.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
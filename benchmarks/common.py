@@ -0,0 +1,95 @@
+"""Shared setup for Warbler benchmarks.
+
+Benchmarks run against DATABASE_URL if set, otherwise a scratch SQLite file,
+seeded with synthetic users, follows, messages and likes. Run them from the
+repo root, e.g.::
+
+    python benchmarks/bench_compression.py
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = (
+        "sqlite:///" + os.path.join(tempfile.gettempdir(), 'warbler-bench.db'))
+
+from app import create_app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Message, Follows, Likes  # noqa: E402
+from likecounts import reconcile  # noqa: E402
+
+app = create_app('testing')
+app.app_context().push()
+
+# a fixed, cheap hash so seeding doesn't spend minutes in bcrypt
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+
+def seed(num_users=300, num_messages=5000, follows_per_user=50,
+         likes_per_user=20, seed_value=0):
+    """Recreate the schema and fill it with synthetic data."""
+
+    rng = random.Random(seed_value)
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        dict(username=f"user{i}", email=f"user{i}@example.com",
+             password=PASSWORD_HASH, bio=f"Bio of user {i}",
+             image_url=User.image_url.default.arg,
+             header_image_url=User.header_image_url.default.arg)
+        for i in range(1, num_users + 1)])
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Message), [
+        dict(text=f"Warble {i} " + "lorem ipsum " * rng.randint(1, 10),
+             timestamp=now - timedelta(minutes=num_messages - i),
+             user_id=rng.randint(1, num_users))
+        for i in range(1, num_messages + 1)])
+
+    follows = set()
+    for user_id in range(1, num_users + 1):
+        for other in rng.sample(range(1, num_users + 1), follows_per_user):
+            if other != user_id:
+                follows.add((other, user_id))
+    db.session.execute(db.insert(Follows), [
+        dict(user_being_followed_id=a, user_following_id=b,
+             created_at=now - timedelta(seconds=rng.randint(0, 10 ** 6)))
+        for a, b in follows])
+
+    liked = rng.sample(range(1, num_messages + 1),
+                       min(num_messages, num_users * likes_per_user))
+    db.session.execute(db.insert(Likes), [
+        dict(user_id=rng.randint(1, num_users), message_id=message_id)
+        for message_id in liked])
+
+    db.session.commit()
+    reconcile()
+
+
+def logged_in_client(user_id=1):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+    return client
+
+
+def timed(fn, repeat=20):
+    """(median wall seconds, median CPU seconds) of calling `fn`."""
+
+    walls, cpus = [], []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        fn()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    walls.sort()
+    cpus.sort()
+    return walls[len(walls) // 2], cpus[len(cpus) // 2]
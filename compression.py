@@ -0,0 +1,189 @@
+"""WSGI response compression for Warbler.
+
+Wraps the Flask WSGI app and compresses text responses (HTML pages, JSON)
+with brotli or gzip, whichever the client prefers (brotli on a tie).
+Responses are left alone when they:
+
+- already have a Content-Encoding (e.g. precompressed /assets/ files);
+- aren't one of COMPRESSIBLE_TYPES (images, event streams...);
+- declare a Content-Length below `min_size`, where the header overhead
+  outweighs the saving.
+
+Responses without a Content-Length (streamed bodies) are compressed chunk by
+chunk with a sync flush after each, so clients still see data as soon as the
+app yields it.
+
+A strong ETag promises byte-for-byte identical bodies, which the encoded
+body isn't; compressed responses carry it as a weak ETag instead (If-None-
+Match compares weakly, so revalidation still works).
+"""
+
+import zlib
+
+from werkzeug.datastructures import Headers
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+)
+
+
+def encoding_quality(accept_encoding, encoding):
+    """Quality an Accept-Encoding header gives `encoding` (0: not accepted).
+
+    An entry naming the encoding beats a "*" wildcard, so "br;q=0, *" refuses
+    brotli. (werkzeug's parse_accept_header drops q=0 entries, which loses
+    exactly that refusal.)
+    """
+
+    wildcard = 0
+    for entry in (accept_encoding or '').split(','):
+        value, _, params = entry.partition(';')
+        value = value.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, arg = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = min(max(float(arg), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+        if value == encoding:
+            return quality
+        if value == '*':
+            wildcard = quality
+    return wildcard
+
+
+class _Gzip:
+    def __init__(self, level):
+        # wbits 16+MAX_WBITS: gzip container rather than raw zlib
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware:
+    """Compress eligible responses from `app` with brotli or gzip.
+
+    `level` is the gzip level (1-9) and `brotli_quality` the brotli quality
+    (0-11); the defaults trade a little ratio for much less CPU than the
+    maximums, which only pay off for precompressed static files.
+    """
+
+    def __init__(self, app, level=6, brotli_quality=4, min_size=500,
+                 mimetypes=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+        self.mimetypes = frozenset(mimetypes)
+
+    def choose_encoding(self, environ):
+        """'br', 'gzip' or None, per the request's Accept-Encoding."""
+
+        accept = environ.get('HTTP_ACCEPT_ENCODING')
+        offers = ('br', 'gzip') if brotli else ('gzip',)
+        # the highest quality wins; max() keeps the first (br) on a tie
+        best = max(offers, key=lambda offer: encoding_quality(accept, offer))
+        return best if encoding_quality(accept, best) else None
+
+    def _compressor(self, encoding):
+        if encoding == 'br':
+            return _Brotli(self.brotli_quality)
+        return _Gzip(self.level)
+
+    def should_compress(self, environ, status, headers):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return False
+        if status[:3] in ('204', '206', '304') or 'Content-Encoding' in headers:
+            return False
+
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        if mimetype not in self.mimetypes:
+            return False
+
+        length = headers.get('Content-Length')
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        state = {}
+
+        def compressing_start_response(status, response_headers, exc_info=None):
+            headers = Headers(response_headers)
+            if 'Accept-Encoding' not in headers.get('Vary', ''):
+                headers.add('Vary', 'Accept-Encoding')
+
+            if self.should_compress(environ, status, headers):
+                state['streaming'] = 'Content-Length' not in headers
+                state['compressor'] = self._compressor(encoding)
+                headers.remove('Content-Length')
+                headers['Content-Encoding'] = encoding
+                etag = headers.get('ETag')
+                if etag and not etag.startswith('W/'):
+                    headers['ETag'] = 'W/' + etag
+
+            write = start_response(status, headers.to_wsgi_list(), exc_info)
+            if 'compressor' not in state:
+                return write
+
+            def compressing_write(data):
+                write(state['compressor'].compress(data)
+                      + state['compressor'].flush())
+            return compressing_write
+
+        app_iter = self.app(environ, compressing_start_response)
+        if 'compressor' not in state:
+            return app_iter
+
+        return self._compress_iter(app_iter, state['compressor'],
+                                   state['streaming'])
+
+    def _compress_iter(self, app_iter, compressor, streaming):
+        try:
+            for chunk in app_iter:
+                data = compressor.compress(chunk)
+                if streaming:
+                    data += compressor.flush()
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -0,0 +1,152 @@
+"""Configuration profiles for Warbler.
+
+`create_app` picks one by name ('development', 'production' or 'testing'),
+defaulting to the WARBLER_ENV environment variable, then 'development'.
+Settings that come from the environment are read when the profile is
+instantiated (i.e. at app creation), not at import.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # install Flask-DebugToolbar (it then only shows in debug mode)
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    COMPRESS_MIN_SIZE = 500
+    REALTIME_MAX_AGE = 300
+    RATELIMIT_ENABLED = True
+    # how long like counts are coalesced in memory before an UPDATE
+    LIKECOUNT_FLUSH_SECONDS = 5
+    # recompute like counts from `likes` at startup and this often, in every
+    # worker (None: only by `flask likes reconcile`)
+    LIKECOUNT_RECONCILE_SECONDS = None
+    # how often unique-viewer sketches are merged into the database
+    VIEWERS_FLUSH_SECONDS = 60
+    METRICS_FLUSH_SECONDS = 10
+
+    # fraction of requests to profile (besides ones with a signed header)
+    PROFILE_SAMPLE_RATE = 0
+    PROFILE_INTERVAL_MS = 5
+
+    # statements slower than this are logged (None: don't), and this
+    # fraction of those are EXPLAINed
+    SLOW_QUERY_MS = 100
+    SLOW_QUERY_EXPLAIN_RATE = 0.1
+
+    # share compiled templates between workers via TEMPLATE_CACHE_DIR, and
+    # load them all at boot
+    TEMPLATE_BYTECODE_CACHE = False
+    TEMPLATE_WARM = False
+
+    # build the username/email Bloom filters at startup, in the background
+    AVAILABILITY_WARM = True
+    # likewise the username autocomplete index
+    AUTOCOMPLETE_WARM = True
+
+    # messages partitioned by month (see partitions.py): how many future
+    # months to keep created, and how often to check
+    PARTITIONS_AHEAD = 3
+    PARTITION_CHECK_SECONDS = 3600
+
+    # seconds hot read results are cached for (0: don't cache; see
+    # querycache.py), and how many entries each worker keeps
+    QUERY_CACHE_TTL = 0
+    QUERY_CACHE_MAX_ENTRIES = 10_000
+
+    # connections the async read API (asyncapi.py) may hold open
+    ASYNC_POOL_SIZE = 20
+    ASYNC_POOL_OVERFLOW = 20
+
+    # create_app logs a warning if it takes longer than this (not counting
+    # the interpreter and Flask/SQLAlchemy imports every process pays)
+    STARTUP_BUDGET_MS = 100
+
+    DEFAULT_DATABASE_URL = 'postgresql:///warbler'
+
+    def __init__(self):
+        self.SQLALCHEMY_DATABASE_URI = os.environ.get(
+            'DATABASE_URL', self.DEFAULT_DATABASE_URL)
+        self.SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+        self.IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR')
+        self.COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+        self.COMPRESS_BROTLI_QUALITY = int(
+            os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+        # where trending counters are saved between restarts (None: don't)
+        self.TRENDING_SNAPSHOT_PATH = os.environ.get('TRENDING_SNAPSHOT_PATH')
+        # directory shared by pre-fork workers for aggregated /metrics
+        self.METRICS_DIR = os.environ.get('METRICS_DIR')
+        # if set, /metrics requires "Authorization: Bearer <token>"
+        self.METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+        # where request profiles are written (default: instance/profiles)
+        self.PROFILE_DIR = os.environ.get('PROFILE_DIR')
+        self.PROFILE_SAMPLE_RATE = float(
+            os.environ.get('PROFILE_SAMPLE_RATE', self.PROFILE_SAMPLE_RATE))
+        # default: instance/slow-queries.jsonl
+        self.SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG')
+        # default: instance/jinja-cache
+        self.TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+        # set once `flask partitions convert` has run
+        self.MESSAGES_PARTITIONED = bool(
+            os.environ.get('MESSAGES_PARTITIONED'))
+        # where archived partitions go (default: instance/archive)
+        self.MESSAGE_ARCHIVE_DIR = os.environ.get('MESSAGE_ARCHIVE_DIR')
+        # comma-separated database URLs to shard messages across (see
+        # sharding.py); empty keeps them in the main database
+        self.MESSAGE_SHARDS = [url for url in os.environ.get(
+            'MESSAGE_SHARDS', '').split(',') if url]
+        self.QUERY_CACHE_TTL = int(
+            os.environ.get('QUERY_CACHE_TTL', self.QUERY_CACHE_TTL))
+        # reverse proxies in front of the app whose X-Forwarded-For/-Proto
+        # headers are trusted (0: use the socket's address; see ratelimit.py)
+        self.TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar available."""
+
+    DEBUG_TOOLBAR = True
+    # the toolbar alone takes ~100ms to set up
+    STARTUP_BUDGET_MS = 500
+
+
+class ProductionConfig(Config):
+    """Serving real traffic: no dev-only extensions, real secret required."""
+
+    TEMPLATE_BYTECODE_CACHE = True
+    TEMPLATE_WARM = True
+    QUERY_CACHE_TTL = 30
+
+    def __init__(self):
+        super().__init__()
+        if 'SECRET_KEY' not in os.environ:
+            raise RuntimeError("SECRET_KEY must be set in production")
+
+
+class TestingConfig(Config):
+    """The test suite."""
+
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    LIKECOUNT_FLUSH_SECONDS = 0
+    VIEWERS_FLUSH_SECONDS = 0
+    AVAILABILITY_WARM = False
+    AUTOCOMPLETE_WARM = False
+    SLOW_QUERY_MS = None
+    # the minimum bcrypt allows; hashing at the default 12 rounds is most
+    # of the suite's run time
+    BCRYPT_LOG_ROUNDS = 4
+    DEFAULT_DATABASE_URL = 'postgresql:///warbler-test'
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+}
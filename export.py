@@ -0,0 +1,282 @@
+"""Streaming exports of Warbler account data.
+
+A user's profile, follows, likes and messages are read with server-side
+cursors (``yield_per``: psycopg2 fetches BATCH_SIZE rows at a time instead
+of the whole result), serialized as they arrive, and written out in chunks
+of about CHUNK_BYTES, so memory use doesn't grow with the account's size.
+
+Formats:
+
+- NDJSON: every record of every dataset, one JSON object per line with a
+  ``type`` ('user', 'follow', 'like' or 'message');
+- CSV: one dataset per file, with the columns of the matching
+  ``generator/*.csv`` (plus ``id`` for users and messages, so likes still
+  point at the right messages), so ``python seed.py DIRECTORY`` can load
+  an export made with ``flask export dir``.
+
+Messages come last and in id order, and `after`/`before` restrict them to
+an id range: a client whose download was cut off resumes with ``after`` set
+to the last message id it got. Either format can be gzipped as it's
+written (`gzip_chunks`), independently of the HTTP compression middleware.
+
+Served to users at /api/users/<id>/export; ``flask export`` is the operator
+equivalent.
+"""
+
+import csv
+import io
+import json
+import os
+import zlib
+
+import click
+from flask.cli import with_appcontext
+
+from models import db, User, Message, Follows, Likes
+import sharding
+
+# the column layouts of generator/create_csvs.py (USERS_CSV_HEADERS etc.)
+USER_COLUMNS = ['email', 'username', 'image_url', 'password', 'bio',
+                'header_image_url', 'location', 'id']
+MESSAGE_COLUMNS = ['text', 'timestamp', 'user_id', 'id']
+FOLLOW_COLUMNS = ['user_being_followed_id', 'user_following_id']
+LIKE_COLUMNS = ['user_id', 'message_id']
+
+DATASETS = {
+    'users': (User, USER_COLUMNS),
+    'follows': (Follows, FOLLOW_COLUMNS),
+    'likes': (Likes, LIKE_COLUMNS),
+    'messages': (Message, MESSAGE_COLUMNS),
+}
+# singular names for NDJSON records
+RECORD_TYPES = {'users': 'user', 'follows': 'follow', 'likes': 'like',
+                'messages': 'message'}
+
+BATCH_SIZE = 1000
+CHUNK_BYTES = 64 * 1024
+
+
+##############################################################################
+# Queries
+
+
+def _select(dataset, user_ids=None, after=None, before=None):
+    """Statement for `dataset`'s rows, limited to those of `user_ids`
+    (None: everyone's)."""
+
+    model, columns = DATASETS[dataset]
+    stmt = db.select(*(getattr(model, c) for c in columns))
+
+    if dataset == 'users':
+        if user_ids is not None:
+            stmt = stmt.where(User.id.in_(user_ids))
+        return stmt.order_by(User.id)
+
+    if dataset == 'follows':
+        if user_ids is not None:
+            stmt = stmt.where(db.or_(
+                Follows.user_following_id.in_(user_ids),
+                Follows.user_being_followed_id.in_(user_ids)))
+        return stmt.order_by(Follows.user_following_id,
+                             Follows.user_being_followed_id)
+
+    if dataset == 'likes':
+        if user_ids is not None:
+            stmt = stmt.where(Likes.user_id.in_(user_ids))
+        return stmt.order_by(Likes.user_id, Likes.message_id)
+
+    if user_ids is not None:
+        stmt = stmt.where(Message.user_id.in_(user_ids))
+    if after is not None:
+        stmt = stmt.where(Message.id > after)
+    if before is not None:
+        stmt = stmt.where(Message.id < before)
+    return stmt.order_by(Message.id)
+
+
+def rows(dataset, user_ids=None, after=None, before=None):
+    """Stream `dataset`'s rows as dicts, BATCH_SIZE at a time."""
+
+    if dataset == 'messages' and sharding.enabled():
+        for row in sharding.stream_rows(user_ids, after, before, BATCH_SIZE):
+            yield {column: getattr(row, column) for column in MESSAGE_COLUMNS}
+        return
+
+    stmt = _select(dataset, user_ids, after, before)
+    result = db.session.execute(stmt.execution_options(yield_per=BATCH_SIZE))
+    for row in result:
+        yield row._asdict()
+
+
+def user_rows(user_id, dataset, after=None, before=None, passwords=False):
+    """One user's rows of `dataset`: their profile, the follows they're in
+    either side of, their likes or their messages.
+
+    Password hashes are blanked unless `passwords`.
+    """
+
+    for row in rows(dataset, [user_id], after, before):
+        if dataset == 'users' and not passwords:
+            row['password'] = ''
+        yield row
+
+
+##############################################################################
+# Serialization
+
+
+def _chunked(pieces):
+    """Join `pieces` (strings) into byte chunks of about CHUNK_BYTES."""
+
+    buf, size = [], 0
+    for piece in pieces:
+        data = piece.encode()
+        buf.append(data)
+        size += len(data)
+        if size >= CHUNK_BYTES:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def ndjson_chunks(user_id, after=None, before=None, passwords=False):
+    """A user's whole export as NDJSON byte chunks.
+
+    When resuming (`after` set) only the remaining messages are sent; the
+    other datasets came before them.
+    """
+
+    datasets = ['messages'] if after is not None else list(DATASETS)
+
+    def lines():
+        for dataset in datasets:
+            kind = RECORD_TYPES[dataset]
+            for row in user_rows(user_id, dataset, after, before, passwords):
+                yield json.dumps(dict(type=kind, **row), default=str) + '\n'
+
+    return _chunked(lines())
+
+
+def csv_chunks(records, columns):
+    """`records` (dicts) as CSV byte chunks, header first."""
+
+    def lines():
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+
+    return _chunked(lines())
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of byte chunks as it goes."""
+
+    # wbits 16+MAX_WBITS: gzip container rather than raw zlib
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+
+def export_chunks(user_id, fmt, dataset='messages', after=None, before=None,
+                  passwords=False, gzip=False):
+    """A user's export in `fmt` ('ndjson', or 'csv' of one `dataset`)."""
+
+    if fmt == 'ndjson':
+        chunks = ndjson_chunks(user_id, after, before, passwords)
+    else:
+        chunks = csv_chunks(
+            user_rows(user_id, dataset, after, before, passwords),
+            DATASETS[dataset][1])
+    return gzip_chunks(chunks) if gzip else chunks
+
+
+##############################################################################
+# CLI
+
+
+def _write(chunks, output):
+    stream = click.get_binary_stream('stdout') if output == '-' \
+        else open(output, 'wb')
+    try:
+        for chunk in chunks:
+            stream.write(chunk)
+    finally:
+        if output != '-':
+            stream.close()
+
+
+@click.group('export')
+def export_cli():
+    """Export account data."""
+
+
+@export_cli.command('user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']),
+              default='ndjson')
+@click.option('--data', 'dataset', type=click.Choice(list(DATASETS)),
+              default='messages', help="Which dataset, for CSV.")
+@click.option('--after', type=int, help="Only messages after this id.")
+@click.option('--before', type=int, help="Only messages before this id.")
+@click.option('--gzip', is_flag=True)
+@click.option('--passwords/--no-passwords', default=False,
+              help="Include the password hash.")
+@click.option('-o', '--output', default='-', help="File (default stdout).")
+@with_appcontext
+def user_command(user_id, fmt, dataset, after, before, gzip, passwords,
+                 output):
+    """Stream one user's data."""
+
+    if db.session.get(User, user_id) is None:
+        raise click.ClickException(f"No user {user_id}.")
+
+    _write(export_chunks(user_id, fmt, dataset, after, before, passwords,
+                         gzip), output)
+
+
+@export_cli.command('dir')
+@click.argument('directory')
+@click.option('--user', 'user_ids', type=int, multiple=True,
+              help="Only these users (default everyone).")
+@with_appcontext
+def dir_command(directory, user_ids):
+    """Write users/messages/follows/likes CSVs that seed.py can load.
+
+    With --user, follows and likes that point outside those users (and
+    their messages) are left out, so the files load on their own.
+    """
+
+    user_ids = list(user_ids) or None
+    os.makedirs(directory, exist_ok=True)
+
+    message_ids = None
+    if user_ids is not None:
+        message_ids = {row['id'] for row in rows('messages', user_ids)}
+        members = set(user_ids)
+
+    def keep(dataset, row):
+        if user_ids is None:
+            return True
+        if dataset == 'follows':
+            return (row['user_following_id'] in members
+                    and row['user_being_followed_id'] in members)
+        if dataset == 'likes':
+            return row['message_id'] in message_ids
+        return True
+
+    for dataset, (_, columns) in DATASETS.items():
+        path = os.path.join(directory, f"{dataset}.csv")
+        records = (row for row in rows(dataset, user_ids)
+                   if keep(dataset, row))
+        _write(csv_chunks(records, columns), path)
+        click.echo(f"Wrote {path}")
@@ -0,0 +1,320 @@
+"""Resized avatar / header image thumbnails for Warbler.
+
+Users' `image_url` and `header_image_url` point at arbitrary full-size
+images, but pages render them at 48-200px. Templates pass those URLs through
+the `thumbnail` filter, which rewrites them to ``/images/<size>/<token>``
+where the token is the source URL signed with the app's secret key (so the
+endpoint can't be used as an open proxy).
+
+The first request for a thumbnail fetches the source once, writes WebP and
+JPEG variants named by the hash of the source bytes into IMAGE_CACHE_DIR,
+and records the mapping in a small index file; later requests are a plain
+file send. The token only names the source URL, whose content can change, so
+responses are cached for THUMBNAIL_MAX_AGE and then revalidated (by ETag),
+and an index entry older than IMAGE_REFRESH_SECONDS is refetched.
+
+Sources are fetched server-side, so only public addresses are allowed: the
+host must resolve to globally routable IPs, checked again for the address
+actually connected to (against DNS rebinding) and for every redirect.
+Loopback, private (RFC 1918), link-local (cloud metadata) and other reserved
+addresses are refused.
+
+Config:
+
+- IMAGE_CACHE_DIR: where thumbnails live (default: <instance>/thumbnails)
+- IMAGE_SOURCE_DIR: if set, remote sources are read from this directory
+  (by file name) instead of over HTTP; used by tests and offline dev
+- IMAGE_REFRESH_SECONDS: how long a fetched source is trusted (default: a
+  day)
+"""
+
+import ipaddress
+import os
+import socket
+import tempfile
+import time
+import warnings
+from hashlib import sha256
+from http.client import HTTPConnection, HTTPSConnection
+from io import BytesIO
+from urllib.parse import urlparse
+from urllib.request import (HTTPHandler, HTTPRedirectHandler, HTTPSHandler,
+                            ProxyHandler, Request, build_opener)
+
+from flask import current_app
+from itsdangerous import URLSafeSerializer
+from werkzeug.security import safe_join
+
+import metrics
+
+# box sizes we render at, allowing for 2x displays: timeline/nav avatars
+# (48px), user card avatars (70px), profile avatar (200px), user card
+# headers and the full-width profile hero
+THUMBNAIL_SIZES = (96, 160, 400, 640, 1280)
+
+# browsers revalidate after this; sources are refetched after REFRESH_SECONDS
+THUMBNAIL_MAX_AGE = 24 * 60 * 60
+REFRESH_SECONDS = 24 * 60 * 60
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+# a few compressed megabytes can still decode to gigapixels; refuse sources
+# bigger than this before decoding them
+MAX_SOURCE_PIXELS = 40_000_000
+FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 3
+
+FORMATS = {
+    'webp': ('image/webp', dict(format='WEBP', quality=80, method=4)),
+    'jpg': ('image/jpeg', dict(format='JPEG', quality=82, optimize=True,
+                               progressive=True)),
+}
+
+
+class ImageSourceError(Exception):
+    """The source image couldn't be fetched or decoded."""
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='thumbnail')
+
+
+def _cache_dir():
+    return current_app.config.get('IMAGE_CACHE_DIR') or os.path.join(
+        current_app.instance_path, 'thumbnails')
+
+
+def fit_size(size):
+    """Smallest supported thumbnail size that covers `size`."""
+
+    for supported in THUMBNAIL_SIZES:
+        if supported >= size:
+            return supported
+    return THUMBNAIL_SIZES[-1]
+
+
+def thumbnail_url(source_url, size=THUMBNAIL_SIZES[0]):
+    """Template filter: URL of a `size`-px thumbnail of `source_url`."""
+
+    if not source_url:
+        return source_url
+
+    token = _serializer().dumps(source_url)
+    return f"/images/{fit_size(size)}/{token}"
+
+
+def source_for_token(token):
+    """Source URL a thumbnail token was signed for (BadSignature if forged)."""
+
+    return _serializer().loads(token)
+
+
+##############################################################################
+# Fetching
+
+
+def _check_address(address):
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    if not ip.is_global or ip.is_multicast:
+        raise ImageSourceError(f"Refusing to fetch from {ip}")
+
+
+def _check_url(url):
+    """Refuse non-http(s) URLs and hosts that resolve to non-public IPs."""
+
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ImageSourceError(f"Unsupported image URL: {url}")
+
+    try:
+        infos = socket.getaddrinfo(parsed.hostname, parsed.port or (
+            443 if parsed.scheme == 'https' else 80), type=socket.SOCK_STREAM)
+    except (OSError, ValueError) as exc:
+        raise ImageSourceError(str(exc)) from exc
+    for info in infos:
+        _check_address(info[4][0])
+
+
+def _connect_public(address, *args, **kwargs):
+    # the address we actually reached, whatever DNS said a moment ago
+    sock = socket.create_connection(address, *args, **kwargs)
+    try:
+        _check_address(sock.getpeername()[0])
+    except ImageSourceError:
+        sock.close()
+        raise
+    return sock
+
+
+class _PublicHTTPConnection(HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPSConnection(HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPHandler(HTTPHandler):
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPConnection, req, **kwargs)
+
+
+class _PublicHTTPSHandler(HTTPSHandler):
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPSConnection, req, **kwargs)
+
+
+class _PublicRedirectHandler(HTTPRedirectHandler):
+    max_redirections = MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# no proxies (we check the address we connect to) and no ftp:// or file://
+_opener = build_opener(ProxyHandler({}), _PublicHTTPHandler,
+                       _PublicHTTPSHandler, _PublicRedirectHandler)
+
+
+def fetch_source(source_url):
+    """Bytes of the full-size source image."""
+
+    if source_url.startswith('/static/'):
+        path = safe_join(current_app.static_folder,
+                         source_url[len('/static/'):])
+        return _read_file(path)
+
+    parsed = urlparse(source_url)
+    if parsed.scheme not in ('http', 'https'):
+        raise ImageSourceError(f"Unsupported image URL: {source_url}")
+
+    source_dir = current_app.config.get('IMAGE_SOURCE_DIR')
+    if source_dir:
+        path = safe_join(source_dir, os.path.basename(parsed.path))
+        return _read_file(path)
+
+    _check_url(source_url)
+    try:
+        req = Request(source_url, headers={'User-Agent': 'Warbler thumbnailer'})
+        with _opener.open(req, timeout=FETCH_TIMEOUT) as resp:
+            data = resp.read(MAX_SOURCE_BYTES + 1)
+    except (OSError, ValueError) as exc:
+        raise ImageSourceError(str(exc)) from exc
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ImageSourceError(f"Image too large: {source_url}")
+    return data
+
+
+def _read_file(path):
+    if path is None or not os.path.isfile(path):
+        raise ImageSourceError(f"No such image: {path}")
+
+    with open(path, 'rb') as f:
+        return f.read(MAX_SOURCE_BYTES)
+
+
+##############################################################################
+# Rendering and caching
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def render_variants(data, size):
+    """Encode `data` as each of FORMATS, scaled to fit a `size` box."""
+
+    # imported here so workers only load Pillow once they build a thumbnail
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    # Pillow only warns up to twice its own MAX_IMAGE_PIXELS; make that an
+    # error too (filterwarnings replaces an identical filter, not adds one)
+    warnings.filterwarnings('error', category=Image.DecompressionBombWarning)
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+            if width * height > MAX_SOURCE_PIXELS:
+                raise ImageSourceError(
+                    f"Image too large: {width}x{height} pixels")
+            # let JPEG decode at reduced scale; much cheaper for big photos
+            img.draft('RGB', (size, size))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size), Image.LANCZOS)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info
+                                  else 'RGB')
+
+            variants = {}
+            for ext, (_, options) in FORMATS.items():
+                out = BytesIO()
+                frame = img.convert('RGB') if ext == 'jpg' else img
+                frame.save(out, **options)
+                variants[ext] = out.getvalue()
+            return variants
+
+    except (Image.DecompressionBombError,
+            Image.DecompressionBombWarning) as exc:
+        raise ImageSourceError(f"Image too large: {exc}") from exc
+    except (UnidentifiedImageError, OSError) as exc:
+        raise ImageSourceError(str(exc)) from exc
+
+
+def thumbnail_file(source_url, size, ext):
+    """Path to the cached `ext` thumbnail of `source_url`, building it once.
+
+    The source is fetched again once its index entry is older than
+    IMAGE_REFRESH_SECONDS; if that fails, the old thumbnail is kept.
+    """
+
+    cache_dir = _cache_dir()
+    index_dir = os.path.join(cache_dir, 'index')
+    index_path = os.path.join(
+        index_dir, f"{sha256(source_url.encode()).hexdigest()}-{size}")
+    refresh = current_app.config.get('IMAGE_REFRESH_SECONDS', REFRESH_SECONDS)
+
+    cached = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            name = f.read().strip()
+        path = os.path.join(cache_dir, f"{name}.{ext}")
+        if os.path.exists(path):
+            if time.time() - os.path.getmtime(index_path) < refresh:
+                metrics.cache_hit('thumbnail')
+                return path
+            cached = path
+
+    metrics.cache_miss('thumbnail')
+    try:
+        data = fetch_source(source_url)
+    except ImageSourceError:
+        if cached is None:
+            raise
+        # keep serving what we have; try again after another interval
+        os.utime(index_path)
+        return cached
+    name = f"{sha256(data).hexdigest()[:20]}-{size}"
+
+    os.makedirs(index_dir, exist_ok=True)
+    for variant_ext, encoded in render_variants(data, size).items():
+        _write_atomic(os.path.join(cache_dir, f"{name}.{variant_ext}"),
+                      encoded)
+    _write_atomic(index_path, name.encode())
+
+    return os.path.join(cache_dir, f"{name}.{ext}")
+
+
+def preferred_format(accept):
+    """'webp' if the Accept header explicitly lists it, else 'jpg'."""
+
+    return 'webp' if 'image/webp' in accept else 'jpg'
@@ -0,0 +1,121 @@
+"""Compiled-template caching for Warbler.
+
+Jinja compiles a template (parse, generate Python source, compile it) the
+first time each process renders it, and inheritance means one page can
+compile several (home.html pulls in base.html and messages/_card.html). So
+the first requests after a deploy are slow, once per worker.
+
+With TEMPLATE_BYTECODE_CACHE on (as in the production profile), the app
+uses a Jinja FileSystemBytecodeCache in TEMPLATE_CACHE_DIR (default
+instance/jinja-cache): compiled code is written once and loaded with marshal by every worker,
+skipping the parse and compile. Entries are keyed by template name and
+checked against the source's checksum, so edited templates are recompiled
+rather than served stale.
+
+- ``flask templates compile`` fills the cache ahead of time (e.g. in the
+  deploy step) and prints how long each template took to compile;
+- with TEMPLATE_WARM on, `create_app` loads every template into the
+  environment's in-memory cache at boot, from the bytecode cache, so no
+  request pays for it.
+
+Per-template render times are reported by /metrics
+(warbler_template_render_seconds); load times at boot go to
+warbler_template_load_seconds.
+"""
+
+import os
+import shutil
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+import metrics
+
+template_load = metrics.registry.register(metrics.Histogram(
+    'warbler_template_load_seconds',
+    "Time to load (compile, or read from the bytecode cache) a template.",
+    ('template',), buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1)))
+
+
+def cache_dir(app):
+    return app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(
+        app.instance_path, 'jinja-cache')
+
+
+def use_cache(app):
+    """Give `app`'s Jinja environment the shared bytecode cache."""
+
+    directory = cache_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    return directory
+
+
+def init_app(app):
+    """Use the bytecode cache (TEMPLATE_BYTECODE_CACHE) and load every
+    template at boot (TEMPLATE_WARM), as configured."""
+
+    if app.config.get('TEMPLATE_BYTECODE_CACHE'):
+        use_cache(app)
+    if app.config.get('TEMPLATE_WARM'):
+        warm(app)
+
+
+def app_templates(env):
+    """Names of the templates under templates/."""
+
+    return [name for name in env.list_templates() if name.endswith('.html')]
+
+
+def load_all(app):
+    """Load every template into `app`'s environment; {name: seconds}."""
+
+    env = app.jinja_env
+    timings = {}
+    for name in app_templates(env):
+        started = time.perf_counter()
+        env.get_template(name)
+        timings[name] = time.perf_counter() - started
+        template_load.observe(timings[name], name)
+    return timings
+
+
+def warm(app):
+    """Load all templates at boot, logging how long it took."""
+
+    timings = load_all(app)
+    app.logger.info("Warmed %d templates in %.1fms", len(timings),
+                    sum(timings.values()) * 1000)
+    return timings
+
+
+##############################################################################
+# CLI
+
+
+@click.group('templates')
+def templates_cli():
+    """Precompile Jinja templates."""
+
+
+@templates_cli.command('compile')
+@click.option('--clear', is_flag=True, help="Empty the cache first.")
+@with_appcontext
+def compile_command(clear):
+    """Compile every template into the bytecode cache directory."""
+
+    app = current_app._get_current_object()
+    if clear:
+        shutil.rmtree(cache_dir(app), ignore_errors=True)
+    directory = use_cache(app)
+    # start from an empty in-memory cache so everything is really compiled
+    app.jinja_env.cache.clear()
+
+    timings = load_all(app)
+    for name, seconds in sorted(timings.items(), key=lambda t: -t[1]):
+        click.echo(f"  {seconds * 1000:7.2f}ms  {name}")
+    click.echo(f"Compiled {len(timings)} templates into {directory} "
+               f"in {sum(timings.values()) * 1000:.1f}ms")
@@ -0,0 +1,240 @@
+"""Per-message like counts for Warbler.
+
+`Message.like_count` is a denormalized count of the message's rows in
+`likes`, so cards can show it without a COUNT(*) per message. Rather than an
+UPDATE per like, the like/unlike view calls `record(message_id, +1/-1)`,
+which only adjusts an in-memory delta. Deltas for the same message coalesce,
+and every LIKECOUNT_FLUSH_SECONDS a background thread writes them out
+together as one batched ``UPDATE messages SET like_count = like_count +
+:delta`` (and once more at exit).
+
+Until then, cards add the pending delta to the stored count (see
+`displayed`), so this process reads its own writes. Other processes see a
+like once it is flushed.
+
+A crash loses unflushed deltas, and likes removed by cascades (deleting a
+user) never pass through `record`. `likes` itself stays the source of
+truth. `reconcile()` recomputes like_count from it for every message that has
+drifted, and is safe to run at any time. It scans every message, so run it
+once per deployment (``flask likes reconcile``, e.g. after a restart or from
+cron) rather than in every worker; setting LIKECOUNT_RECONCILE_SECONDS opts a
+process into running it in the background at startup and then at that
+interval. A flush racing a reconcile can still be counted twice, which the
+next reconcile fixes.
+"""
+
+import atexit
+import threading
+import time
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, Message, Likes
+import sharding
+
+FLUSH_SECONDS = 5
+
+
+class LikeCounter:
+    """Coalesces like_count increments in memory between flushes."""
+
+    def __init__(self):
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self.flushes = 0
+
+    def record(self, message_id, delta):
+        with self._lock:
+            self._pending[message_id] += delta
+            if not self._pending[message_id]:
+                del self._pending[message_id]
+
+    def pending(self, message_id):
+        """Unflushed delta for `message_id`."""
+
+        return self._pending.get(message_id, 0)
+
+    def take(self):
+        """Remove and return the pending deltas, as {message id: delta}."""
+
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        return pending
+
+    def restore(self, pending):
+        """Put back deltas from a failed flush."""
+
+        with self._lock:
+            for message_id, delta in pending.items():
+                self._pending[message_id] += delta
+
+    def flush(self):
+        """Write pending deltas in one batched UPDATE; returns rows sent."""
+
+        pending = self.take()
+        if not pending:
+            return 0
+
+        table = Message.__table__
+        stmt = (table.update()
+                .where(table.c.id == db.bindparam('message_id'))
+                .values(like_count=table.c.like_count + db.bindparam('delta')))
+        params = [{'message_id': message_id, 'delta': delta}
+                  for message_id, delta in sorted(pending.items())]
+
+        try:
+            if sharding.enabled():
+                sharding.add_like_counts(pending)
+            else:
+                # own transaction, so we never commit a request's session
+                with db.engine.begin() as conn:
+                    conn.execute(stmt, params)
+        except Exception:
+            self.restore(pending)
+            raise
+
+        self.flushes += 1
+        return len(params)
+
+
+counter = LikeCounter()
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_with(app):
+    with app.app_context():
+        try:
+            counter.flush()
+        except Exception:
+            app.logger.exception("Flushing like counts failed")
+
+
+def _start_flusher(app, interval):
+    """Flush every `interval` seconds from a daemon thread, and at exit.
+
+    Only the first call starts one.
+    """
+
+    global _flusher
+
+    def run():
+        while True:
+            time.sleep(interval)
+            _flush_with(app)
+
+    with _flusher_lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=run, name='likecounts-flusher',
+                                    daemon=True)
+        _flusher.start()
+        atexit.register(_flush_with, app)
+
+
+# set to stop the background reconcile
+_stop_reconciling = threading.Event()
+
+
+def _reconcile_with(app):
+    """`reconcile()`, logging rather than raising failures; returns the
+    number of messages corrected (None on failure)."""
+
+    with app.app_context():
+        try:
+            return reconcile()
+        except Exception:
+            app.logger.exception("Reconciling like counts failed")
+
+
+def init_app(app):
+    """Reconcile now and every LIKECOUNT_RECONCILE_SECONDS, in the background.
+
+    Returns the thread doing it (or None, if the setting is unset, as it is
+    by default). Setting `_stop_reconciling` ends it.
+    """
+
+    interval = app.config.get('LIKECOUNT_RECONCILE_SECONDS')
+    if not interval:
+        return None
+
+    def run():
+        while True:
+            _reconcile_with(app)
+            if _stop_reconciling.wait(interval):
+                return
+
+    thread = threading.Thread(target=run, name='likecounts-reconcile',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def record(message_id, delta):
+    """Count a like (+1) or unlike (-1) of `message_id`.
+
+    With LIKECOUNT_FLUSH_SECONDS = 0 this writes through immediately.
+    """
+
+    interval = current_app.config.get('LIKECOUNT_FLUSH_SECONDS', FLUSH_SECONDS)
+    counter.record(message_id, delta)
+
+    if not interval:
+        counter.flush()
+    elif _flusher is None:
+        _start_flusher(current_app._get_current_object(), interval)
+
+
+def displayed(message_id, stored):
+    """Like count to show: the stored column plus our unflushed delta."""
+
+    return stored + counter.pending(message_id)
+
+
+def flush():
+    return counter.flush()
+
+
+def reconcile():
+    """Reset like_count from `likes` wherever they disagree.
+
+    Returns the number of messages corrected.
+    """
+
+    # anything we were about to add is already reflected in `likes`
+    counter.take()
+
+    if sharding.enabled():
+        return sharding.reconcile_like_counts()
+
+    actual = (db.select(db.func.count())
+              .where(Likes.message_id == Message.id)
+              .scalar_subquery())
+    result = db.session.execute(
+        db.update(Message)
+        .where(Message.like_count != actual)
+        .values(like_count=actual)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount
+
+
+##############################################################################
+# CLI
+
+
+@click.group('likes')
+def likes_cli():
+    """Maintain message like counts."""
+
+
+@likes_cli.command('reconcile')
+@with_appcontext
+def reconcile_command():
+    """Recompute like_count from the likes table."""
+
+    click.echo(f"Corrected {reconcile()} message(s).")
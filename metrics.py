@@ -0,0 +1,475 @@
+"""Runtime metrics for Warbler, served at /metrics in the Prometheus format.
+
+Collected with a few cheap hooks:
+
+- before/after_request time each request and count it by route, method and
+  status;
+- SQLAlchemy cursor events count and time every query, overall and per
+  route;
+- Flask's template signals time each render_template() call;
+- the thumbnail cache, availability filters, trending rankings and
+  autocomplete index report hits and misses via `cache_requests`;
+- rate limit rejections are counted as they happen, and connection pool
+  usage is read at scrape time.
+
+Recording is a dict update and a bisect under a per-metric lock, so the
+per-request cost is a few microseconds.
+
+Each process keeps its own counts. Under a pre-fork server (gunicorn -w N)
+set METRICS_DIR to a directory shared by the workers: every process then
+writes its state there (every METRICS_FLUSH_SECONDS, and whenever it serves
+a scrape), and /metrics merges all of the files. Counters and histograms
+from exited workers still count, so totals never go backwards; gauges are
+only taken from processes that are still alive. A scrape folds the files of
+exited workers into metrics-retired.json and removes them. Each file records
+its process's start time as well as its pid, so a new process that reuses
+an old one's pid isn't mistaken for it.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import (g, request, has_request_context, before_render_template,
+                   template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+# seconds; Prometheus' default buckets
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5,
+                   5.0, 7.5, 10.0)
+QUERY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+FLUSH_SECONDS = 10
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def state(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value
+                    in self._values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """A monotonically increasing count, per label values."""
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value read at collection time from `collect`, a function returning
+    {label values tuple: value}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def state(self):
+        values = self.collect() if self.collect else {}
+        return [[list(labels), value] for labels, value in values.items()]
+
+
+class Histogram(_Metric):
+    """Counts of observations per bucket, plus their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one per bucket, then +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+
+class Registry:
+    """The metrics of one process."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def state(self):
+        """JSON-able snapshot of every metric's current values."""
+
+        return {name: {'kind': metric.kind, 'help': metric.help,
+                       'labelnames': metric.labelnames,
+                       'buckets': getattr(metric, 'buckets', None),
+                       'values': metric.state()}
+                for name, metric in self.metrics.items()}
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'warbler_http_requests_total', "HTTP requests handled.",
+    ('endpoint', 'method', 'status')))
+request_duration = registry.register(Histogram(
+    'warbler_http_request_duration_seconds', "Time to handle a request.",
+    ('endpoint',)))
+db_queries = registry.register(Counter(
+    'warbler_db_queries_total', "SQL statements executed.", ('endpoint',)))
+db_query_seconds = registry.register(Counter(
+    'warbler_db_query_seconds_total', "Time spent executing SQL.",
+    ('endpoint',)))
+db_query_duration = registry.register(Histogram(
+    'warbler_db_query_duration_seconds', "Time to execute one statement.",
+    buckets=QUERY_BUCKETS))
+template_duration = registry.register(Histogram(
+    'warbler_template_render_seconds', "Time to render a template.",
+    ('template',)))
+cache_requests = registry.register(Counter(
+    'warbler_cache_requests_total', "Cache lookups by cache and result.",
+    ('cache', 'result')))
+ratelimit_rejections = registry.register(Counter(
+    'warbler_ratelimit_rejections_total', "Requests rejected by rate limits.",
+    ('policy',)))
+
+
+def cache_hit(cache):
+    cache_requests.inc(cache, 'hit')
+
+
+def cache_miss(cache):
+    cache_requests.inc(cache, 'miss')
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'none'
+
+
+##############################################################################
+# Collection hooks
+
+
+def _start_request():
+    g._metrics_start = time.perf_counter()
+
+
+def _finish_request(response):
+    started = g.pop('_metrics_start', None)
+    if started is not None:
+        endpoint = _endpoint()
+        request_duration.observe(time.perf_counter() - started, endpoint)
+        requests_total.inc(endpoint, request.method,
+                           str(response.status_code))
+    _maybe_flush()
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['metrics_started'].pop()
+    elapsed = time.perf_counter() - started
+    endpoint = _endpoint()
+    db_queries.inc(endpoint)
+    db_query_seconds.inc(endpoint, amount=elapsed)
+    db_query_duration.observe(elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_query(context):
+    started = context.connection.info.get('metrics_started') \
+        if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _start_render(app, template, context, **extra):
+    g.setdefault('_metrics_renders', []).append(time.perf_counter())
+
+
+def _finish_render(app, template, context, **extra):
+    renders = g.get('_metrics_renders')
+    if renders:
+        template_duration.observe(time.perf_counter() - renders.pop(),
+                                  template.name or 'string')
+
+
+def _pool_usage():
+    pool = db.engine.pool
+    # not every pool class (e.g. SQLite's) has every statistic
+    return {(name,): getattr(pool, name)()
+            for name in ('size', 'checkedin', 'checkedout', 'overflow')
+            if hasattr(pool, name)}
+
+
+registry.register(Gauge(
+    'warbler_db_pool_connections', "Connection pool usage, by state.",
+    ('state',), collect=_pool_usage))
+
+
+def init_app(app):
+    """Install the request and template hooks on `app`."""
+
+    global _metrics_dir, _flush_seconds
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_finish_render, app)
+
+    _metrics_dir = app.config.get('METRICS_DIR')
+    _flush_seconds = app.config.get('METRICS_FLUSH_SECONDS', FLUSH_SECONDS)
+
+
+##############################################################################
+# Multi-process aggregation
+
+_metrics_dir = None
+_flush_seconds = FLUSH_SECONDS
+_last_flush = 0.0
+# the process that last flushed (a forked worker starts with its parent's)
+_flushed_pid = None
+
+_RETIRED = 'metrics-retired.json'
+
+
+def _state_path(directory, pid):
+    return os.path.join(directory, f"metrics-{pid}.json")
+
+
+@contextmanager
+def _locked(directory):
+    """Exclusive lock on the metrics directory, for retiring files."""
+
+    with open(os.path.join(directory, 'metrics.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps(data))
+    os.replace(tmp, path)
+
+
+def flush(directory=None):
+    """Write this process's state into the shared metrics directory."""
+
+    global _last_flush, _flushed_pid
+
+    directory = directory or _metrics_dir
+    _last_flush = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    pid = os.getpid()
+    path = _state_path(directory, pid)
+    data = {'pid': pid, 'started': _started(pid),
+            'metrics': registry.state()}
+
+    if _flushed_pid == pid:
+        _write(path, data)
+        return
+
+    # first flush: a file already there is from an exited process that
+    # had our pid, and its counts must not be overwritten
+    with _locked(directory):
+        previous = _read(path)
+        if previous is not None:
+            _retire(directory, [(path, previous)])
+        _write(path, data)
+    _flushed_pid = pid
+
+
+def _maybe_flush():
+    if _metrics_dir and time.monotonic() - _last_flush >= _flush_seconds:
+        flush()
+
+
+def _started(pid):
+    """When process `pid` started, in clock ticks since boot (None if this
+    isn't known, e.g. without /proc)."""
+
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # fields after the command name, which may contain spaces;
+            # starttime is the 22nd field
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _alive(pid, started=None):
+    """Is `pid` running, and (if `started` is given) the same process?"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return started is None or _started(pid) in (None, started)
+
+
+def merge(states):
+    """Combine per-process states (as returned by `Registry.state`)."""
+
+    merged = {}
+    for pid, state in states:
+        for name, metric in state.items():
+            # pid None: retired processes' counts
+            if metric['kind'] == 'gauge' and (pid is None or not _alive(pid)):
+                continue
+
+            into = merged.setdefault(name, dict(metric, values={}))
+            for labels, value in metric['values']:
+                key = tuple(labels)
+                if metric['kind'] == 'histogram':
+                    totals = into['values'].setdefault(key, [0] * len(value))
+                    into['values'][key] = [a + b for a, b
+                                           in zip(totals, value)]
+                else:
+                    into['values'][key] = into['values'].get(key, 0) + value
+    return merged
+
+
+def _as_state(merged):
+    """`merge`'s result in `Registry.state`'s form, to write back out."""
+
+    return {name: dict(metric, values=[[list(labels), value] for labels, value
+                                       in metric['values'].items()])
+            for name, metric in merged.items()}
+
+
+def _retire(directory, dead):
+    """Fold dead processes' (path, data) into the retired file, and remove
+    their files. Call with the directory locked."""
+
+    path = os.path.join(directory, _RETIRED)
+    retired = _read(path)
+    states = [(None, retired['metrics'])] if retired else []
+    states += [(None, data['metrics']) for _, data in dead]
+    _write(path, {'pid': None, 'metrics': _as_state(merge(states))})
+    for dead_path, _ in dead:
+        os.remove(dead_path)
+
+
+def collect():
+    """Merged metrics for the whole server (or just this process)."""
+
+    if not _metrics_dir:
+        return merge([(os.getpid(), registry.state())])
+
+    flush()
+    states, dead = [], []
+    with _locked(_metrics_dir):
+        for name in os.listdir(_metrics_dir):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            path = os.path.join(_metrics_dir, name)
+            data = _read(path)
+            if data is None:
+                continue
+            if data['pid'] is None or _alive(data['pid'], data.get('started')):
+                states.append((data['pid'], data['metrics']))
+            else:
+                states.append((None, data['metrics']))
+                dead.append((path, data))
+        if dead:
+            _retire(_metrics_dir, dead)
+    return merge(states)
+
+
+##############################################################################
+# Exposition
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics=None):
+    """Text exposition format (version 0.0.4) of `metrics`."""
+
+    metrics = collect() if metrics is None else metrics
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        names = metric['labelnames']
+
+        for labels, value in sorted(metric['values'].items()):
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_format_labels(names, labels)} "
+                             f"{_format_value(value)}")
+                continue
+
+            cumulative = 0
+            bounds = [str(b) for b in metric['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket"
+                             f"{_format_labels(names, labels, [('le', bound)])}"
+                             f" {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(names, labels)} "
+                         f"{_format_value(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(names, labels)} "
+                         f"{cumulative}")
+
+    return '\n'.join(lines) + '\n'
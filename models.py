@@ -4,6 +4,7 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.orm import backref
 
 bcrypt = Bcrypt()
@@ -15,6 +16,15 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # listings page through a user's followers/following newest-first, so
+    # each page is a range scan over one of these
+    __table_args__ = (
+        db.Index('ix_follows_followed_created',
+                 'user_being_followed_id', 'created_at'),
+        db.Index('ix_follows_following_created',
+                 'user_following_id', 'created_at'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -27,12 +37,23 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
+    # a user likes a message at most once (many users can like it)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -46,7 +67,6 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
 
@@ -55,6 +75,10 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # ids are never reused, as with a Postgres sequence (caches, realtime
+    # channels and cursors key on them)
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -171,11 +195,32 @@ class User(db.Model):
         return False
 
 
+# usernames and emails are unique regardless of case; these also back the
+# availability probes in availability.py
+db.Index('ix_users_username_lower', db.func.lower(User.username), unique=True)
+db.Index('ix_users_email_lower', db.func.lower(User.email), unique=True)
+
+# lower(username) LIKE 'prefix%' for autocomplete; the unique index above uses
+# the database collation, which Postgres can't use for LIKE
+db.Index('ix_users_username_lower_pattern',
+         db.func.lower(User.username).label('username_lower'),
+         postgresql_ops={'username_lower': 'text_pattern_ops'})
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # "what's new from these authors since message N" polls are a range
+    # scan per author over the first; newest-first feeds over the second
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        # message ids only grow: "since message N" cursors rely on it
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -189,7 +234,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -198,9 +243,90 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # denormalized count of this message's likes; see likecounts.py
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
 
+class MessageId(db.Model):
+    """Allocator of message ids when messages are sharded (see sharding.py).
+
+    Rows are deleted as soon as they're inserted; only the sequence is used.
+    """
+
+    __tablename__ = 'message_ids'
+
+    # never reuse a value, even after the row holding it is deleted
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+
+class MessageTag(db.Model):
+    """Inverted index entry: a #hashtag used in a message.
+
+    Keyed (tag, message_id) so a tag's messages, newest first, are one
+    range scan of the primary key.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """Inverted index entry: a user @mentioned in a message."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+
+class MessageViewers(db.Model):
+    """A message's unique viewers, as a HyperLogLog sketch (see viewers.py)."""
+
+    __tablename__ = 'message_viewers'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    sketch = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -209,3 +335,35 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                # sharded messages have no rows here for likes etc. to
+                # reference (on Postgres, `flask shards init` drops the keys)
+                configure_sqlite(engine,
+                                 foreign_keys=not app.config.get(
+                                     'MESSAGE_SHARDS'))
+
+
+def configure_sqlite(engine, foreign_keys=True):
+    """Make a SQLite engine behave like the Postgres one the app expects.
+
+    - enforce foreign keys (and so their ON DELETE CASCADEs), which SQLite
+      only does when asked, per connection;
+    - use the write-ahead log, so readers don't block the writer (the like
+      count flusher and other background threads write from their own
+      connections), syncing to disk at checkpoints rather than every
+      commit (the usual pairing: a power loss can drop the last commits,
+      but never corrupts the database).
+    """
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = "
+                       + ("ON" if foreign_keys else "OFF"))
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
@@ -0,0 +1,375 @@
+"""Monthly range partitioning of `messages` (PostgreSQL only).
+
+Feeds only ever look at recent warbles, but an unpartitioned `messages`
+makes every index scan, index update and vacuum pay for all of history.
+``flask partitions convert`` turns it into a table partitioned by month on
+`timestamp`:
+
+- each month is its own table (``messages_y2024m05``), plus
+  ``messages_default`` for anything outside the months that exist;
+- the primary key becomes (id, timestamp), since Postgres requires the
+  partition key in unique constraints. That also means `likes`,
+  `message_tags` and `mentions` can no longer have foreign keys to
+  messages.id, so their ON DELETE CASCADE is replaced by a trigger on
+  `messages`.
+
+With MESSAGES_PARTITIONED on, the app then:
+
+- keeps PARTITIONS_AHEAD months of partitions ahead of the current one,
+  checking every PARTITION_CHECK_SECONDS from a background thread
+  (``flask partitions ensure`` does the same from cron);
+- pages timelines and profiles newest-first within a time window first
+  (see `readmodels.recent_first`), so the planner only touches the last
+  month or two of partitions for any active user.
+
+``flask partitions archive --before 2020-01`` detaches each month before
+that, writes it to MESSAGE_ARCHIVE_DIR as gzipped CSV (the cold store) and
+drops it; ``flask partitions restore FILE`` brings one back. Likes and tag
+or mention index rows of archived messages are kept, so a restore is
+complete; feeds join through `messages`, so they just stop showing.
+"""
+
+import gzip
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, Message
+
+PARENT = 'messages'
+DEFAULT_PARTITION = 'messages_default'
+AHEAD = 3
+CHECK_SECONDS = 3600
+
+# tables whose message_id rows go with a deleted message
+DEPENDENT_TABLES = ('likes', 'message_tags', 'mentions', 'message_viewers')
+
+_NAME_RE = re.compile(r'^messages_y(\d{4})m(\d{2})$')
+
+
+##############################################################################
+# Months and names
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def months(first, last):
+    """Starts of each month from `first` through `last`."""
+
+    month, last = month_start(first), month_start(last)
+    while month <= last:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_name(month):
+    return f"{PARENT}_y{month.year:04d}m{month.month:02d}"
+
+
+def partition_month(name):
+    """The month a partition holds, or None for other tables."""
+
+    match = _NAME_RE.match(name)
+    return date(int(match[1]), int(match[2]), 1) if match else None
+
+
+def create_partition_sql(month):
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF {PARENT} FOR VALUES "
+            f"FROM ('{month.isoformat()}') "
+            f"TO ('{add_months(month, 1).isoformat()}')")
+
+
+##############################################################################
+# Inspection
+
+
+def _require_postgres(conn):
+    if conn.dialect.name != 'postgresql':
+        raise click.ClickException(
+            "Partitioning needs PostgreSQL (this is "
+            f"{conn.dialect.name}).")
+
+
+def is_partitioned(conn):
+    return bool(conn.exec_driver_sql(
+        "SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = %(table)s::regclass", {'table': PARENT}).first())
+
+
+def existing_partitions(conn):
+    """{month: name} of the attached monthly partitions."""
+
+    names = conn.exec_driver_sql(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = %(table)s::regclass", {'table': PARENT}).scalars()
+    return {partition_month(name): name for name in names
+            if partition_month(name)}
+
+
+##############################################################################
+# Operations
+
+
+def ensure(conn, ahead=AHEAD, today=None):
+    """Create any missing partitions from this month to `ahead` months on.
+
+    Returns the names created.
+    """
+
+    this_month = month_start(today or datetime.utcnow().date())
+    have = existing_partitions(conn)
+    created = []
+    for month in months(this_month, add_months(this_month, ahead)):
+        if month not in have:
+            conn.exec_driver_sql(create_partition_sql(month))
+            created.append(partition_name(month))
+    return created
+
+
+def drop_dependent_foreign_keys(conn):
+    """Drop the foreign keys from DEPENDENT_TABLES to messages.id."""
+
+    for table in DEPENDENT_TABLES:
+        for fk in conn.exec_driver_sql(
+                "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+                "AND conrelid = %(table)s::regclass "
+                "AND confrelid = 'messages'::regclass",
+                {'table': table}).scalars().all():
+            conn.exec_driver_sql(f'ALTER TABLE {table} DROP CONSTRAINT "{fk}"')
+
+
+_CASCADE_FUNCTION = """
+CREATE OR REPLACE FUNCTION messages_delete_dependents() RETURNS trigger AS $$
+BEGIN
+    {deletes}
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def convert(conn, ahead=AHEAD):
+    """Rebuild `messages` as a partitioned table, keeping its rows.
+
+    Run inside one transaction; it holds an exclusive lock on `messages`
+    while rows are copied.
+    """
+
+    if is_partitioned(conn):
+        raise click.ClickException("messages is already partitioned.")
+
+    drop_dependent_foreign_keys(conn)
+
+    conn.exec_driver_sql(f"ALTER TABLE {PARENT} RENAME TO {PARENT}_old")
+    conn.exec_driver_sql(f"ALTER INDEX {PARENT}_pkey "
+                         f"RENAME TO {PARENT}_old_pkey")
+    for index in Message.__table__.indexes:
+        conn.exec_driver_sql(f'ALTER INDEX "{index.name}" '
+                             f'RENAME TO "{index.name}_old"')
+
+    conn.exec_driver_sql(
+        f"CREATE TABLE {PARENT} (LIKE {PARENT}_old INCLUDING DEFAULTS "
+        f"INCLUDING CONSTRAINTS, PRIMARY KEY (id, \"timestamp\"), "
+        f"FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE) "
+        f"PARTITION BY RANGE (\"timestamp\")")
+    # the id sequence belongs to the old table; keep it when that's dropped
+    conn.exec_driver_sql(f"ALTER SEQUENCE {PARENT}_id_seq "
+                         f"OWNED BY {PARENT}.id")
+    for index in Message.__table__.indexes:
+        index.create(conn)
+
+    oldest = conn.exec_driver_sql(
+        f'SELECT min("timestamp") FROM {PARENT}_old').scalar()
+    today = datetime.utcnow().date()
+    for month in months(oldest or today, today):
+        conn.exec_driver_sql(create_partition_sql(month))
+    ensure(conn, ahead, today)
+    conn.exec_driver_sql(f"CREATE TABLE {DEFAULT_PARTITION} "
+                         f"PARTITION OF {PARENT} DEFAULT")
+
+    conn.exec_driver_sql(f"INSERT INTO {PARENT} SELECT * FROM {PARENT}_old")
+    conn.exec_driver_sql(f"DROP TABLE {PARENT}_old")
+
+    deletes = '\n    '.join(f"DELETE FROM {table} WHERE message_id = OLD.id;"
+                            for table in DEPENDENT_TABLES)
+    conn.exec_driver_sql(_CASCADE_FUNCTION.format(deletes=deletes))
+    conn.exec_driver_sql(
+        f"CREATE TRIGGER messages_delete_dependents AFTER DELETE ON {PARENT} "
+        f"FOR EACH ROW EXECUTE FUNCTION messages_delete_dependents()")
+
+
+def archive_path(directory, month):
+    return os.path.join(directory, f"{partition_name(month)}.csv.gz")
+
+
+def archive(conn, month, directory, drop=True):
+    """Detach `month`'s partition and write it to `directory`.
+
+    Returns the archive's path.
+    """
+
+    name = partition_name(month)
+    conn.exec_driver_sql(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(directory, month)
+    tmp = path + '.tmp'
+    cursor = conn.connection.cursor()
+    with gzip.open(tmp, 'wt') as f:
+        cursor.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", f)
+    os.replace(tmp, path)
+
+    if drop:
+        conn.exec_driver_sql(f"DROP TABLE {name}")
+    return path
+
+
+def restore(conn, path):
+    """Re-create an archived month's partition and load it from `path`."""
+
+    month = partition_month(os.path.basename(path).split('.')[0])
+    if month is None:
+        raise click.ClickException(f"{path} isn't a partition archive.")
+
+    conn.exec_driver_sql(create_partition_sql(month))
+    cursor = conn.connection.cursor()
+    with gzip.open(path, 'rt') as f:
+        cursor.copy_expert(f"COPY {partition_name(month)} FROM STDIN "
+                           f"WITH CSV HEADER", f)
+    return partition_name(month)
+
+
+##############################################################################
+# Keeping partitions ahead
+
+_maintainer = None
+
+
+def _ensure_with(app):
+    with app.app_context():
+        try:
+            with db.engine.begin() as conn:
+                created = ensure(conn, app.config.get('PARTITIONS_AHEAD',
+                                                      AHEAD))
+            if created:
+                app.logger.info("Created partitions %s", ', '.join(created))
+        except Exception:
+            app.logger.exception("Creating message partitions failed")
+
+
+def _start_maintainer(app, interval):
+    """Ensure partitions now and every `interval` seconds."""
+
+    global _maintainer
+
+    def run():
+        while True:
+            _ensure_with(app)
+            time.sleep(interval)
+
+    _maintainer = threading.Thread(target=run, name='partitions-maintainer',
+                                   daemon=True)
+    _maintainer.start()
+
+
+def init_app(app):
+    """Keep future partitions created, if MESSAGES_PARTITIONED is on."""
+
+    interval = app.config.get('PARTITION_CHECK_SECONDS', CHECK_SECONDS)
+    if app.config.get('MESSAGES_PARTITIONED') and interval \
+            and _maintainer is None:
+        _start_maintainer(app, interval)
+
+
+##############################################################################
+# CLI
+
+
+@click.group('partitions')
+def partitions_cli():
+    """Manage monthly partitions of messages."""
+
+
+@partitions_cli.command('convert')
+@with_appcontext
+def convert_command():
+    """Partition the messages table by month (one-off)."""
+
+    with db.engine.begin() as conn:
+        _require_postgres(conn)
+        convert(conn, current_app.config.get('PARTITIONS_AHEAD', AHEAD))
+        count = len(existing_partitions(conn))
+    click.echo(f"messages is now partitioned ({count} monthly partitions). "
+               f"Set MESSAGES_PARTITIONED=1.")
+
+
+@partitions_cli.command('ensure')
+@with_appcontext
+def ensure_command():
+    """Create partitions for the coming months."""
+
+    with db.engine.begin() as conn:
+        _require_postgres(conn)
+        created = ensure(conn, current_app.config.get('PARTITIONS_AHEAD',
+                                                      AHEAD))
+    click.echo(f"Created {', '.join(created)}." if created
+               else "Nothing to do.")
+
+
+def _parse_month(ctx, param, value):
+    try:
+        return datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise click.BadParameter("use YYYY-MM")
+
+
+@partitions_cli.command('archive')
+@click.option('--before', required=True, callback=_parse_month,
+              help="Archive months before this one (YYYY-MM).")
+@click.option('--keep', is_flag=True,
+              help="Only detach; don't drop the tables.")
+@with_appcontext
+def archive_command(before, keep):
+    """Move old months to the cold store (MESSAGE_ARCHIVE_DIR)."""
+
+    directory = current_app.config.get('MESSAGE_ARCHIVE_DIR') or \
+        os.path.join(current_app.instance_path, 'archive')
+
+    with db.engine.connect() as conn:
+        _require_postgres(conn)
+        old = sorted(month for month in existing_partitions(conn)
+                     if month < before)
+    # a transaction per month, so a failure keeps what's been done
+    for month in old:
+        with db.engine.begin() as conn:
+            path = archive(conn, month, directory, drop=not keep)
+        click.echo(f"Archived {partition_name(month)} to {path}")
+    if not old:
+        click.echo("Nothing to archive.")
+
+
+@partitions_cli.command('restore')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def restore_command(path):
+    """Load an archived month back into messages."""
+
+    with db.engine.begin() as conn:
+        _require_postgres(conn)
+        name = restore(conn, path)
+    click.echo(f"Restored {name}.")
@@ -0,0 +1,262 @@
+"""On-demand sampling profiles of single requests.
+
+A request is profiled when it either carries a valid ``X-Warbler-Profile``
+header (a signed, expiring token from ``flask profile token``) or is picked
+at random with probability PROFILE_SAMPLE_RATE. Every other request pays
+only for the check.
+
+While a profiled request runs, a background thread samples its Python stack
+every PROFILE_INTERVAL_MS via sys._current_frames(), so SQL, ORM hydration,
+Jinja rendering and bcrypt show up in proportion to the time they take,
+without instrumenting any of them. When the request finishes, PROFILE_DIR
+gets three files named after the time, endpoint and process:
+
+- ``.collapsed``: one ``frame;frame;frame count`` line per distinct stack,
+  for flamegraph.pl / inferno / speedscope;
+- ``.speedscope.json``: the same samples in speedscope's file format;
+- ``.meta.json``: route, status, duration and a summary of the SQL run
+  (count, total time, slowest statements).
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HEADER = 'X-Warbler-Profile'
+TOKEN_MAX_AGE = 3600
+INTERVAL_MS = 5
+
+# slowest statements listed in a profile's query summary
+TOP_QUERIES = 5
+
+
+class Sampler:
+    """Samples one thread's call stack at a fixed interval."""
+
+    def __init__(self, thread_id, interval=INTERVAL_MS / 1000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='profiler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_stack(frame)] += 1
+
+
+def _stack(frame):
+    """Root-first tuple of (function, file, line) for `frame`."""
+
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, code.co_filename, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _frame_name(func, filename, line):
+    return f"{func} ({os.path.basename(filename)}:{line})"
+
+
+def collapsed(stacks):
+    """Brendan Gregg's collapsed-stack format."""
+
+    return ''.join(
+        ';'.join(_frame_name(*frame).replace(';', ':') for frame in stack)
+        + f" {count}\n"
+        for stack, count in sorted(stacks.items()))
+
+
+def speedscope(stacks, name, interval):
+    """A speedscope 'sampled' profile (https://www.speedscope.app)."""
+
+    frames, index, samples, weights = [], {}, [], []
+    for stack, count in stacks.items():
+        sample = []
+        for func, filename, line in stack:
+            key = (func, filename, line)
+            if key not in index:
+                index[key] = len(frames)
+                frames.append({'name': func, 'file': filename, 'line': line})
+            sample.append(index[key])
+        samples.append(sample)
+        weights.append(count * interval * 1000)
+
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'warbler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+    }
+
+
+##############################################################################
+# Request hooks
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'],
+                                  salt='profile')
+
+
+def make_token():
+    """A header value that asks for a profile, valid for TOKEN_MAX_AGE."""
+
+    return _serializer().dumps('profile')
+
+
+def _requested():
+    token = request.headers.get(HEADER)
+    if token:
+        try:
+            _serializer().loads(token, max_age=TOKEN_MAX_AGE)
+            return True
+        except BadSignature:
+            return False
+
+    rate = current_app.config.get('PROFILE_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def _start_profile():
+    if not _requested():
+        return
+
+    interval = current_app.config.get('PROFILE_INTERVAL_MS', INTERVAL_MS) / 1000
+    sampler = Sampler(threading.get_ident(), interval)
+    g._profile = {'sampler': sampler, 'queries': [],
+                  'started': time.perf_counter()}
+    sampler.start()
+
+
+def _finish_profile(response):
+    profile = g.pop('_profile', None)
+    if profile is None:
+        return response
+
+    stacks = profile['sampler'].stop()
+    elapsed = time.perf_counter() - profile['started']
+    try:
+        write_profile(stacks, profile['sampler'].interval, elapsed,
+                      profile['queries'], response.status_code)
+    except OSError:
+        current_app.logger.exception("Writing a request profile failed")
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if g and '_profile' in g:
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profile_started')
+    if started and g and '_profile' in g:
+        g._profile['queries'].append(
+            (time.perf_counter() - started.pop(), statement))
+
+
+def write_profile(stacks, interval, elapsed, queries, status):
+    """Write the profile files for the current request; returns their stem."""
+
+    directory = current_app.config.get('PROFILE_DIR') or os.path.join(
+        current_app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+
+    endpoint = request.endpoint or 'unmatched'
+    stem = os.path.join(directory, "{}-{}-{}-{}".format(
+        datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+        endpoint.replace('.', '_'), os.getpid(), threading.get_ident()))
+
+    query_time = sum(seconds for seconds, _ in queries)
+    name = (f"{request.method} {request.path} ({endpoint}) {status} "
+            f"{elapsed * 1000:.0f}ms, {len(queries)} queries "
+            f"{query_time * 1000:.0f}ms")
+
+    meta = {
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': endpoint,
+        'status': status,
+        'duration_ms': round(elapsed * 1000, 3),
+        'samples': sum(stacks.values()),
+        'interval_ms': interval * 1000,
+        'queries': {
+            'count': len(queries),
+            'total_ms': round(query_time * 1000, 3),
+            'slowest': [{'ms': round(seconds * 1000, 3),
+                         'statement': ' '.join(statement.split())[:500]}
+                        for seconds, statement
+                        in sorted(queries, key=lambda q: -q[0])[:TOP_QUERIES]],
+        },
+    }
+
+    with open(f"{stem}.collapsed", 'w') as f:
+        f.write(collapsed(stacks))
+    with open(f"{stem}.speedscope.json", 'w') as f:
+        json.dump(speedscope(stacks, name, interval), f)
+    with open(f"{stem}.meta.json", 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    current_app.logger.info("Profiled %s -> %s", name, stem)
+    return stem
+
+
+def init_app(app):
+    """Install the profiling hooks on `app`."""
+
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+
+
+##############################################################################
+# CLI
+
+
+@click.group('profile')
+def profile_cli():
+    """Profile individual requests."""
+
+
+@profile_cli.command('token')
+@with_appcontext
+def token_command():
+    """Print a header that makes a request profile itself."""
+
+    click.echo(f"{HEADER}: {make_token()}")
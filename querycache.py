@@ -0,0 +1,234 @@
+"""Query-result cache for Warbler's hottest reads.
+
+Profile pages, message pages and liked-message lists for popular users and
+messages are requested far more often than they change. Read functions
+wrapped with `memoize` keep their results for QUERY_CACHE_TTL seconds (0,
+the default outside production, turns caching off):
+
+    cached_message_card = memoize(
+        'message_card', lambda id: [message_tag(id)], card_tags)(message_card)
+
+Every entry is tagged with the users and messages it was built from: tags
+known from the arguments, plus any `result_tags` finds in the result (e.g.
+the authors of the cards in a liked-messages list, whose names and avatars
+the cards carry). The write views call `invalidate` with the tags they
+touch, which drops every entry carrying any of them. Invalidation bumps a
+per-tag version rather than hunting down keys, and an entry only counts if
+its tags' versions are unchanged since before it was computed, so a result
+computed while a write was committing is never served afterwards. Versions
+come from one counter shared by all tags, so for result tags, which are only
+known once the result is, a version newer than the counter's value before
+computing shows the tag was invalidated meanwhile, and the result isn't
+stored.
+
+Entries live in a backend. `MemoryBackend` is an in-process LRU bounded to
+QUERY_CACHE_MAX_ENTRIES (per worker, so one worker's invalidations don't
+reach another's entries, and the TTL bounds how stale those get).
+`set_backend` swaps in anything with the same methods (e.g. one backed by
+Redis, with the counter an INCR key) so all workers share entries and
+invalidations.
+
+Concurrent misses for the same key are collapsed: one thread computes, the
+others wait for it and take its result, so an expired popular page costs
+one query per process instead of one per request in flight.
+
+Hits and misses are reported per cache name as ``query_<name>``.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app
+
+import metrics
+
+MAX_ENTRIES = 10_000
+
+
+def user_tag(user_id):
+    return f"user:{user_id}"
+
+
+def message_tag(message_id):
+    return f"message:{message_id}"
+
+
+def card_tags(result):
+    """Tags for a `MessageCard`, a list of them, or None: each message and
+    its author."""
+
+    if result is None:
+        return []
+    cards = result if isinstance(result, list) else [result]
+    tags = []
+    for card in cards:
+        tags.append(message_tag(card.id))
+        tags.append(user_tag(card.user.id))
+    return tags
+
+
+class MemoryBackend:
+    """In-process LRU with per-entry expiry; the local stand-in for a
+    shared store."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        # key -> (expires, value, {tag: version})
+        self._entries = OrderedDict()
+        # tag -> value of _counter when it was last invalidated
+        self._versions = {}
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def counter(self):
+        """The latest version given to any tag."""
+
+        with self._lock:
+            return self._counter
+
+    def versions(self, tags):
+        """Current version of each of `tags`."""
+
+        with self._lock:
+            return {tag: self._versions.get(tag, 0) for tag in tags}
+
+    def get(self, key):
+        """(True, value) for a live entry, else (False, None)."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expires, value, versions = entry
+            if expires <= self.clock() or any(
+                    self._versions.get(tag, 0) != version
+                    for tag, version in versions.items()):
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl, versions):
+        """Store `value` for `ttl` seconds, valid while `versions` (from
+        `versions()`) are current."""
+
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl, value, versions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._counter += 1
+            for tag in tags:
+                self._versions[tag] = self._counter
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._counter = 0
+
+
+backend = MemoryBackend()
+
+# key -> lock held by the thread computing it
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def set_backend(new_backend):
+    """Replace the entry store (e.g. with one shared between workers)."""
+
+    global backend
+    backend = new_backend
+
+
+def init_app(app):
+    if isinstance(backend, MemoryBackend):
+        backend.max_entries = app.config.get('QUERY_CACHE_MAX_ENTRIES',
+                                             MAX_ENTRIES)
+
+
+def get(name, key, compute, tags=(), result_tags=None, ttl=None):
+    """`compute()`'s result, cached under (`name`, *`key`) and tagged with
+    `tags` plus `result_tags(result)`."""
+
+    if ttl is None:
+        ttl = current_app.config.get('QUERY_CACHE_TTL', 0)
+    if not ttl:
+        return compute()
+
+    key = (name,) + tuple(key)
+    found, value = backend.get(key)
+    if found:
+        metrics.cache_hit(f'query_{name}')
+        return value
+
+    with _flights_lock:
+        flight = _flights.setdefault(key, threading.Lock())
+
+    try:
+        with flight:
+            # someone else may have filled it while we waited
+            found, value = backend.get(key)
+            if found:
+                metrics.cache_hit(f'query_{name}')
+                return value
+
+            metrics.cache_miss(f'query_{name}')
+            started = backend.counter()
+            versions = backend.versions(tags)
+            value = compute()
+            if result_tags is not None:
+                extra = backend.versions(
+                    [tag for tag in result_tags(value) if tag not in versions])
+                if any(version > started for version in extra.values()):
+                    # invalidated while we computed: good for this request
+                    # only
+                    return value
+                versions.update(extra)
+            backend.set(key, value, ttl, versions)
+            return value
+    finally:
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+
+def memoize(name, tags, result_tags=None):
+    """Decorator caching a read function by its (positional) arguments.
+
+    `tags(*args)` lists the tags its result depends on. The undecorated
+    function stays available as `.uncached`.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args):
+            return get(name, args, lambda: fn(*args), tags(*args),
+                       result_tags)
+
+        wrapper.uncached = fn
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*tags):
+    """Drop every cached result tagged with any of `tags`."""
+
+    backend.invalidate(tags)
+
+
+def reset():
+    backend.clear()
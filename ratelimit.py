@@ -0,0 +1,229 @@
+"""Request rate limiting for Warbler.
+
+Routes opt in with the `rate_limit` decorator, naming a policy and what to
+key it on::
+
+    @app.route('/login', methods=["GET", "POST"])
+    @rate_limit('login', limit=10, per=60, key='ip', methods=('POST',))
+    def login():
+        ...
+
+Policies use a token bucket by default (bursts up to `limit`, refilling at
+limit/per per second), or `algorithm='sliding_window'` for a stricter
+"at most `limit` in any `per` seconds" (the usual two-window approximation).
+
+Counters live in a backend. `MemoryBackend` keeps them in-process, which is
+exact for a single worker; with several workers each enforces the limit
+separately. `set_backend` swaps in anything with the same `hit` method (e.g.
+one backed by Redis) so limits are shared.
+
+Requests are keyed by `client_ip`, the address of whoever connected. Behind a
+reverse proxy (or load balancer) that is the proxy, so every client would
+share one bucket: set TRUSTED_PROXIES to the number of proxies in front of
+the app, and create_app installs werkzeug's ProxyFix to take the address from
+X-Forwarded-For instead. Don't set it when clients can reach the app
+directly, or they can claim any address.
+
+Every limited response carries RateLimit-Limit/-Remaining/-Reset headers;
+rejections are 429s with Retry-After, and are counted in `rejections`.
+"""
+
+import math
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+
+import metrics
+
+TOKEN_BUCKET = 'token_bucket'
+SLIDING_WINDOW = 'sliding_window'
+
+
+class Policy:
+    """`limit` requests per `per` seconds, enforced with `algorithm`."""
+
+    def __init__(self, name, limit, per, algorithm=TOKEN_BUCKET):
+        if algorithm not in (TOKEN_BUCKET, SLIDING_WINDOW):
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+
+        self.name = name
+        self.limit = limit
+        self.per = per
+        self.algorithm = algorithm
+
+    def __repr__(self):
+        return f"<Policy {self.name}: {self.limit}/{self.per}s {self.algorithm}>"
+
+
+class Decision:
+    """Outcome of one `hit`."""
+
+    def __init__(self, allowed, limit, remaining, reset_after, retry_after=0):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        # seconds until the client's full quota is available again
+        self.reset_after = reset_after
+        # seconds until the next request would be allowed
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {
+            'RateLimit-Limit': str(self.limit),
+            'RateLimit-Remaining': str(self.remaining),
+            'RateLimit-Reset': str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(math.ceil(self.retry_after))
+        return headers
+
+
+class MemoryBackend:
+    """In-process counters; the local stand-in for a shared store."""
+
+    # prune idle keys every this many hits
+    PRUNE_EVERY = 10_000
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._state = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+
+    def hit(self, key, policy):
+        now = self.clock()
+        with self._lock:
+            self._hits += 1
+            if self._hits % self.PRUNE_EVERY == 0:
+                self._prune(now)
+
+            if policy.algorithm == TOKEN_BUCKET:
+                return self._token_bucket(key, policy, now)
+            return self._sliding_window(key, policy, now)
+
+    def _token_bucket(self, key, policy, now):
+        rate = policy.limit / policy.per
+        tokens, updated, _ = self._state.get(key, (policy.limit, now, None))
+        tokens = min(policy.limit, tokens + (now - updated) * rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        reset_after = (policy.limit - tokens) / rate
+        self._state[key] = (tokens, now, now + reset_after)
+
+        retry_after = 0 if allowed else (1 - tokens) / rate
+        return Decision(allowed, policy.limit, int(tokens), reset_after,
+                        retry_after)
+
+    def _sliding_window(self, key, policy, now):
+        window = int(now // policy.per)
+        start, current, previous, _ = self._state.get(key, (window, 0, 0, None))
+
+        if window != start:
+            previous = current if window == start + 1 else 0
+            current = 0
+
+        elapsed = (now % policy.per) / policy.per
+        estimated = previous * (1 - elapsed) + current
+
+        allowed = estimated + 1 <= policy.limit
+        retry_after = 0
+        if allowed:
+            current += 1
+            estimated += 1
+        elif current + 1 > policy.limit or not previous:
+            retry_after = policy.per - (now % policy.per)
+        else:
+            # wait for the previous window's weight to decay enough
+            needed = 1 - (policy.limit - 1 - current) / previous
+            retry_after = (needed - elapsed) * policy.per
+
+        self._state[key] = (window, current, previous,
+                            (window + 2) * policy.per)
+        reset_after = policy.per * 2 - (now % policy.per)
+        return Decision(allowed, policy.limit,
+                        max(0, int(policy.limit - estimated)), reset_after,
+                        retry_after)
+
+    def _prune(self, now):
+        # last field of every state tuple is when the key is back to "fresh"
+        stale = [key for key, state in self._state.items() if state[-1] <= now]
+        for key in stale:
+            del self._state[key]
+
+    def reset(self):
+        with self._lock:
+            self._state.clear()
+
+
+backend = MemoryBackend()
+
+# policy name -> number of rejected requests
+rejections = Counter()
+
+
+def set_backend(new_backend):
+    """Replace the counter store (e.g. with one shared between workers)."""
+
+    global backend
+    backend = new_backend
+
+
+def client_ip():
+    """The client's address (from X-Forwarded-For if TRUSTED_PROXIES)."""
+
+    return request.remote_addr or 'unknown'
+
+
+def _key_for(kind):
+    if kind == 'user' and g.get('user'):
+        return f"user:{g.user.id}"
+    return f"ip:{client_ip()}"
+
+
+def _rejected(decision):
+    if request.path.startswith('/api/'):
+        resp = jsonify(error="Too many requests.")
+    else:
+        resp = current_app.make_response("Too many requests.")
+    resp.status_code = 429
+    resp.headers.update(decision.headers())
+    return resp
+
+
+def rate_limit(name, limit, per, key='ip', algorithm=TOKEN_BUCKET,
+               methods=None):
+    """Limit a view to `limit` requests per `per` seconds.
+
+    `key` is 'ip' or 'user' (the logged-in user, falling back to IP);
+    `methods`, if given, limits only those HTTP methods.
+    """
+
+    policy = Policy(name, limit, per, algorithm)
+
+    def decorator(view):
+        @wraps(view)
+        def limited(*args, **kwargs):
+            if (not current_app.config.get('RATELIMIT_ENABLED', True)
+                    or (methods and request.method not in methods)):
+                return view(*args, **kwargs)
+
+            decision = backend.hit(f"{name}:{_key_for(key)}", policy)
+            if not decision.allowed:
+                rejections[name] += 1
+                metrics.ratelimit_rejections.inc(name)
+                return _rejected(decision)
+
+            resp = current_app.make_response(view(*args, **kwargs))
+            resp.headers.update(decision.headers())
+            return resp
+
+        limited.rate_limit_policy = policy
+        return limited
+
+    return decorator
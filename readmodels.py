@@ -0,0 +1,516 @@
+"""Read-only row objects for Warbler's render paths.
+
+Timeline, profile and listing pages only need a handful of display columns,
+so rather than hydrating full ORM instances (identity map, attribute
+instrumentation, lazy relationships) we select just those columns and wrap
+each row in a small slotted, immutable "card".
+
+Cards expose the same attribute names the templates already use
+(``msg.user.username``, ``user.image_url``...), and compare equal to the ORM
+object they were projected from, so checks like ``g.user.is_following(user)``
+keep working unchanged.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from models import db, User, Message, Likes, Follows, MessageTag, Mention
+from likecounts import displayed as displayed_like_count
+from querycache import memoize, user_tag, message_tag, card_tags
+import sharding
+
+FOLLOWS_PAGE_SIZE = 48
+TAG_PAGE_SIZE = 50
+
+# with partitioned messages, newest-first pages look this far back first
+RECENT_WINDOW = timedelta(days=31)
+
+
+class _Card:
+    """Base for immutable, slotted row objects."""
+
+    __slots__ = ()
+
+    # ORM class a card stands in for (used for equality)
+    _model = None
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __eq__(self, other):
+        if isinstance(other, (type(self), self._model)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((type(self), self.id))
+
+    def __repr__(self):
+        return f"<{type(self).__name__} #{self.id}>"
+
+
+class UserCard(_Card):
+    """Display fields for a user."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+    _model = User
+
+
+class MessageCard(_Card):
+    """Display fields for a message, with its author as a `UserCard`."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'like_count', 'user')
+
+    _model = Message
+
+
+USER_CARD_COLUMNS = (
+    User.id.label('user_id'),
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
+MESSAGE_CARD_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.like_count,
+) + USER_CARD_COLUMNS
+
+
+def user_card_from_row(row):
+    """Build a `UserCard` from a row selected with USER_CARD_COLUMNS."""
+
+    return UserCard(
+        id=row.user_id,
+        username=row.username,
+        image_url=row.image_url,
+        header_image_url=row.header_image_url,
+        bio=row.bio,
+    )
+
+
+def message_card_from_row(row):
+    """Build a `MessageCard` from a row selected with MESSAGE_CARD_COLUMNS."""
+
+    return MessageCard(
+        id=row.id,
+        text=row.text,
+        timestamp=row.timestamp,
+        like_count=displayed_like_count(row.id, row.like_count),
+        user=user_card_from_row(row),
+    )
+
+
+def _message_cards(stmt):
+    return [message_card_from_row(row) for row in db.session.execute(stmt)]
+
+
+def _message_select():
+    return (db.select(*MESSAGE_CARD_COLUMNS)
+            .join(User, Message.user_id == User.id))
+
+
+def _shard_cards(rows):
+    """`MessageCard`s for message rows read from shards; their authors'
+    cards come from the main database."""
+
+    authors = {card.id: card for card in
+               user_cards_by_ids(list({row.user_id for row in rows}))}
+    return [MessageCard(id=row.id,
+                        text=row.text,
+                        timestamp=row.timestamp,
+                        like_count=displayed_like_count(row.id,
+                                                        row.like_count),
+                        user=authors[row.user_id])
+            for row in rows if row.user_id in authors]
+
+
+def recent_first(stmt, limit):
+    """Cards for the first `limit` rows of `stmt`, which must be ordered
+    newest first.
+
+    When messages are partitioned by month (MESSAGES_PARTITIONED), first
+    read only the last RECENT_WINDOW of messages, so the planner prunes
+    older partitions. If that doesn't fill the page, the rest comes from
+    one query for everything older (so at most two queries, and the
+    second only for users quiet that long).
+    """
+
+    if not current_app.config.get('MESSAGES_PARTITIONED'):
+        return _message_cards(stmt.limit(limit))
+
+    cutoff = datetime.utcnow() - RECENT_WINDOW
+    cards = _message_cards(
+        stmt.where(Message.timestamp >= cutoff).limit(limit))
+    if len(cards) < limit:
+        cards += _message_cards(
+            stmt.where(Message.timestamp < cutoff).limit(limit - len(cards)))
+    return cards
+
+
+##############################################################################
+# Queries
+
+
+def following_ids(user_id):
+    """Ids of users that `user_id` follows."""
+
+    stmt = (db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id))
+    return db.session.scalars(stmt).all()
+
+
+def liked_message_ids(user_id):
+    """Set of message ids liked by `user_id`."""
+
+    stmt = db.select(Likes.message_id).where(Likes.user_id == user_id)
+    return set(db.session.scalars(stmt))
+
+
+def message_card(message_id):
+    """`MessageCard` for one message, or None."""
+
+    if sharding.enabled():
+        cards = message_cards_by_ids([message_id])
+        return cards[0] if cards else None
+
+    row = db.session.execute(
+        _message_select().where(Message.id == message_id)).first()
+    return message_card_from_row(row) if row else None
+
+
+def timeline_cards(user_ids, limit=100):
+    """Most recent messages written by any of `user_ids`."""
+
+    if sharding.enabled():
+        return _shard_cards(sharding.recent_rows(user_ids, limit))
+
+    stmt = (_message_select()
+            .where(Message.user_id.in_(user_ids))
+            .order_by(Message.timestamp.desc()))
+    return recent_first(stmt, limit)
+
+
+def latest_message_id():
+    """Id of the newest message (0 if there are none)."""
+
+    if sharding.enabled():
+        return sharding.latest_id()
+
+    return db.session.scalar(db.select(db.func.max(Message.id))) or 0
+
+
+def timeline_cards_since(user_ids, after_id, limit=100):
+    """Messages by any of `user_ids` with id > `after_id`, oldest first.
+
+    Message ids only grow, so "newer than the last one I saw" is an id range.
+    """
+
+    if sharding.enabled():
+        return _shard_cards(sharding.rows_since(user_ids, after_id, limit))
+
+    stmt = (_message_select()
+            .where(Message.user_id.in_(user_ids), Message.id > after_id)
+            .order_by(Message.id)
+            .limit(limit))
+    return _message_cards(stmt)
+
+
+def timeline_count_since(user_ids, after_id, cap=100):
+    """How many messages by `user_ids` have id > `after_id`, up to `cap`.
+
+    Capped so a client that's been away a long time doesn't make us count
+    its whole backlog just to show "99+".
+    """
+
+    if sharding.enabled():
+        return sharding.count_since(user_ids, after_id, cap)
+
+    newer = (db.select(Message.id)
+             .where(Message.user_id.in_(user_ids), Message.id > after_id)
+             .limit(cap)
+             .subquery())
+    return db.session.scalar(db.select(db.func.count()).select_from(newer))
+
+
+def message_cards_by_ids(message_ids):
+    """`MessageCard`s for `message_ids`, in that order (missing ids skipped)."""
+
+    if not message_ids:
+        return []
+
+    if sharding.enabled():
+        rows = sharding.rows_by_ids(message_ids)
+        cards = {card.id: card for card in _shard_cards(list(rows.values()))}
+        return [cards[id] for id in message_ids if id in cards]
+
+    stmt = _message_select().where(Message.id.in_(message_ids))
+    cards = {card.id: card for card in _message_cards(stmt)}
+    return [cards[id] for id in message_ids if id in cards]
+
+
+def user_message_cards(user_id, limit=100):
+    """Most recent messages written by `user_id`."""
+
+    if sharding.enabled():
+        return _shard_cards(sharding.recent_rows([user_id], limit))
+
+    stmt = (_message_select()
+            .where(Message.user_id == user_id)
+            .order_by(Message.timestamp.desc()))
+    return recent_first(stmt, limit)
+
+
+def message_count(user_id):
+    """How many messages `user_id` has written."""
+
+    if sharding.enabled():
+        return sharding.count_for_user(user_id)
+
+    return db.session.scalar(
+        db.select(db.func.count()).where(Message.user_id == user_id))
+
+
+def liked_count(user_id):
+    """How many messages `user_id` has liked."""
+
+    return db.session.scalar(
+        db.select(db.func.count()).where(Likes.user_id == user_id))
+
+
+def following_count(user_id):
+    """How many users `user_id` follows."""
+
+    return db.session.scalar(
+        db.select(db.func.count())
+        .where(Follows.user_following_id == user_id))
+
+
+def follower_count(user_id):
+    """How many users follow `user_id`."""
+
+    return db.session.scalar(
+        db.select(db.func.count())
+        .where(Follows.user_being_followed_id == user_id))
+
+
+def is_following(user_id, other_id):
+    """Does `user_id` follow `other_id`? (One primary key lookup.)"""
+
+    return db.session.scalar(
+        db.select(db.literal(True))
+        .where(Follows.user_following_id == user_id,
+               Follows.user_being_followed_id == other_id)) is not None
+
+
+def liked_message_cards(user_id, limit=100):
+    """Most recent messages liked by `user_id`."""
+
+    if sharding.enabled():
+        ids = db.session.scalars(
+            db.select(Likes.message_id).where(Likes.user_id == user_id)).all()
+        cards = message_cards_by_ids(ids)
+        cards.sort(key=lambda card: (card.timestamp, card.id), reverse=True)
+        return cards[:limit]
+
+    stmt = (_message_select()
+            .join(Likes, Likes.message_id == Message.id)
+            .where(Likes.user_id == user_id)
+            .order_by(Message.timestamp.desc())
+            .limit(limit))
+    return _message_cards(stmt)
+
+
+def user_cards(search=None):
+    """All users, optionally filtered by a username substring."""
+
+    stmt = db.select(*USER_CARD_COLUMNS)
+    if search:
+        stmt = stmt.where(User.username.like(f"%{search}%"))
+    return [user_card_from_row(row) for row in db.session.execute(stmt)]
+
+
+def user_cards_by_ids(user_ids):
+    """`UserCard`s for `user_ids`, in that order (missing ids skipped)."""
+
+    if not user_ids:
+        return []
+
+    stmt = db.select(*USER_CARD_COLUMNS).where(User.id.in_(user_ids))
+    cards = {row.user_id: user_card_from_row(row)
+             for row in db.session.execute(stmt)}
+    return [cards[id] for id in user_ids if id in cards]
+
+
+##############################################################################
+# Hashtag and mention feeds
+#
+# Both index tables are keyed (term, message_id), so "newest messages for
+# this term, before message id N" is a backwards range scan of the primary
+# key; the cursor is just the last message id shown.
+
+
+def _indexed_page(index, match_col, value, before, limit):
+    if sharding.enabled():
+        stmt = (db.select(index.message_id)
+                .where(match_col == value)
+                .order_by(index.message_id.desc())
+                .limit(limit + 1))
+        if before:
+            stmt = stmt.where(index.message_id < before)
+        ids = db.session.scalars(stmt).all()
+        cards = message_cards_by_ids(ids[:limit])
+        return cards, (ids[limit - 1] if len(ids) > limit else None)
+
+    stmt = (_message_select()
+            .join(index, index.message_id == Message.id)
+            .where(match_col == value)
+            .order_by(index.message_id.desc())
+            .limit(limit + 1))
+    if before:
+        stmt = stmt.where(index.message_id < before)
+
+    cards = _message_cards(stmt)
+    if len(cards) > limit:
+        return cards[:limit], cards[limit - 1].id
+    return cards, None
+
+
+def tag_message_cards(tag, before=None, limit=TAG_PAGE_SIZE):
+    """Newest messages tagged `tag` (already normalized).
+
+    Returns (cards, next_before); next_before is None on the last page.
+    """
+
+    return _indexed_page(MessageTag, MessageTag.tag, tag, before, limit)
+
+
+def mention_message_cards(user_id, before=None, limit=TAG_PAGE_SIZE):
+    """Newest messages mentioning `user_id`, as (cards, next_before)."""
+
+    return _indexed_page(Mention, Mention.user_id, user_id, before, limit)
+
+
+##############################################################################
+# Follower / following listings
+#
+# These page through the follows table newest-first using a keyset cursor of
+# (created_at, other user's id) rather than OFFSET, so every page is a bounded
+# range scan over ix_follows_*_created no matter how deep it is.
+
+
+def encode_cursor(created_at, user_id):
+    """Opaque cursor for the follow row after which the next page starts."""
+
+    raw = f"{created_at.isoformat()}|{user_id}".encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`; returns None for a missing/garbled cursor."""
+
+    if not cursor:
+        return None
+
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, user_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(user_id)
+    except ValueError:
+        return None
+
+
+def _follow_page(match_col, other_col, user_id, after, limit):
+    stmt = (db.select(*USER_CARD_COLUMNS, Follows.created_at)
+            .join(User, User.id == other_col)
+            .where(match_col == user_id)
+            .order_by(Follows.created_at.desc(), other_col.desc())
+            .limit(limit + 1))
+
+    position = decode_cursor(after)
+    if position:
+        created_at, other_id = position
+        stmt = stmt.where(db.or_(
+            Follows.created_at < created_at,
+            db.and_(Follows.created_at == created_at, other_col < other_id)))
+
+    rows = db.session.execute(stmt).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].user_id)
+
+    return [user_card_from_row(row) for row in rows], next_cursor
+
+
+def followers_page(user_id, after=None, limit=FOLLOWS_PAGE_SIZE):
+    """One page of users following `user_id`, most recent follow first.
+
+    Returns (cards, next_cursor); next_cursor is None on the last page.
+    """
+
+    return _follow_page(Follows.user_being_followed_id,
+                        Follows.user_following_id,
+                        user_id, after, limit)
+
+
+def following_page(user_id, after=None, limit=FOLLOWS_PAGE_SIZE):
+    """One page of users `user_id` follows, most recent follow first.
+
+    Returns (cards, next_cursor); next_cursor is None on the last page.
+    """
+
+    return _follow_page(Follows.user_following_id,
+                        Follows.user_being_followed_id,
+                        user_id, after, limit)
+
+
+def followed_among(user_id, other_ids):
+    """Subset of `other_ids` that `user_id` follows."""
+
+    if not other_ids:
+        return set()
+
+    stmt = (db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id,
+                   Follows.user_being_followed_id.in_(other_ids)))
+    return set(db.session.scalars(stmt))
+
+
+##############################################################################
+# Cached reads
+#
+# Versions of the above for the hottest pages (see querycache.py). The write
+# views invalidate the tags these depend on.
+
+cached_message_card = memoize(
+    'message_card', lambda id: [message_tag(id)], card_tags)(message_card)
+cached_user_message_cards = memoize(
+    'user_messages', lambda id, limit=100: [user_tag(id)],
+    card_tags)(user_message_cards)
+cached_liked_message_cards = memoize(
+    'liked_messages', lambda id, limit=100: [user_tag(id)],
+    card_tags)(liked_message_cards)
+cached_message_count = memoize(
+    'message_count', lambda id: [user_tag(id)])(message_count)
+cached_liked_count = memoize(
+    'liked_count', lambda id: [user_tag(id)])(liked_count)
+cached_following_count = memoize(
+    'following_count', lambda id: [user_tag(id)])(following_count)
+cached_follower_count = memoize(
+    'follower_count', lambda id: [user_tag(id)])(follower_count)
+cached_is_following = memoize(
+    'is_following', lambda id, other: [user_tag(id)])(is_following)
@@ -0,0 +1,209 @@
+"""Realtime timeline updates over Server-Sent Events.
+
+When `messages_add()` commits a warble, `publish_message` renders its
+timeline card once and publishes it on the author's channel. Each open
+``/api/timeline/stream`` connection subscribes to the channels of everyone
+its user follows (and its own), and receives the cards as SSE events whose
+ids are message ids.
+
+Reconnecting is a range query: a client that comes back with
+``Last-Event-ID: 123`` is first sent the timeline messages with id > 123 from
+the database, then live events. The same catch-up covers a slow client whose
+bounded per-connection buffer overflowed.
+
+Ids are allocated when a message is flushed, not when it commits, so a
+message can commit (and be published) after one with a higher id. A stream
+therefore never drops an event for being below the highest id it has sent;
+it skips only ids it has already sent (the last SEEN_SIZE), and catch-up
+queries start REORDER_WINDOW ids behind the last id. The browser skips cards
+it already shows, so a message sent again after a reconnect is harmless.
+
+The broker is in-process (`LocalBroker`), so it only reaches connections
+held by the same worker; anything with the same publish/subscribe/
+unsubscribe interface (e.g. one backed by Redis pub/sub) can be swapped in
+with `set_broker`. Each connection holds a worker thread while open, so
+streams close themselves after REALTIME_MAX_AGE seconds and the browser's
+EventSource reconnects (with Last-Event-ID) on its own.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict, deque
+
+from flask import render_template
+
+from models import db
+from readmodels import following_ids, latest_message_id, timeline_cards_since
+
+# per-connection buffer; beyond this we drop events and catch up from the DB
+BUFFER_SIZE = 100
+
+HEARTBEAT_SECONDS = 15
+MAX_AGE_SECONDS = 300
+
+# how long a reconnecting browser should wait, in ms
+RETRY_MS = 3000
+
+# how far behind the last sent id catch-up looks for late commits
+REORDER_WINDOW = 50
+# ids sent on a connection that are remembered, to skip duplicates
+SEEN_SIZE = 1000
+
+
+class Subscription:
+    """A bounded queue of events for one connection."""
+
+    def __init__(self, channels, maxlen=BUFFER_SIZE):
+        self.channels = frozenset(channels)
+        self.events = deque(maxlen=maxlen)
+        self.overflowed = False
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        with self._ready:
+            if len(self.events) == self.events.maxlen:
+                self.overflowed = True
+            self.events.append(event)
+            self._ready.notify()
+
+    def drain(self, timeout):
+        """Wait up to `timeout` seconds for events; returns (events, overflowed).
+
+        After an overflow the buffered events are discarded too, since the
+        caller has to catch up from the database anyway.
+        """
+
+        with self._ready:
+            if not self.events:
+                self._ready.wait(timeout)
+            events, overflowed = list(self.events), self.overflowed
+            self.events.clear()
+            self.overflowed = False
+
+        return ([] if overflowed else events), overflowed
+
+
+class LocalBroker:
+    """In-process pub/sub, keyed by channel name."""
+
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels, maxlen=BUFFER_SIZE):
+        sub = Subscription(channels, maxlen)
+        with self._lock:
+            for channel in sub.channels:
+                self._subscriptions[channel].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for channel in sub.channels:
+                subs = self._subscriptions.get(channel)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subscriptions[channel]
+
+    def publish(self, channel, event):
+        with self._lock:
+            subs = list(self._subscriptions.get(channel, ()))
+        for sub in subs:
+            sub.put(event)
+        return len(subs)
+
+
+broker = LocalBroker()
+
+
+def set_broker(new_broker):
+    """Replace the broker (e.g. with one shared between processes)."""
+
+    global broker
+    broker = new_broker
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+def render_card(card):
+    """Timeline <li> for a `MessageCard`, as the home page renders it."""
+
+    # a brand-new message can't have been liked yet
+    return render_template('messages/_card.html', msg=card, likes=())
+
+
+def publish_message(card):
+    """Push a just-committed message to its author's followers' streams."""
+
+    event = (card.id, {'id': card.id, 'html': render_card(card)})
+    return broker.publish(user_channel(card.user.id), event)
+
+
+def format_event(event_id, data, event='message'):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def timeline_stream(user_id, last_event_id=None,
+                    heartbeat=HEARTBEAT_SECONDS, max_age=MAX_AGE_SECONDS):
+    """Generate SSE text for `user_id`'s timeline.
+
+    Must run inside an app context (see `flask.stream_with_context`).
+    """
+
+    user_ids = following_ids(user_id) + [user_id]
+    sub = broker.subscribe(user_channel(uid) for uid in user_ids)
+
+    def catch_up(after_id):
+        events = [(card.id, {'id': card.id, 'html': render_card(card)})
+                  for card in timeline_cards_since(user_ids, after_id)]
+        # don't pin a pooled connection for the life of the stream
+        db.session.rollback()
+        return events
+
+    seen, seen_order = set(), deque()
+
+    def first_time(event_id):
+        if event_id in seen:
+            return False
+        seen.add(event_id)
+        seen_order.append(event_id)
+        if len(seen_order) > SEEN_SIZE:
+            seen.discard(seen_order.popleft())
+        return True
+
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+
+        if last_event_id is None:
+            # with nothing to resume from, start at "now"; anything that
+            # commits later is published to us
+            last_id = latest_message_id()
+            pending = catch_up(last_id)
+        else:
+            last_id = last_event_id
+            first_time(last_event_id)
+            pending = catch_up(max(last_id - REORDER_WINDOW, 0))
+        deadline = time.monotonic() + max_age
+
+        while True:
+            for event_id, data in pending:
+                if first_time(event_id):
+                    yield format_event(event_id, data)
+                    last_id = max(last_id, event_id)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            pending, overflowed = sub.drain(min(heartbeat, remaining))
+            if overflowed:
+                pending = catch_up(max(last_id - REORDER_WINDOW, 0))
+            elif not pending:
+                # comment line; keeps proxies from timing out the connection
+                yield ": keepalive\n\n"
+    finally:
+        broker.unsubscribe(sub)
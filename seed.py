@@ -1,20 +1,45 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
+Loads generator/*.csv, or the CSVs in the directory given as the first
+argument (e.g. one written by ``flask export dir``).
+"""
+
+import os
+import sys
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import create_app
+from models import db, User, Message, Follows, Likes
+import likecounts
+
+data_dir = sys.argv[1] if len(sys.argv) > 1 else 'generator'
 
+# seeding only needs the database, not the views
+app = create_app(views=False)
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
+with open(os.path.join(data_dir, 'users.csv')) as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
-with open('generator/messages.csv') as messages:
+with open(os.path.join(data_dir, 'messages.csv')) as messages:
     db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
+with open(os.path.join(data_dir, 'follows.csv')) as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+# exports have likes; the generated data doesn't
+if os.path.exists(os.path.join(data_dir, 'likes.csv')):
+    with open(os.path.join(data_dir, 'likes.csv')) as likes:
+        db.session.bulk_insert_mappings(Likes, DictReader(likes))
+
+# exported rows keep their ids; move the sequences past them
+if db.engine.dialect.name == 'postgresql':
+    for table in ('users', 'messages'):
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"coalesce(max(id), 0) + 1, false) FROM {table}"))
+
 db.session.commit()
+likecounts.reconcile()
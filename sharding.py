@@ -0,0 +1,471 @@
+"""Horizontal sharding of messages by author.
+
+With MESSAGE_SHARDS set to a list of database URLs, message rows live on
+those databases rather than in the main one: a user's messages all go to
+shard ``user_id % N``. Users, follows, likes and the tag/mention indexes
+stay in the main database.
+
+Message ids stay globally unique and ordered: each new message takes the
+next value v from the main database's `message_ids` allocator and gets id
+``v * N + shard``. So a message id alone says which shard holds it
+(``id % N``, used by message pages, likes and deletes), and ids still grow
+in posting order across shards, which the "new since" polls and tag pages
+rely on.
+
+Reads that span authors (the home timeline, polls, liked/tag/mention
+pages) scatter one query per shard involved, run in parallel, each with the
+page's full limit, then k-way merge the sorted results and cut the page.
+`readmodels` does the dispatching; this module only deals in message rows
+(id, text, timestamp, like_count, user_id).
+
+Setting up:
+
+- ``flask shards init`` creates the shard tables and, on PostgreSQL, drops
+  the foreign keys from likes/message_tags/mentions/message_viewers to
+  messages.id (those rows now point at other databases; deletes clean them
+  up explicitly);
+- ``flask shards migrate`` moves existing messages out of the main
+  database, renumbering id v to ``v * N + shard`` (so order is kept) and
+  updating likes, tags, mentions and viewer sketches to match. If it fails
+  partway it can simply be run again: messages already on a shard are
+  skipped.
+
+N is fixed once messages are placed: changing the number of shards would
+need a re-shard, which this doesn't do. Each write touches two databases
+without a distributed transaction; a failure between them can leave a
+message without its index rows, which ``flask tags backfill`` repairs.
+"""
+
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine
+
+from models import (db, Message, MessageId, Likes, MessageTag, Mention,
+                    MessageViewers, configure_sqlite)
+
+# the messages table as it exists on each shard: no foreign keys (users
+# live elsewhere) and ids assigned by the allocator
+shard_metadata = db.MetaData()
+messages = db.Table(
+    'messages', shard_metadata,
+    db.Column('id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('text', db.String(140), nullable=False),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Column('user_id', db.Integer, nullable=False),
+    db.Column('like_count', db.Integer, nullable=False, server_default='0'),
+    db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+)
+
+ROW_COLUMNS = (messages.c.id, messages.c.text, messages.c.timestamp,
+               messages.c.like_count, messages.c.user_id)
+
+
+class ShardSet:
+    """Engines for N message shards, and parallel queries across them."""
+
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self.engines = [create_engine(url) for url in self.urls]
+        for engine in self.engines:
+            if engine.dialect.name == 'sqlite':
+                configure_sqlite(engine)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.engines)
+
+    def for_user(self, user_id):
+        return user_id % len(self)
+
+    def for_message(self, message_id):
+        return message_id % len(self)
+
+    def group_users(self, user_ids):
+        """{shard index: [user ids on it]}."""
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.for_user(user_id), []).append(user_id)
+        return groups
+
+    def group_messages(self, message_ids):
+        groups = {}
+        for message_id in message_ids:
+            groups.setdefault(self.for_message(message_id),
+                              []).append(message_id)
+        return groups
+
+    def execute(self, index, stmt):
+        """Run `stmt` on one shard; returns its rows."""
+
+        with self.engines[index].connect() as conn:
+            return conn.execute(stmt).all()
+
+    def scatter(self, stmts):
+        """Run {shard index: statement} in parallel; {index: rows}."""
+
+        if len(stmts) == 1:
+            (index, stmt), = stmts.items()
+            return {index: self.execute(index, stmt)}
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=len(self), thread_name_prefix='shard')
+        futures = {index: self._executor.submit(self.execute, index, stmt)
+                   for index, stmt in stmts.items()}
+        return {index: future.result() for index, future in futures.items()}
+
+    def create_all(self):
+        for engine in self.engines:
+            shard_metadata.create_all(engine)
+
+    def drop_all(self):
+        for engine in self.engines:
+            shard_metadata.drop_all(engine)
+
+
+def init_app(app):
+    """Connect to MESSAGE_SHARDS, if any."""
+
+    urls = app.config.get('MESSAGE_SHARDS')
+    if urls:
+        app.extensions['message_shards'] = ShardSet(urls)
+
+
+def shards():
+    """The current app's `ShardSet`, or None if messages aren't sharded."""
+
+    return current_app.extensions.get('message_shards')
+
+
+def enabled():
+    return shards() is not None
+
+
+##############################################################################
+# Reads
+
+
+def _merge(results, key, reverse=False, limit=None):
+    """K-way merge per-shard row lists, each already sorted by `key`."""
+
+    merged = heapq.merge(*results.values(), key=key, reverse=reverse)
+    if limit is None:
+        return list(merged)
+    return [row for _, row in zip(range(limit), merged)]
+
+
+def _newest_first(row):
+    return (row.timestamp, row.id)
+
+
+def recent_rows(user_ids, limit):
+    """The newest `limit` messages by any of `user_ids`."""
+
+    shard_set = shards()
+    stmts = {index: (db.select(*ROW_COLUMNS)
+                     .where(messages.c.user_id.in_(ids))
+                     .order_by(messages.c.timestamp.desc(),
+                               messages.c.id.desc())
+                     .limit(limit))
+             for index, ids in shard_set.group_users(user_ids).items()}
+    if not stmts:
+        return []
+    return _merge(shard_set.scatter(stmts), _newest_first, reverse=True,
+                  limit=limit)
+
+
+def rows_since(user_ids, after_id, limit):
+    """Messages by `user_ids` with id > `after_id`, oldest first."""
+
+    shard_set = shards()
+    stmts = {index: (db.select(*ROW_COLUMNS)
+                     .where(messages.c.user_id.in_(ids),
+                            messages.c.id > after_id)
+                     .order_by(messages.c.id)
+                     .limit(limit))
+             for index, ids in shard_set.group_users(user_ids).items()}
+    if not stmts:
+        return []
+    return _merge(shard_set.scatter(stmts), lambda row: row.id, limit=limit)
+
+
+def count_since(user_ids, after_id, cap):
+    shard_set = shards()
+    stmts = {}
+    for index, ids in shard_set.group_users(user_ids).items():
+        newer = (db.select(messages.c.id)
+                 .where(messages.c.user_id.in_(ids), messages.c.id > after_id)
+                 .limit(cap)
+                 .subquery())
+        stmts[index] = db.select(db.func.count()).select_from(newer)
+    if not stmts:
+        return 0
+    counts = shard_set.scatter(stmts)
+    return min(cap, sum(rows[0][0] for rows in counts.values()))
+
+
+def latest_id():
+    shard_set = shards()
+    stmt = db.select(db.func.max(messages.c.id))
+    results = shard_set.scatter({index: stmt
+                                 for index in range(len(shard_set))})
+    return max((rows[0][0] or 0 for rows in results.values()), default=0)
+
+
+def rows_by_ids(message_ids):
+    """{message id: row} for whichever of `message_ids` exist."""
+
+    shard_set = shards()
+    stmts = {index: db.select(*ROW_COLUMNS).where(messages.c.id.in_(ids))
+             for index, ids in shard_set.group_messages(message_ids).items()}
+    if not stmts:
+        return {}
+    return {row.id: row for rows in shard_set.scatter(stmts).values()
+            for row in rows}
+
+
+def count_for_user(user_id):
+    shard_set = shards()
+    stmt = (db.select(db.func.count())
+            .where(messages.c.user_id == user_id))
+    return shard_set.execute(shard_set.for_user(user_id), stmt)[0][0]
+
+
+def stream_rows(user_ids=None, after=None, before=None, batch_size=1000):
+    """Every message (of `user_ids`, if given) in id order, read with
+    server-side cursors and merged across shards."""
+
+    shard_set = shards()
+    if user_ids is None:
+        indexes = range(len(shard_set))
+    else:
+        indexes = shard_set.group_users(user_ids).keys()
+
+    def from_shard(index):
+        stmt = db.select(*ROW_COLUMNS).order_by(messages.c.id)
+        if user_ids is not None:
+            stmt = stmt.where(messages.c.user_id.in_(user_ids))
+        if after is not None:
+            stmt = stmt.where(messages.c.id > after)
+        if before is not None:
+            stmt = stmt.where(messages.c.id < before)
+        with shard_set.engines[index].connect() as conn:
+            result = conn.execution_options(
+                yield_per=batch_size).execute(stmt)
+            yield from result
+
+    return heapq.merge(*(from_shard(index) for index in indexes),
+                       key=lambda row: row.id)
+
+
+##############################################################################
+# Writes
+
+
+def allocate_id(user_id):
+    """A new message id for `user_id`'s shard (in the main session)."""
+
+    value = db.session.execute(db.insert(MessageId)).inserted_primary_key[0]
+    # only the sequence matters; the row itself isn't needed
+    db.session.execute(db.delete(MessageId).where(MessageId.id == value))
+    shard_set = shards()
+    return value * len(shard_set) + shard_set.for_user(user_id)
+
+
+def add_message(user_id, text, timestamp=None):
+    """Write a message to its author's shard; returns its id.
+
+    The id is allocated in the main session, which the caller commits.
+    """
+
+    shard_set = shards()
+    message_id = allocate_id(user_id)
+    with shard_set.engines[shard_set.for_user(user_id)].begin() as conn:
+        conn.execute(messages.insert().values(
+            id=message_id, text=text, user_id=user_id,
+            timestamp=timestamp or datetime.utcnow()))
+    return message_id
+
+
+def _delete_dependents(message_ids):
+    """Delete (in the main session) the likes and index rows of messages."""
+
+    for model in (Likes, MessageTag, Mention, MessageViewers):
+        db.session.execute(
+            db.delete(model).where(model.message_id.in_(message_ids)))
+
+
+def delete_message(message_id):
+    """Delete a message, and (in the main session) its likes and index rows."""
+
+    shard_set = shards()
+    with shard_set.engines[shard_set.for_message(message_id)].begin() as conn:
+        conn.execute(messages.delete().where(messages.c.id == message_id))
+    _delete_dependents([message_id])
+
+
+def delete_user_messages(user_id):
+    """Delete a user's messages, and (in the main session) their likes and
+    index rows, including other users' likes of them; returns their ids."""
+
+    shard_set = shards()
+    with shard_set.engines[shard_set.for_user(user_id)].begin() as conn:
+        ids = conn.execute(
+            db.select(messages.c.id).where(messages.c.user_id == user_id)
+        ).scalars().all()
+        conn.execute(messages.delete().where(messages.c.user_id == user_id))
+    if ids:
+        _delete_dependents(ids)
+    return ids
+
+
+def add_like_counts(deltas):
+    """Apply {message id: delta} to like_count on each shard."""
+
+    shard_set = shards()
+    stmt = (messages.update()
+            .where(messages.c.id == db.bindparam('message_id'))
+            .values(like_count=messages.c.like_count + db.bindparam('delta')))
+    for index, ids in shard_set.group_messages(deltas).items():
+        with shard_set.engines[index].begin() as conn:
+            conn.execute(stmt, [{'message_id': id, 'delta': deltas[id]}
+                                for id in ids])
+
+
+def reconcile_like_counts():
+    """Reset like_count on every shard from the main database's likes."""
+
+    actual = dict(db.session.execute(
+        db.select(Likes.message_id, db.func.count())
+        .group_by(Likes.message_id)).all())
+
+    shard_set = shards()
+    stmt = (messages.update()
+            .where(messages.c.id == db.bindparam('message_id'))
+            .values(like_count=db.bindparam('count')))
+    corrected = 0
+    for engine in shard_set.engines:
+        with engine.begin() as conn:
+            wrong = [{'message_id': id, 'count': actual.get(id, 0)}
+                     for id, stored in conn.execute(
+                         db.select(messages.c.id, messages.c.like_count))
+                     if stored != actual.get(id, 0)]
+            if wrong:
+                conn.execute(stmt, wrong)
+            corrected += len(wrong)
+    return corrected
+
+
+##############################################################################
+# CLI
+
+
+@click.group('shards')
+def shards_cli():
+    """Manage message shards."""
+
+
+def _require_shards():
+    if not enabled():
+        raise click.ClickException("MESSAGE_SHARDS is not set.")
+    return shards()
+
+
+@shards_cli.command('init')
+@with_appcontext
+def init_command():
+    """Create the shard tables."""
+
+    import partitions
+
+    shard_set = _require_shards()
+    shard_set.create_all()
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            partitions.drop_dependent_foreign_keys(conn)
+    click.echo(f"Created messages on {len(shard_set)} shard(s).")
+
+
+@shards_cli.command('migrate')
+@click.option('--batch-size', default=1000)
+@with_appcontext
+def migrate_command(batch_size):
+    """Move messages from the main database onto the shards."""
+
+    shard_set = _require_shards()
+    n = len(shard_set)
+    table = Message.__table__
+
+    moved, after = 0, 0
+    while True:
+        batch = db.session.execute(
+            db.select(table).where(table.c.id > after)
+            .order_by(table.c.id).limit(batch_size)).mappings().all()
+        if not batch:
+            break
+        for index, rows in _group_rows(shard_set, batch).items():
+            new_rows = [dict(row, id=row['id'] * n + index) for row in rows]
+            with shard_set.engines[index].begin() as conn:
+                # copied by an earlier run that failed later on
+                copied = set(conn.execute(
+                    db.select(messages.c.id)
+                    .where(messages.c.id.in_([row['id'] for row in new_rows]))
+                ).scalars())
+                new_rows = [row for row in new_rows if row['id'] not in copied]
+                if new_rows:
+                    conn.execute(messages.insert(), new_rows)
+        moved += len(batch)
+        after = batch[-1]['id']
+        click.echo(f"  copied {moved} message(s)")
+
+    # point likes and index rows at the new ids, then drop the originals. A
+    # new id can equal another row's old id, so go through negative ids
+    # first rather than collide with rows not yet renumbered
+    for model in (Likes, MessageTag, Mention, MessageViewers):
+        owner = (db.select(table.c.user_id)
+                 .where(table.c.id == model.message_id)
+                 .scalar_subquery())
+        db.session.execute(
+            db.update(model)
+            .where(model.message_id.in_(db.select(table.c.id)))
+            .values(message_id=-(model.message_id * n + owner % n))
+            .execution_options(synchronize_session=False))
+        db.session.execute(
+            db.update(model)
+            .where(model.message_id < 0)
+            .values(message_id=-model.message_id)
+            .execution_options(synchronize_session=False))
+    db.session.execute(db.delete(Message))
+    _advance_allocator(after)
+    db.session.commit()
+    click.echo(f"Moved {moved} message(s) onto {n} shard(s).")
+
+
+def _group_rows(shard_set, rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(shard_set.for_user(row['user_id']), []).append(row)
+    return groups
+
+
+def _advance_allocator(value):
+    """Make the allocator's next value greater than `value`."""
+
+    if not value:
+        return
+    db.session.execute(db.insert(MessageId).values(id=value))
+    db.session.execute(db.delete(MessageId).where(MessageId.id == value))
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text(
+            "SELECT setval(pg_get_serial_sequence('message_ids', 'id'), "
+            ":value)"), {'value': value})
@@ -0,0 +1,286 @@
+"""Slow-query log for Warbler.
+
+Every statement that takes longer than SLOW_QUERY_MS is recorded, via
+SQLAlchemy cursor events, as one JSON line in SLOW_QUERY_LOG (default
+instance/slow-queries.jsonl) with:
+
+- the statement and its fingerprint: the statement with literals, bound
+  parameters and IN lists normalized away, so ``user_id IN (1, 2)`` and
+  ``user_id IN (3, 4, 5)`` aggregate together;
+- the shape of its parameters (names, types and list lengths; never values);
+- the route (Flask endpoint and path) that ran it;
+- for a sample of read queries (SLOW_QUERY_EXPLAIN_RATE), the plan: plain
+  EXPLAIN on Postgres, EXPLAIN QUERY PLAN on SQLite. It's planned, not run
+  again, on the same connection (inside a savepoint on Postgres, so a failed
+  EXPLAIN can't abort the caller's transaction). Locking reads (FOR UPDATE
+  / FOR SHARE) and WITH statements that modify data are never EXPLAINed.
+
+``flask slowlog report`` aggregates the log by fingerprint: count, total,
+mean and max time, the routes responsible, and the latest captured plan.
+Every worker appends to the same file, so the report covers all of them.
+"""
+
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from hashlib import sha1
+
+import click
+from flask import current_app, has_request_context, request
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+THRESHOLD_MS = 100
+EXPLAIN_RATE = 0.1
+
+# the last few records, for inspection from a shell or tests
+recent = deque(maxlen=100)
+
+_settings = {'threshold_ms': None, 'explain_rate': 0, 'path': None}
+_write_lock = threading.Lock()
+
+
+##############################################################################
+# Fingerprints
+
+
+_NORMALIZE = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                   # string literals
+    (re.compile(r'%\(\w+\)s|(?<!:):(?!:)\w+|\$\d+|\?'), '?'),  # bound parameters
+    (re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b'), '?'),       # numbers
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),    # IN / VALUES lists
+    (re.compile(r'(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+'), r'\1'),  # multi-VALUES
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize(statement):
+    """`statement` with the parts that vary between calls replaced."""
+
+    for pattern, replacement in _NORMALIZE:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def fingerprint(statement):
+    return sha1(normalize(statement).encode()).hexdigest()[:12]
+
+
+def _value_shape(value):
+    name = type(value).__name__
+    if isinstance(value, (list, tuple)):
+        return f"{name}[{len(value)}]"
+    return name
+
+
+def params_shape(parameters, executemany=False):
+    """Names and types (not values) of a statement's parameters."""
+
+    if executemany:
+        rows = list(parameters or ())
+        return {'executemany': len(rows),
+                'row': params_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {key: _value_shape(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_value_shape(value) for value in parameters]
+    return None
+
+
+##############################################################################
+# Recording
+
+
+_READ = re.compile(r'\s*(SELECT|WITH)\b', re.IGNORECASE)
+_LOCKING = re.compile(
+    r'\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b', re.IGNORECASE)
+_WRITES = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE)\b', re.IGNORECASE)
+
+
+def explainable(statement):
+    """Is `statement` a read we can safely EXPLAIN?"""
+
+    return bool(_READ.match(statement)
+                and not _LOCKING.search(statement)
+                and not _WRITES.search(statement))
+
+
+def _explain(conn, statement, parameters):
+    """The query plan for a read statement, or None."""
+
+    if not explainable(statement):
+        return None
+
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        prefix = 'EXPLAIN (FORMAT TEXT) '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    # straight on the DBAPI connection, so cursor events (and this log)
+    # don't see it; a savepoint keeps a failure from aborting the caller's
+    # transaction on Postgres (SQLite has no aborted state)
+    dbapi_conn = conn.connection.dbapi_connection
+    savepoint = (dialect == 'postgresql'
+                 and not getattr(dbapi_conn, 'autocommit', False))
+    cursor = dbapi_conn.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT slowlog_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as exc:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slowlog_explain')
+            return f"EXPLAIN failed: {exc}"
+        finally:
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT slowlog_explain')
+    except Exception as exc:
+        return f"EXPLAIN failed: {exc}"
+    finally:
+        cursor.close()
+
+    return '\n'.join(' '.join(str(col) for col in row) for row in rows)
+
+
+def record(conn, statement, parameters, executemany, elapsed):
+    """Log one slow statement."""
+
+    entry = {
+        'at': datetime.utcnow().isoformat(),
+        'ms': round(elapsed * 1000, 3),
+        'fingerprint': fingerprint(statement),
+        'normalized': normalize(statement),
+        'statement': statement,
+        'params': params_shape(parameters, executemany),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'path': request.path if has_request_context() else None,
+        'plan': None,
+    }
+    if (not executemany and _settings['explain_rate']
+            and random.random() < _settings['explain_rate']):
+        entry['plan'] = _explain(conn, statement, parameters)
+
+    recent.append(entry)
+    path = _settings['path']
+    if path:
+        with _write_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if _settings['threshold_ms'] is not None:
+        conn.info.setdefault('slowlog_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('slowlog_started')
+    if not started:
+        return
+
+    elapsed = time.perf_counter() - started.pop()
+    if elapsed * 1000 >= _settings['threshold_ms']:
+        record(conn, statement, parameters, executemany, elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_query(context):
+    started = (context.connection.info.get('slowlog_started')
+               if context.connection is not None else None)
+    if started:
+        started.pop()
+
+
+def _log_path(app):
+    return app.config.get('SLOW_QUERY_LOG') or os.path.join(
+        app.instance_path, 'slow-queries.jsonl')
+
+
+def init_app(app):
+    """Start logging statements slower than the app's SLOW_QUERY_MS
+    (None turns the log off)."""
+
+    _settings['threshold_ms'] = app.config.get('SLOW_QUERY_MS', THRESHOLD_MS)
+    _settings['explain_rate'] = app.config.get('SLOW_QUERY_EXPLAIN_RATE',
+                                               EXPLAIN_RATE)
+    _settings['path'] = _log_path(app)
+
+
+##############################################################################
+# Report
+
+
+def aggregate(entries):
+    """Group log entries by fingerprint, slowest total first."""
+
+    groups = {}
+    for entry in entries:
+        group = groups.setdefault(entry['fingerprint'], {
+            'fingerprint': entry['fingerprint'],
+            'normalized': entry['normalized'],
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'routes': Counter(), 'params': entry['params'], 'plan': None,
+        })
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        group['max_ms'] = max(group['max_ms'], entry['ms'])
+        group['routes'][entry['endpoint'] or '(no request)'] += 1
+        if entry['plan']:
+            group['plan'] = entry['plan']
+
+    return sorted(groups.values(), key=lambda g: -g['total_ms'])
+
+
+def read_log(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+@click.group('slowlog')
+def slowlog_cli():
+    """Inspect the slow-query log."""
+
+
+@slowlog_cli.command('report')
+@click.option('--limit', default=10, help="How many fingerprints to show.")
+@click.option('--plans/--no-plans', default=True)
+@with_appcontext
+def report_command(limit, plans):
+    """Slow statements grouped by fingerprint, by total time."""
+
+    path = _log_path(current_app)
+    if not os.path.exists(path):
+        click.echo(f"No slow queries logged ({path} doesn't exist).")
+        return
+
+    for group in aggregate(read_log(path))[:limit]:
+        click.echo(f"\n[{group['fingerprint']}] {group['count']} calls, "
+                   f"total {group['total_ms']:.1f}ms, "
+                   f"mean {group['total_ms'] / group['count']:.1f}ms, "
+                   f"max {group['max_ms']:.1f}ms")
+        click.echo(f"  {group['normalized']}")
+        click.echo(f"  params: {json.dumps(group['params'])}")
+        routes = ', '.join(f"{route} ({count})"
+                           for route, count in group['routes'].most_common(5))
+        click.echo(f"  routes: {routes}")
+        if plans and group['plan']:
+            click.echo('  plan:')
+            for line in group['plan'].splitlines():
+                click.echo(f"    {line}")
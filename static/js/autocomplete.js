@@ -0,0 +1,42 @@
+// Suggest usernames in the navbar search box as the user types.
+(function () {
+  var input = document.getElementById('search');
+  if (!input || !window.fetch) {
+    return;
+  }
+
+  var list = document.createElement('datalist');
+  list.id = 'search-suggestions';
+  input.setAttribute('list', list.id);
+  input.setAttribute('autocomplete', 'off');
+  input.parentNode.appendChild(list);
+
+  var timer = null;
+  var latest = '';
+
+  input.addEventListener('input', function () {
+    clearTimeout(timer);
+    timer = setTimeout(function () {
+      var prefix = input.value.trim();
+      latest = prefix;
+      if (!prefix) {
+        list.innerHTML = '';
+        return;
+      }
+
+      fetch('/api/users/autocomplete?q=' + encodeURIComponent(prefix))
+        .then(function (resp) { return resp.json(); })
+        .then(function (data) {
+          if (prefix !== latest) {
+            return;
+          }
+          list.innerHTML = '';
+          data.users.forEach(function (user) {
+            var option = document.createElement('option');
+            option.value = user.username;
+            list.appendChild(option);
+          });
+        });
+    }, 100);
+  });
+})();
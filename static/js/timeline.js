@@ -0,0 +1,20 @@
+// Prepend new warbles to the home timeline as the server pushes them.
+(function () {
+  var list = document.getElementById('messages');
+  if (!list || !list.dataset.stream || !window.EventSource) {
+    return;
+  }
+
+  var source = new EventSource(list.dataset.stream);
+
+  source.addEventListener('message', function (event) {
+    var data = JSON.parse(event.data);
+    if (document.querySelector('a[href="/messages/' + data.id + '"]')) {
+      return;
+    }
+
+    var template = document.createElement('template');
+    template.innerHTML = data.html.trim();
+    list.insertBefore(template.content.firstChild, list.firstChild);
+  });
+})();
@@ -0,0 +1,183 @@
+"""Hashtags and @mentions for Warbler.
+
+When a message is posted, `index_message` pulls the ``#tags`` and
+``@usernames`` out of its text and records them in two inverted index
+tables: `message_tags` (tag -> message id) and `mentions` (user id ->
+message id). Message ids only grow, so both are time-ordered for free, and a
+tag page or mentions feed is a keyset range scan over the primary key
+(see `readmodels.tag_message_cards` / `mention_message_cards`).
+
+Tags are matched case-insensitively (stored lower-cased); mentions are
+resolved to user ids when the message is posted, so they survive renames.
+Mentions of usernames that don't exist are ignored.
+
+Messages posted before the index existed are indexed by
+``flask tags backfill``, which walks the messages table in id order in
+batches, so it never holds more than one batch in memory and can be re-run
+(or resumed with --after) safely.
+"""
+
+import re
+
+import click
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+
+from models import db, User, Message, MessageTag, Mention
+import sharding
+
+MAX_TAG_LENGTH = 50
+
+# a # or @ that doesn't follow a word character (so not emails or a#b), nor
+# & (so linkify never mistakes an HTML entity like &#39; for a tag)
+TAG_RE = re.compile(r'(?<![\w#&])#(\w{1,%d})\b' % MAX_TAG_LENGTH)
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)')
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def normalize_tag(tag):
+    return tag.lower()
+
+
+def extract_tags(text):
+    """Distinct lower-cased hashtags in `text`, in order of appearance."""
+
+    return list(dict.fromkeys(normalize_tag(tag)
+                              for tag in TAG_RE.findall(text)))
+
+
+def extract_mentions(text):
+    """Distinct lower-cased @usernames in `text`, in order of appearance."""
+
+    return list(dict.fromkeys(name.lower()
+                              for name in MENTION_RE.findall(text)))
+
+
+def mentioned_user_ids(names):
+    """{lower-cased username: user id} for those of `names` that exist."""
+
+    if not names:
+        return {}
+
+    stmt = (db.select(db.func.lower(User.username), User.id)
+            .where(db.func.lower(User.username).in_(names)))
+    return dict(db.session.execute(stmt).all())
+
+
+def index_rows(messages):
+    """(tag rows, mention rows) to insert for `messages` (id, text) pairs."""
+
+    parsed = [(id, extract_tags(text), extract_mentions(text))
+              for id, text in messages]
+    user_ids = mentioned_user_ids(
+        {name for _, _, names in parsed for name in names})
+
+    tag_rows = [{'tag': tag, 'message_id': id}
+                for id, tags, _ in parsed for tag in tags]
+    mention_rows = [{'user_id': user_ids[name], 'message_id': id}
+                    for id, _, names in parsed
+                    for name in names if name in user_ids]
+    return tag_rows, mention_rows
+
+
+def index_message(message):
+    """Add a newly-flushed message's tags and mentions to the session."""
+
+    tag_rows, mention_rows = index_rows([(message.id, message.text)])
+    db.session.add_all(MessageTag(**row) for row in tag_rows)
+    db.session.add_all(Mention(**row) for row in mention_rows)
+
+
+def linkify(text):
+    """Template filter: escape `text`, linking its #tags and @mentions."""
+
+    def tag_link(match):
+        return Markup('<a href="/tags/{}">#{}</a>').format(
+            normalize_tag(match.group(1)), match.group(1))
+
+    def mention_link(match):
+        return Markup('<a href="/users?q={}">@{}</a>').format(
+            match.group(1), match.group(1))
+
+    html = TAG_RE.sub(tag_link, str(escape(text)))
+    return Markup(MENTION_RE.sub(mention_link, html))
+
+
+def backfill(after=0, batch_size=BACKFILL_BATCH_SIZE, progress=None):
+    """Index every message with id > `after`; returns how many were read.
+
+    Each batch deletes and re-inserts its messages' entries and commits, so
+    the backfill is idempotent and can be interrupted and resumed.
+    """
+
+    total = 0
+    for batch in _message_batches(after, batch_size):
+        ids = [id for id, _ in batch]
+        tag_rows, mention_rows = index_rows(batch)
+
+        db.session.execute(
+            db.delete(MessageTag).where(MessageTag.message_id.in_(ids)))
+        db.session.execute(
+            db.delete(Mention).where(Mention.message_id.in_(ids)))
+        if tag_rows:
+            db.session.execute(db.insert(MessageTag), tag_rows)
+        if mention_rows:
+            db.session.execute(db.insert(Mention), mention_rows)
+        db.session.commit()
+
+        total += len(batch)
+        if progress:
+            progress(total, ids[-1])
+
+    return total
+
+
+def _message_batches(after, batch_size):
+    """(id, text) of messages with id > `after`, in id order, in lists of
+    `batch_size`."""
+
+    if sharding.enabled():
+        batch = []
+        for row in sharding.stream_rows(after=after, batch_size=batch_size):
+            batch.append((row.id, row.text))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    while True:
+        batch = db.session.execute(
+            db.select(Message.id, Message.text)
+            .where(Message.id > after)
+            .order_by(Message.id)
+            .limit(batch_size)).all()
+        if not batch:
+            return
+        yield batch
+        after = batch[-1][0]
+
+
+##############################################################################
+# CLI
+
+
+@click.group('tags')
+def tags_cli():
+    """Maintain the hashtag and mention index."""
+
+
+@tags_cli.command('backfill')
+@click.option('--after', default=0, help="Resume after this message id.")
+@click.option('--batch-size', default=BACKFILL_BATCH_SIZE)
+@with_appcontext
+def backfill_command(after, batch_size):
+    """Index hashtags and mentions of existing messages."""
+
+    def progress(total, last_id):
+        click.echo(f"  indexed {total} message(s), through id {last_id}")
+
+    total = backfill(after, batch_size, progress)
+    click.echo(f"Indexed {total} message(s).")
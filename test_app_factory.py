@@ -0,0 +1,109 @@
+"""Application factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import create_app
+from config import DevelopmentConfig
+
+
+class AppFactoryTestCase(TestCase):
+    """Test create_app and its profiles."""
+
+    def run_python(self, code, *args, **env):
+        """stdout of `code` run in a fresh interpreter, whose caches and
+        logs go to a temporary directory rather than instance/."""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ,
+                       TEMPLATE_CACHE_DIR=os.path.join(tmp, 'jinja-cache'),
+                       SLOW_QUERY_LOG=os.path.join(tmp, 'slow-queries.jsonl'),
+                       **env)
+            out = subprocess.run([sys.executable, '-c', code, *args],
+                                 env=env, capture_output=True, text=True,
+                                 check=True)
+        return out.stdout.strip()
+
+    def test_testing_profile(self):
+        """Does the testing profile configure a test app with views"""
+        app = create_app('testing')
+
+        self.assertTrue(app.config['TESTING'])
+        self.assertFalse(app.config['WTF_CSRF_ENABLED'])
+        self.assertNotIn('_debug_toolbar.static', app.view_functions)
+        self.assertIn('views.homepage', app.view_functions)
+        self.assertIn('api.api_timeline_since', app.view_functions)
+
+    def test_without_views(self):
+        """Can the app be built for DB-only tools without any views"""
+        app = create_app('testing', views=False)
+
+        self.assertNotIn('views.homepage', app.view_functions)
+        self.assertIn('sqlalchemy', app.extensions)
+
+    def test_development_toolbar(self):
+        config = DevelopmentConfig()
+        config.DEBUG = True
+        app = create_app(config)
+        self.assertIn('_debug_toolbar.static', app.view_functions)
+
+    def test_production_requires_secret(self):
+        env = dict(os.environ)
+        env.pop('SECRET_KEY', None)
+        os.environ.pop('SECRET_KEY', None)
+        try:
+            with self.assertRaises(RuntimeError):
+                create_app('production')
+        finally:
+            os.environ.clear()
+            os.environ.update(env)
+
+    def test_production_skips_dev_imports(self):
+        """Does a production worker never import the debug toolbar"""
+        code = ("import sys; from app import create_app; "
+                "create_app('production'); "
+                "print('flask_debugtoolbar' in sys.modules)")
+        self.assertEqual(self.run_python(code, SECRET_KEY='test'), 'False')
+
+    def test_startup_measured(self):
+        """Is app creation timed (a warning is logged over budget)"""
+        app = create_app('testing')
+
+        self.assertGreater(app.config['STARTUP_MS'], 0)
+
+    def test_features_imported_lazily(self):
+        """Are unconfigured features and CLI groups left unimported"""
+        code = ("import sys; from app import create_app; "
+                "create_app('testing', views=False); "
+                "imported = set(sys.argv[1:]) & set(sys.modules); "
+                "print(' '.join(sorted(imported)))")
+        lazy = ['assets', 'export', 'jinjacache', 'likecounts', 'partitions',
+                'querycache', 'sharding', 'slowlog', 'tags']
+
+        self.assertEqual(self.run_python(code, *lazy), '')
+
+    def test_lazy_cli_group(self):
+        """Do CLI groups load their commands when used"""
+        app = create_app('testing', views=False)
+
+        result = app.test_cli_runner().invoke(args=['likes', '--help'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('reconcile', result.output)
@@ -0,0 +1,114 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+from assets import Builder, minify_css, asset_url
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+# only local sources, so the tests don't need the network
+BUNDLES = {'app.css': ['/static/stylesheets/style.css']}
+IMAGES = ['/static/images/warbler-logo.png']
+
+
+class AssetPipelineTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.dist_dir = tempfile.mkdtemp()
+        app.config['ASSETS_DIST_DIR'] = self.dist_dir
+
+        with app.app_context():
+            self.manifest = Builder(self.dist_dir).build(BUNDLES, IMAGES)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.dist_dir)
+        app.config['ASSETS_DIST_DIR'] = None
+
+    def test_minify_css(self):
+        """Are comments and whitespace removed"""
+        css = "/* hi */\na > b ,\nc {\n  color: red;\n}\n"
+        self.assertEqual(minify_css(css), "a>b,c{color: red}")
+
+    def test_manifest(self):
+        """Are bundles and images written under hashed names"""
+        self.assertRegex(self.manifest['app.css'], r'^app\.[0-9a-f]{12}\.css$')
+        self.assertRegex(self.manifest['images/warbler-logo.png'],
+                         r'^images/warbler-logo\.[0-9a-f]{12}\.png$')
+
+        with app.test_request_context():
+            self.assertEqual(asset_url('app.css'),
+                             f"/assets/{self.manifest['app.css']}")
+            self.assertIsNone(asset_url('nope.css'))
+
+    def test_css_urls_rewritten(self):
+        """Do bundled CSS references point at fingerprinted copies"""
+        with open(os.path.join(self.dist_dir, self.manifest['app.css'])) as f:
+            css = f.read()
+
+        self.assertNotIn('/static/images/nav-bg.png', css)
+        self.assertRegex(css, r'url\("images/nav-bg\.[0-9a-f]{12}\.png"\)')
+
+    def test_serve_precompressed(self):
+        """Is the gzip variant served with immutable caching"""
+        resp = self.client.get(f"/assets/{self.manifest['app.css']}",
+                               headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn(b'.navbar', gzip.decompress(resp.data))
+
+    def test_refused_encoding(self):
+        """Is an encoding the client gave q=0 never sent"""
+        url = f"/assets/{self.manifest['app.css']}"
+        resp = self.client.get(url, headers={
+            'Accept-Encoding': 'br;q=0, gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'.navbar', resp.data)
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'br;q=0, *'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        resp = self.client.get(url, headers={
+            'Accept-Encoding': 'br;q=0.1, gzip;q=1.0'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_base_uses_bundle(self):
+        """Does the layout link the built bundle instead of the CDNs"""
+        resp = self.client.get('/login')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn(f"/assets/{self.manifest['app.css']}", html)
+        self.assertNotIn('unpkg.com', html)
+
+    def test_missing_asset(self):
+        resp = self.client.get('/assets/app.0000.css')
+        self.assertEqual(resp.status_code, 404)
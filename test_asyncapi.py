@@ -0,0 +1,166 @@
+"""Async read API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asyncapi.py
+
+
+import asyncio
+import json
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from asyncapi import AsyncAPI, async_url, mount
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+async def call(asgi_app, path, query=b'', cookie=None, method='GET'):
+    """(status, JSON body) of one request to `asgi_app`."""
+
+    headers = [(b'cookie', f"session={cookie}".encode())] if cookie else []
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query, 'headers': headers}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+
+class AsyncAPITestCase(TestCase):
+    """Test the async endpoints against the same data as the sync views."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        self.carol = User.signup("carol", "carol@test.com", "password", None)
+        db.session.commit()
+        self.alice.following.append(self.bob)
+        db.session.add_all([
+            Message(text="alice says", user_id=self.alice.id),
+            Message(text="bob says", user_id=self.bob.id),
+            Message(text="carol says", user_id=self.carol.id),
+        ])
+        db.session.commit()
+        self.ids = {u.username: u.id for u in (self.alice, self.bob,
+                                               self.carol)}
+
+    def tearDown(self):
+        db.session.remove()
+
+    def request(self, *args, **kwargs):
+        async def run():
+            api = AsyncAPI(app)
+            try:
+                return await call(api, *args, **kwargs)
+            finally:
+                await api.reads.dispose()
+
+        return asyncio.run(run())
+
+    def cookie(self, user_id):
+        serializer = app.session_interface.get_signing_serializer(app)
+        return serializer.dumps({CURR_USER_KEY: user_id})
+
+    def test_async_url(self):
+        self.assertEqual(
+            async_url("postgresql:///warbler").drivername,
+            'postgresql+asyncpg')
+        self.assertEqual(
+            async_url("postgresql+psycopg2://u@h/warbler").drivername,
+            'postgresql+asyncpg')
+        with self.assertRaises(ValueError):
+            async_url("mysql://u@h/warbler")
+
+    def test_timeline(self):
+        status, _ = self.request('/api/async/timeline')
+        self.assertEqual(status, 401)
+
+        status, body = self.request(
+            '/api/async/timeline', cookie=self.cookie(self.ids['alice']))
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(m['text'] for m in body['messages']),
+                         ["alice says", "bob says"])
+
+        status, _ = self.request('/api/async/timeline', cookie="forged")
+        self.assertEqual(status, 401)
+
+        # SimpleCookie refuses the whole header over one illegal name
+        status, _ = self.request(
+            '/api/async/timeline',
+            cookie=self.cookie(self.ids['alice']) + "; bad,name=1")
+        self.assertEqual(status, 401)
+
+    def test_profile(self):
+        status, body = self.request(f"/api/async/users/{self.ids['alice']}")
+        self.assertEqual(status, 200)
+        self.assertEqual(body['user']['username'], "alice")
+        self.assertEqual(body['counts'], {'messages': 1, 'following': 1,
+                                          'followers': 0, 'likes': 0})
+        self.assertEqual([m['text'] for m in body['messages']],
+                         ["alice says"])
+
+        status, _ = self.request("/api/async/users/999999")
+        self.assertEqual(status, 404)
+
+    def test_message_and_search(self):
+        msg = Message.query.filter_by(text="bob says").one()
+        status, body = self.request(f"/api/async/messages/{msg.id}")
+        self.assertEqual(status, 200)
+        self.assertEqual(body['message']['user']['username'], "bob")
+
+        status, body = self.request('/api/async/users', query=b'q=ar')
+        self.assertEqual([u['username'] for u in body['users']], ["carol"])
+
+        status, _ = self.request('/api/async/users', method='POST')
+        self.assertEqual(status, 405)
+        status, _ = self.request('/api/async/nope')
+        self.assertEqual(status, 404)
+
+    def test_mount(self):
+        """Other paths go to the wrapped WSGI app"""
+
+        async def wsgi_app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b'"flask"'})
+
+        async def run():
+            dispatch = mount(app, wsgi_app)
+            try:
+                return (await call(dispatch, '/users'),
+                        await call(dispatch, '/api/async/users'))
+            finally:
+                await dispatch.async_api.reads.dispose()
+
+        (status, body), (_, users) = asyncio.run(run())
+        self.assertEqual(body, "flask")
+        self.assertEqual(len(users['users']), 3)
@@ -0,0 +1,137 @@
+"""Username autocomplete tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_autocomplete.py
+
+
+import threading
+import time
+from unittest import TestCase, mock
+
+from testdb import TransactionalTestCase
+from models import db, User
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+import autocomplete
+from autocomplete import UsernameIndex
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UsernameIndexTestCase(TestCase):
+    """Test the sorted array."""
+
+    def test_complete(self):
+        index = UsernameIndex()
+        index.load([(1, 'Bob'), (2, 'bobby'), (3, 'alice'), (4, 'bo_jangles')])
+
+        self.assertEqual(index.complete('BO'),
+                         [(4, 'bo_jangles'), (1, 'Bob'), (2, 'bobby')])
+        self.assertEqual(index.complete('bob', limit=1), [(1, 'Bob')])
+        self.assertEqual(index.complete('z'), [])
+
+        index.remove(1)
+        index.add(5, 'Bobcat')
+        index.add(3, 'bobalice')
+        self.assertEqual(index.complete('bob'),
+                         [(3, 'bobalice'), (2, 'bobby'), (5, 'Bobcat')])
+        self.assertEqual(index.complete('a'), [])
+
+
+class AutocompleteViewsTestCase(TransactionalTestCase):
+    """Test the endpoint and keeping the index current."""
+
+    def setUp(self):
+        super().setUp()
+        autocomplete.reset()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+    def usernames(self, prefix):
+        resp = self.client.get(f"/api/users/autocomplete?q={prefix}")
+        return [u['username'] for u in resp.json['users']]
+
+    def test_sql_fallback(self):
+        """Before the index is built, is the prefix answered from the DB"""
+        self.assertEqual(autocomplete.sql_complete('TEST'),
+                         [(self.testuser.id, 'testuser')])
+        self.assertEqual(autocomplete.sql_complete('test_'), [])
+
+    def test_kept_current(self):
+        autocomplete.build()
+        self.assertEqual(self.usernames('te'), ['testuser'])
+
+        other = User.signup(username="tea_drinker", email="tea@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        self.assertEqual(self.usernames('te'), ['tea_drinker', 'testuser'])
+
+        other.username = "coffee_drinker"
+        db.session.commit()
+        self.assertEqual(self.usernames('te'), ['testuser'])
+        self.assertEqual(self.usernames('@cof'), ['coffee_drinker'])
+
+        db.session.delete(other)
+        db.session.commit()
+        self.assertEqual(self.usernames('cof'), [])
+
+    def test_rollback_not_indexed(self):
+        autocomplete.build()
+
+        User.signup(username="ghost", email="ghost@test.com",
+                    password="testuser", image_url=None)
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.usernames('gh'), [])
+
+    def test_built_at_startup(self):
+        app.config['AUTOCOMPLETE_WARM'] = True
+        try:
+            autocomplete.init_app(app).join()
+        finally:
+            app.config['AUTOCOMPLETE_WARM'] = False
+
+        self.assertTrue(autocomplete.index.ready)
+        self.assertEqual(autocomplete.index.complete('te'),
+                         [(self.testuser.id, 'testuser')])
+
+    def test_one_build_at_a_time(self):
+        """Do lookups on a cold index start a single build between them"""
+        started = []
+        release = threading.Event()
+
+        def build():
+            started.append(True)
+            release.wait()
+            autocomplete._building = False
+
+        with mock.patch.object(autocomplete, 'build', build):
+            for _ in range(3):
+                self.assertEqual(self.usernames('te'), ['testuser'])
+            release.set()
+            while autocomplete._building:
+                time.sleep(0.01)
+
+        self.assertEqual(len(started), 1)
@@ -0,0 +1,169 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+from unittest import TestCase
+
+from testdb import TransactionalTestCase
+from models import db, User
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import availability
+from availability import BloomFilter, username_available, reset
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the in-memory Bloom filter."""
+
+    def test_no_false_negatives(self):
+        """Is every added item reported as present"""
+        bloom = BloomFilter(capacity=1000)
+        names = [f"user{i}" for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        """Do unseen items mostly come back absent"""
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityViewTestCase(TransactionalTestCase):
+    """Test availability probes and endpoints."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        reset()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+    def test_username_available(self):
+        """Are taken usernames detected regardless of case"""
+        self.assertFalse(username_available("testuser"))
+        self.assertFalse(username_available("TestUser"))
+        self.assertTrue(username_available("someoneelse"))
+
+    def test_new_signup_is_seen(self):
+        """Does a signup after the filter is built show up as taken"""
+        self.assertTrue(username_available("testuser2"))
+
+        User.signup(username="testuser2",
+                    email="test2@test.com",
+                    password="testuser",
+                    image_url=None)
+        db.session.commit()
+
+        self.assertFalse(username_available("testuser2"))
+
+    def test_api_username_available(self):
+        """Does the JSON endpoint report availability"""
+        with self.client as c:
+            resp = c.get('/api/username-available?username=TESTUSER')
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(resp.json['available'])
+
+            resp = c.get('/api/username-available?username=fresh')
+            self.assertTrue(resp.json['available'])
+
+            resp = c.get('/api/username-available')
+            self.assertEqual(resp.status_code, 400)
+
+            self.assertEqual(resp.headers['RateLimit-Limit'], '30')
+
+    def taken_elsewhere(self, username, email):
+        """Add a user as another worker would: unseen by our filters."""
+
+        availability.rebuild()
+        db.session.execute(User.__table__.insert().values(
+            username=username, email=email, password="x"))
+        db.session.commit()
+
+    def test_api_confirms_in_database(self):
+        """Does the endpoint see names taken through other workers"""
+        self.taken_elsewhere("elsewhere", "elsewhere@test.com")
+
+        self.assertTrue(username_available("elsewhere"))
+        resp = self.client.get('/api/username-available?username=elsewhere')
+        self.assertFalse(resp.json['available'])
+
+    def test_profile_rename_race(self):
+        """Is renaming to a name taken elsewhere an error, not a 500"""
+        self.taken_elsewhere("elsewhere", "elsewhere@test.com")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.post('/users/profile',
+                          data={'username': "Elsewhere",
+                                'email': "test@test.com",
+                                'password': "testuser"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Username or email already taken",
+                      resp.get_data(as_text=True))
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.testuser.id).username,
+                         "testuser")
+
+    def test_no_email_probe(self):
+        """Is there no endpoint revealing which emails are registered"""
+        resp = self.client.get('/api/email-available?email=test@test.com')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_warm_at_startup(self):
+        """Does init_app build the filters without waiting for a request"""
+        self.assertIsNone(availability.init_app(app))
+
+        app.config['AVAILABILITY_WARM'] = True
+        try:
+            availability.init_app(app).join(10)
+        finally:
+            app.config['AVAILABILITY_WARM'] = False
+
+        self.assertIsNotNone(availability.usernames._filter)
+        self.assertIn("testuser", availability.usernames._filter)
+
+    def test_signup_duplicate_username(self):
+        """Is a duplicate username rejected before creating a user"""
+        with self.client as c:
+            resp = c.post('/signup', data={'username': 'TestUser',
+                                           'email': 'other@test.com',
+                                           'password': 'password'})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Username already taken', html)
+            self.assertEqual(User.query.count(), 1)
@@ -0,0 +1,125 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import zlib
+from unittest import TestCase
+
+import brotli
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from models import db
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+from compression import CompressionMiddleware
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+
+class CompressionTestCase(TestCase):
+    """Test the compression middleware."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_gzip_html(self):
+        """Are pages gzipped when the client accepts it"""
+        plain = self.client.get('/login').get_data()
+        resp = self.client.get('/login', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+    def test_brotli_preferred(self):
+        """Is brotli used when the client accepts both"""
+        plain = self.client.get('/login').get_data()
+        resp = self.client.get('/login',
+                               headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.get_data()), plain)
+
+    def test_refused_encoding(self):
+        """Does an explicit q=0 beat a wildcard"""
+        resp = self.client.get('/login',
+                               headers={'Accept-Encoding': 'br;q=0, *'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_client_preference(self):
+        """Does a higher q-value for gzip beat brotli"""
+        resp = self.client.get(
+            '/login', headers={'Accept-Encoding': 'br;q=0.1, gzip;q=1.0'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        resp = self.client.get(
+            '/login', headers={'Accept-Encoding': 'gzip;q=0.5, br;q=0.5'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+
+    def test_etag_weakened(self):
+        """Is a strong ETag made weak once the body is re-encoded"""
+        def wsgi(environ, start_response):
+            resp = Response('x' * 1000, mimetype='text/plain')
+            resp.set_etag('abc')
+            return resp(environ, start_response)
+
+        client = Client(CompressionMiddleware(wsgi))
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['ETag'], 'W/"abc"')
+
+        resp = client.get('/')
+        self.assertEqual(resp.headers['ETag'], '"abc"')
+
+    def test_no_accept_encoding(self):
+        """Are responses left alone for clients that don't accept encodings"""
+        resp = self.client.get('/login')
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_small_and_binary_skipped(self):
+        """Are tiny responses and non-text types left uncompressed"""
+        def wsgi(environ, start_response):
+            if environ['PATH_INFO'] == '/small':
+                resp = Response('{}', mimetype='application/json')
+            else:
+                resp = Response(b'\xff' * 5000, mimetype='image/png')
+            return resp(environ, start_response)
+
+        client = Client(CompressionMiddleware(wsgi, min_size=500))
+        for path in ('/small', '/image'):
+            resp = client.get(path, headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_streaming(self):
+        """Is each streamed chunk flushed so it can be decoded on arrival"""
+        def wsgi(environ, start_response):
+            chunks = (f"chunk {i}\n" * 50 for i in range(3))
+            return Response(chunks, mimetype='text/plain')(environ,
+                                                            start_response)
+
+        middleware = CompressionMiddleware(wsgi, level=6)
+        client = Client(middleware)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        first = decoder.decompress(next(iter(resp.response)))
+        self.assertEqual(first.decode(), "chunk 0\n" * 50)
@@ -0,0 +1,145 @@
+"""Account data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+
+from testdb import TransactionalTestCase
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import export
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(TransactionalTestCase):
+    """Test the export endpoint and CLI."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.other = User.signup(username="other",
+                                 email="other@test.com",
+                                 password="testuser",
+                                 image_url=None)
+        db.session.flush()
+
+        self.messages = [Message(text=f"msg {i}", user_id=self.testuser.id)
+                         for i in range(5)]
+        theirs = Message(text="theirs", user_id=self.other.id)
+        db.session.add_all(self.messages + [theirs])
+        db.session.flush()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.other.id,
+                    user_following_id=self.testuser.id),
+            Likes(user_id=self.testuser.id, message_id=theirs.id),
+        ])
+        db.session.commit()
+
+        self.ids = [m.id for m in self.messages]
+
+    def tearDown(self):
+        # the next setUp's bulk deletes don't evict these from the session
+        db.session.remove()
+
+    def get(self, query=''):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            return c.get(f"/api/users/{self.testuser.id}/export{query}")
+
+    def test_ndjson(self):
+        resp = self.get()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([r['type'] for r in records],
+                         ['user', 'follow', 'like'] + ['message'] * 5)
+        self.assertEqual(records[0]['password'], '')
+        self.assertEqual([r['id'] for r in records[3:]], self.ids)
+
+    def test_resume_after(self):
+        resp = self.get(f"?after={self.ids[2]}")
+
+        records = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([r['id'] for r in records], self.ids[3:])
+
+    def test_csv_gzip(self):
+        resp = self.get("?format=csv&gzip=1")
+
+        self.assertEqual(resp.mimetype, 'application/gzip')
+        self.assertIn('-messages.csv.gz', resp.headers['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(
+            gzip.decompress(resp.data).decode())))
+        self.assertEqual(rows[0], export.MESSAGE_COLUMNS)
+        self.assertEqual([r[0] for r in rows[1:]],
+                         [f"msg {i}" for i in range(5)])
+
+    def test_others_data_refused(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.other.id
+            resp = c.get(f"/api/users/{self.testuser.id}/export")
+        self.assertEqual(resp.status_code, 403)
+
+        resp = app.test_client().get(f"/api/users/{self.testuser.id}/export")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_chunking(self):
+        # rows are gathered into chunks rather than yielded one by one
+        chunks = list(export.ndjson_chunks(self.testuser.id))
+        self.assertEqual(len(chunks), 1)
+
+    def test_dir_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = app.test_cli_runner().invoke(
+                args=['export', 'dir', tmp, '--user', str(self.testuser.id)])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            def read(name):
+                with open(os.path.join(tmp, name)) as f:
+                    return list(csv.DictReader(f))
+
+            users = read('users.csv')
+            self.assertEqual([u['username'] for u in users], ['testuser'])
+            self.assertTrue(users[0]['password'])
+            self.assertEqual(len(read('messages.csv')), 5)
+            # these point at the other user, who isn't in the export
+            self.assertEqual(read('follows.csv'), [])
+            self.assertEqual(read('likes.csv'), [])
+
+            with open(os.path.join(tmp, 'messages.csv')) as f:
+                header = next(csv.reader(f))
+        with open('generator/messages.csv') as f:
+            generated = next(csv.reader(f))
+        self.assertEqual(header[:len(generated)], generated)
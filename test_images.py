@@ -0,0 +1,200 @@
+"""Image thumbnail tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from models import db
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+import images
+from images import ImageSourceError, thumbnail_url
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+
+class ImageThumbnailTestCase(TestCase):
+    """Test the thumbnail endpoint."""
+
+    def setUp(self):
+        """Point the image source and cache at scratch directories."""
+
+        self.source_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        app.config['IMAGE_SOURCE_DIR'] = self.source_dir
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir
+
+        Image.new('RGB', (800, 600), 'red').save(
+            os.path.join(self.source_dir, 'portrait.jpg'))
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_thumbnail(self):
+        """Is a remote image served resized, cached but revalidated"""
+        with app.test_request_context():
+            url = thumbnail_url("https://example.com/img/portrait.jpg", 48)
+
+        resp = self.client.get(url, headers={'Accept': 'image/webp,*/*'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn(f'max-age={images.THUMBNAIL_MAX_AGE}',
+                      resp.headers['Cache-Control'])
+        with Image.open(BytesIO(resp.data)) as img:
+            self.assertEqual(img.size, (96, 72))
+
+        again = self.client.get(url, headers={
+            'Accept': 'image/webp,*/*',
+            'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+    def test_changed_source_refreshed(self):
+        """Is a source that changed at the same URL picked up after a while"""
+        with app.test_request_context():
+            url = thumbnail_url("https://example.com/img/portrait.jpg", 48)
+        first = self.client.get(url).data
+
+        Image.new('RGB', (800, 600), 'blue').save(
+            os.path.join(self.source_dir, 'portrait.jpg'))
+        self.assertEqual(self.client.get(url).data, first)
+
+        app.config['IMAGE_REFRESH_SECONDS'] = 0
+        try:
+            self.assertNotEqual(self.client.get(url).data, first)
+
+            # a source that has gone keeps its last thumbnail
+            os.remove(os.path.join(self.source_dir, 'portrait.jpg'))
+            self.assertEqual(self.client.get(url).status_code, 200)
+        finally:
+            del app.config['IMAGE_REFRESH_SECONDS']
+
+    def test_thumbnail_cached(self):
+        """Is the source fetched only once"""
+        with app.test_request_context():
+            url = thumbnail_url("https://example.com/img/portrait.jpg", 48)
+
+        self.client.get(url)
+        os.remove(os.path.join(self.source_dir, 'portrait.jpg'))
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+
+    def test_static_default(self):
+        """Can the default avatar be thumbnailed"""
+        with app.test_request_context():
+            url = thumbnail_url("/static/images/default-pic.png", 160)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_forged_token(self):
+        """Are unsigned source URLs rejected"""
+        resp = self.client.get('/images/96/not-a-real-token')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_decompression_bomb(self):
+        """Are sources that decode to too many pixels refused"""
+        out = BytesIO()
+        Image.new('1', (400, 300)).save(out, 'PNG')
+        data = out.getvalue()
+        self.assertIn('jpg', images.render_variants(data, 96))
+
+        with mock.patch.object(images, 'MAX_SOURCE_PIXELS', 100_000):
+            with self.assertRaisesRegex(ImageSourceError, "400x300"):
+                images.render_variants(data, 96)
+
+        # Pillow's own limits: an error past twice MAX_IMAGE_PIXELS, a
+        # warning (treated as one) past it
+        for limit in (1000, 100_000):
+            with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', limit):
+                with self.assertRaisesRegex(ImageSourceError, "too large"):
+                    images.render_variants(data, 96)
+
+    def test_missing_source(self):
+        """Does a missing source fall back to the original URL"""
+        with app.test_request_context():
+            url = thumbnail_url("https://example.com/img/gone.jpg", 48)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, "https://example.com/img/gone.jpg")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"secret")
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageFetchTestCase(TestCase):
+    """Test that sources on internal addresses are never fetched."""
+
+    def setUp(self):
+        app.config['IMAGE_SOURCE_DIR'] = None
+
+    def test_private_addresses_refused(self):
+        for url in ("http://127.0.0.1/a.png", "http://localhost/a.png",
+                    "http://10.1.2.3/a.png", "http://192.168.0.1/a.png",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://[::1]/a.png", "http://[::ffff:127.0.0.1]/a.png",
+                    "http://0.0.0.0/a.png", "ftp://example.com/a.png",
+                    "file:///etc/passwd"):
+            with self.subTest(url=url), app.app_context():
+                with self.assertRaises(ImageSourceError):
+                    images.fetch_source(url)
+
+    def test_connected_address_checked(self):
+        """Is the address actually connected to checked (DNS rebinding)"""
+        server = HTTPServer(('127.0.0.1', 0), _Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = f"http://rebound.example:{server.server_port}/a.png"
+
+        # the name looked public when checked, then resolved to loopback
+        loopback = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     ('127.0.0.1', server.server_port))]
+        with mock.patch.object(images, '_check_url'), \
+                mock.patch('socket.getaddrinfo', return_value=loopback), \
+                app.app_context():
+            with self.assertRaisesRegex(ImageSourceError, "127.0.0.1"):
+                images.fetch_source(url)
+
+    def test_redirect_checked(self):
+        handler = images._PublicRedirectHandler()
+        with self.assertRaises(ImageSourceError):
+            handler.redirect_request(None, None, 302, "Found", {},
+                                     "http://169.254.169.254/")
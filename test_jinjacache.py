@@ -0,0 +1,84 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jinjacache.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, create_app
+from config import TestingConfig
+import jinjacache
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JinjaCacheTestCase(TestCase):
+    """Test precompiling and warming templates."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        config = TestingConfig()
+        config.TEMPLATE_CACHE_DIR = self.tmp.name
+        self.config = config
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def compile(self):
+        fresh = create_app(self.config)
+        # the CLI runs against the current app context's app
+        with fresh.app_context():
+            return fresh.test_cli_runner().invoke(
+                args=['templates', 'compile'])
+
+    def test_compile_command(self):
+        result = self.compile()
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('home.html', result.output)
+        self.assertIn('users/detail.html', result.output)
+        # one bytecode file per template
+        self.assertEqual(len(os.listdir(self.tmp.name)),
+                         len(jinjacache.app_templates(app.jinja_env)))
+
+    def test_warm_loads_from_cache(self):
+        self.compile()
+
+        self.config.TEMPLATE_BYTECODE_CACHE = True
+        self.config.TEMPLATE_WARM = True
+        warmed = create_app(self.config)
+
+        self.assertEqual(len(warmed.jinja_env.cache),
+                         len(jinjacache.app_templates(warmed.jinja_env)))
+        bcc = warmed.jinja_env.bytecode_cache
+        self.assertEqual(bcc.directory, self.tmp.name)
+
+        with warmed.test_client() as client:
+            resp = client.get('/login')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_not_warmed_by_default(self):
+        fresh = create_app(self.config)
+
+        self.assertIsNone(fresh.jinja_env.bytecode_cache)
+        self.assertEqual(len(fresh.jinja_env.cache), 0)
@@ -0,0 +1,151 @@
+"""Like count tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likecounts.py
+
+
+from unittest import TestCase, mock
+
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import likecounts
+from readmodels import message_card
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeCountTestCase(TestCase):
+    """Test coalesced like counts and reconciliation."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        likecounts.counter.take()
+
+        self.client = app.test_client()
+
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        self.fans = [User.signup(username=f"fan{i}",
+                                 email=f"fan{i}@test.com",
+                                 password="testuser",
+                                 image_url=None)
+                     for i in range(3)]
+        db.session.commit()
+
+        self.msg = Message(text="Like me", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+        self.msg_id = self.msg.id
+
+    def tearDown(self):
+        app.config['LIKECOUNT_FLUSH_SECONDS'] = 0
+
+    def stored_count(self):
+        return db.session.scalar(
+            db.select(Message.like_count).where(Message.id == self.msg_id))
+
+    def like_as(self, user):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+            return c.post(f"/users/add_like/{self.msg_id}")
+
+    def test_coalesced_flush(self):
+        """Are likes held in memory, shown on cards, then flushed in one go"""
+        counter = likecounts.LikeCounter()
+        likecounts.counter, original = counter, likecounts.counter
+        try:
+            for _ in range(3):
+                counter.record(self.msg_id, 1)
+            counter.record(self.msg_id, -1)
+
+            self.assertEqual(self.stored_count(), 0)
+            self.assertEqual(message_card(self.msg_id).like_count, 2)
+
+            self.assertEqual(counter.flush(), 1)
+            db.session.expire_all()
+            self.assertEqual(self.stored_count(), 2)
+            self.assertEqual(counter.flushes, 1)
+            self.assertEqual(counter.flush(), 0)
+        finally:
+            likecounts.counter = original
+
+    def test_like_and_unlike(self):
+        """Do the like view's toggles keep like_count in step"""
+        app.config['LIKECOUNT_FLUSH_SECONDS'] = 0
+        for fan in self.fans:
+            self.like_as(fan)
+        self.assertEqual(self.stored_count(), 3)
+
+        self.like_as(self.fans[0])
+        self.assertEqual(self.stored_count(), 2)
+
+        # the flush bypasses the (test-long) session's identity map
+        db.session.expire_all()
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 2',
+                      resp.get_data(as_text=True))
+
+    def test_reconcile(self):
+        """Does reconcile repair counts that drifted from the likes table"""
+        for fan in self.fans[:2]:
+            db.session.add(Likes(user_id=fan.id, message_id=self.msg_id))
+        db.session.commit()
+        self.assertEqual(self.stored_count(), 0)
+
+        self.assertEqual(likecounts.reconcile(), 1)
+        self.assertEqual(self.stored_count(), 2)
+        self.assertEqual(likecounts.reconcile(), 0)
+
+    def test_reconcile_in_background(self):
+        db.session.add(Likes(user_id=self.fans[0].id, message_id=self.msg_id))
+        db.session.commit()
+
+        self.assertIsNone(likecounts.init_app(app))
+
+        app.config['LIKECOUNT_RECONCILE_SECONDS'] = 3600
+        # stop the thread after its first pass
+        likecounts._stop_reconciling.set()
+        try:
+            likecounts.init_app(app).join()
+        finally:
+            likecounts._stop_reconciling.clear()
+            app.config['LIKECOUNT_RECONCILE_SECONDS'] = None
+
+        db.session.expire_all()
+        self.assertEqual(self.stored_count(), 1)
+        self.assertEqual(likecounts._reconcile_with(app), 0)
+
+    def test_concurrent_like(self):
+        """Is losing a race to insert the same like not an error"""
+        db.session.add(Likes(user_id=self.fans[0].id, message_id=self.msg_id))
+        db.session.commit()
+
+        # as if another request inserted it after we checked
+        with mock.patch('flask_sqlalchemy.query.Query.first',
+                        return_value=None):
+            resp = self.like_as(self.fans[0])
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(likecounts.counter.pending(self.msg_id), 0)
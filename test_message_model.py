@@ -4,19 +4,18 @@
 #
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
-import os
-from unittest import TestCase
 from sqlalchemy import exc
 from sqlalchemy.orm.exc import NoResultFound
 
+from testdb import TransactionalTestCase
 from models import db, connect_db, Message, User, Likes
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+import testdb
+testdb.setup()
 
 
 # Now we can import app
@@ -33,16 +32,13 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(TransactionalTestCase):
     """Test models for messages."""
 
     def setUp(self):
         """Create test client, add sample data"""
-        db.session.rollback()
 
-        Message.query.delete()
-        User.query.delete()
-        Likes.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -5,17 +5,16 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
 
+from testdb import TransactionalTestCase
 from models import db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+import testdb
+testdb.setup()
 
 
 # Now we can import app
@@ -35,14 +34,13 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(TransactionalTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -168,3 +166,49 @@ class MessageViewTestCase(TestCase):
             self.assertIn("@testuser</a>", html)
 
 
+
+    def test_timeline_since(self):
+        """Does the since endpoint return only newer followed messages"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            u2 = User.signup(username="testuser2",
+                             email="test2@test.com",
+                             password="testuser",
+                             image_url=None)
+            u3 = User.signup(username="testuser3",
+                             email="test3@test.com",
+                             password="testuser",
+                             image_url=None)
+            db.session.commit()
+            self.testuser.following.append(u2)
+
+            old = Message(text="old", user_id=u2.id)
+            db.session.add(old)
+            db.session.commit()
+            new = Message(text="new", user_id=u2.id)
+            stranger = Message(text="stranger", user_id=u3.id)
+            db.session.add_all([new, stranger])
+            db.session.commit()
+
+            resp = c.get(f'/api/timeline/since?after={old.id}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m['text'] for m in resp.json['messages']],
+                             ["new"])
+            self.assertEqual(resp.json['latest'], new.id)
+
+            resp = c.get(f'/api/timeline/since/count?after={old.id}')
+            self.assertEqual(resp.json, {'count': 1, 'more': False})
+
+            resp = c.get(f'/api/timeline/since?after={new.id}')
+            self.assertEqual(resp.json['messages'], [])
+            self.assertEqual(resp.json['latest'], new.id)
+
+    def test_timeline_since_requires_after(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get('/api/timeline/since')
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,165 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+import metrics
+from metrics import Counter, Histogram, Registry, merge, render
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExpositionTestCase(TestCase):
+    """Test metric types, merging and the text format."""
+
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = self.registry.register(
+            Counter('hits_total', "Hits.", ('path',)))
+        self.histogram = self.registry.register(
+            Histogram('latency_seconds', "Latency.", buckets=(.1, 1)))
+
+    def test_render(self):
+        self.counter.inc('/a')
+        self.counter.inc('/a')
+        self.counter.inc('/"b"')
+        for value in (.05, .5, 5):
+            self.histogram.observe(value)
+
+        text = render(merge([(os.getpid(), self.registry.state())]))
+
+        self.assertIn('# TYPE hits_total counter', text)
+        self.assertIn('hits_total{path="/a"} 2', text)
+        self.assertIn(r'hits_total{path="/\"b\""} 1', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_sum 5.55', text)
+        self.assertIn('latency_seconds_count 3', text)
+
+    def test_merge_processes(self):
+        """Are counters summed across processes, and dead gauges dropped"""
+        self.counter.inc('/a')
+        self.histogram.observe(.5)
+        state = self.registry.state()
+        state['up'] = {'kind': 'gauge', 'help': "Up.", 'labelnames': (),
+                       'buckets': None, 'values': [[[], 1]]}
+
+        # above the kernel's pid_max, so never a live process
+        merged = merge([(os.getpid(), state), (2 ** 22 + 1, state)])
+
+        self.assertEqual(merged['hits_total']['values'], {('/a',): 2})
+        self.assertEqual(merged['latency_seconds']['values'][()],
+                         [0, 2, 0, 1.0])
+        self.assertEqual(merged['up']['values'], {(): 1})
+
+
+class MetricsViewTestCase(TestCase):
+    """Test the hooks and the /metrics endpoint."""
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+        metrics._metrics_dir = None
+
+    def test_request_metrics(self):
+        self.client.get('/login')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('warbler_http_requests_total'
+                      '{endpoint="views.login",method="GET",status="200"} 1',
+                      text)
+        self.assertIn('warbler_http_request_duration_seconds_count'
+                      '{endpoint="views.login"} 1', text)
+        self.assertIn('warbler_template_render_seconds_count'
+                      '{template="users/login.html"} 1', text)
+        self.assertIn('warbler_db_pool_connections', text)
+
+    def test_query_metrics(self):
+        self.client.get('/users')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('warbler_db_queries_total{endpoint="views.list_users"}',
+                      text)
+
+    def test_token(self):
+        app.config['METRICS_TOKEN'] = 'sekrit'
+
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        resp = self.client.get('/metrics',
+                               headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_dir(self):
+        """Does a scrape merge the state files in METRICS_DIR"""
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics._metrics_dir = tmp
+            other = Registry()
+            other.register(Counter('warbler_http_requests_total', "HTTP.",
+                                   ('endpoint', 'method', 'status'))
+                           ).inc('views.login', 'GET', '200', amount=5)
+            with open(os.path.join(tmp, 'metrics-1.json'), 'w') as f:
+                f.write(metrics.json.dumps({'pid': 1,
+                                            'metrics': other.state()}))
+
+            self.client.get('/login')
+            text = self.client.get('/metrics').get_data(as_text=True)
+
+            self.assertIn(f'metrics-{os.getpid()}.json', os.listdir(tmp))
+
+        self.assertIn('warbler_http_requests_total'
+                      '{endpoint="views.login",method="GET",status="200"} 6',
+                      text)
+
+    def test_dead_processes_retired(self):
+        """Are exited workers' files folded into one, keeping their counts"""
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics._metrics_dir = tmp
+            other = Registry()
+            other.register(Counter('warbler_http_requests_total', "HTTP.",
+                                   ('endpoint', 'method', 'status'))
+                           ).inc('views.login', 'GET', '200', amount=5)
+            # above the kernel's pid_max, and pid 1 since restarted
+            for pid, started in [(2 ** 22 + 1, None), (1, -1)]:
+                with open(os.path.join(tmp, f'metrics-{pid}.json'), 'w') as f:
+                    f.write(metrics.json.dumps({'pid': pid, 'started': started,
+                                                'metrics': other.state()}))
+
+            self.client.get('/login')
+            for _ in range(2):
+                text = self.client.get('/metrics').get_data(as_text=True)
+                self.assertIn('warbler_http_requests_total{endpoint='
+                              '"views.login",method="GET",status="200"} 11',
+                              text)
+
+            files = sorted(name for name in os.listdir(tmp)
+                           if name.endswith('.json'))
+            self.assertEqual(files, [f'metrics-{os.getpid()}.json',
+                                     'metrics-retired.json'])
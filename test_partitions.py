@@ -0,0 +1,204 @@
+"""Message partitioning tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import event
+
+from testdb import TransactionalTestCase
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+import partitions
+from partitions import (add_months, months, partition_name, partition_month,
+                        create_partition_sql, month_start)
+from readmodels import timeline_cards, user_message_cards
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+POSTGRES = db.engine.dialect.name == 'postgresql'
+
+
+class MonthsTestCase(TestCase):
+    """Test partition naming and ranges."""
+
+    def test_months(self):
+        self.assertEqual(add_months(date(2023, 11, 1), 3), date(2024, 2, 1))
+        self.assertEqual(list(months(date(2023, 12, 15), date(2024, 2, 2))),
+                         [date(2023, 12, 1), date(2024, 1, 1),
+                          date(2024, 2, 1)])
+
+    def test_names(self):
+        name = partition_name(date(2024, 5, 1))
+
+        self.assertEqual(name, 'messages_y2024m05')
+        self.assertEqual(partition_month(name), date(2024, 5, 1))
+        self.assertIsNone(partition_month('messages_default'))
+        self.assertIn("FROM ('2024-12-01') TO ('2025-01-01')",
+                      create_partition_sql(date(2024, 12, 1)))
+
+
+class RecentFirstTestCase(TransactionalTestCase):
+    """Test that windowed feed queries match unwindowed ones."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup(username="testuser", email="test@test.com",
+                                password="testuser", image_url=None)
+        db.session.flush()
+
+        now = datetime.utcnow()
+        ages = [1, 2, 40, 100, 400, 800]
+        db.session.add_all(
+            Message(text=f"{age} days old", user_id=self.user.id,
+                    timestamp=now - timedelta(days=age))
+            for age in ages)
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['MESSAGES_PARTITIONED'] = False
+
+    def test_same_results(self):
+        for limit in (1, 2, 3, 5, 6, 10):
+            app.config['MESSAGES_PARTITIONED'] = False
+            expected = [c.id for c in user_message_cards(self.user.id, limit)]
+            app.config['MESSAGES_PARTITIONED'] = True
+            self.assertEqual(
+                [c.id for c in user_message_cards(self.user.id, limit)],
+                expected)
+            self.assertEqual(
+                [c.id for c in timeline_cards([self.user.id], limit)],
+                expected)
+
+    def test_sparse_page_two_queries(self):
+        """Does a page the recent window can't fill take one more query"""
+        app.config['MESSAGES_PARTITIONED'] = True
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM messages' in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            cards = user_message_cards(self.user.id, 10)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(len(cards), 6)
+        self.assertEqual(len(statements), 2)
+
+    def test_timestamp_default(self):
+        # evaluated per row, not once at import
+        msg = Message(text="now", user_id=self.user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertLess(datetime.utcnow() - msg.timestamp,
+                        timedelta(minutes=1))
+
+
+@skipUnless(POSTGRES, "partitioning needs PostgreSQL (set TEST_DATABASE_URL)")
+class PartitionOperationsTestCase(TestCase):
+    """Test convert, ensure, archive and restore on PostgreSQL.
+
+    Everything, DDL included, runs in one transaction rolled back after
+    each test.
+    """
+
+    def setUp(self):
+        self.conn = db.engine.connect()
+        self.transaction = self.conn.begin()
+        self.conn.execute(db.delete(Likes))
+        self.conn.execute(db.delete(Message))
+
+        self.user_id = self.conn.execute(
+            db.insert(User).values(username="partitioned",
+                                   email="partitioned@test.com",
+                                   password="x")
+            .returning(User.id)).scalar()
+        self.today = datetime.utcnow().date()
+        self.old_month = add_months(month_start(self.today), -3)
+        self.recent_id = self.add_message(datetime.utcnow())
+        self.old_id = self.add_message(
+            datetime.combine(self.old_month, datetime.min.time())
+            + timedelta(days=10))
+
+        partitions.convert(self.conn, ahead=2)
+
+    def tearDown(self):
+        self.transaction.rollback()
+        self.conn.close()
+
+    def add_message(self, timestamp):
+        return self.conn.execute(
+            db.insert(Message).values(text="hi", user_id=self.user_id,
+                                      timestamp=timestamp)
+            .returning(Message.id)).scalar()
+
+    def message_ids(self):
+        return sorted(self.conn.execute(db.select(Message.id)).scalars())
+
+    def test_convert_and_ensure(self):
+        self.assertTrue(partitions.is_partitioned(self.conn))
+        this_month = month_start(self.today)
+        self.assertEqual(
+            sorted(partitions.existing_partitions(self.conn)),
+            list(months(self.old_month, add_months(this_month, 2))))
+        self.assertEqual(self.message_ids(),
+                         sorted([self.recent_id, self.old_id]))
+
+        # new rows still get ids, and land in their month
+        self.assertGreater(self.add_message(datetime.utcnow()),
+                           self.recent_id)
+
+        self.assertEqual(partitions.ensure(self.conn, ahead=3),
+                         [partition_name(add_months(this_month, 3))])
+        self.assertEqual(partitions.ensure(self.conn, ahead=3), [])
+
+    def test_delete_cascades(self):
+        """Does the trigger remove a deleted message's likes"""
+        self.conn.execute(db.insert(Likes).values(user_id=self.user_id,
+                                                  message_id=self.old_id))
+        self.conn.execute(db.delete(Message).where(Message.id == self.old_id))
+
+        self.assertEqual(self.conn.scalar(db.select(db.func.count())
+                                          .select_from(Likes)), 0)
+
+    def test_archive_and_restore(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = partitions.archive(self.conn, self.old_month, tmp)
+            self.assertTrue(os.path.exists(path))
+            self.assertNotIn(self.old_month,
+                             partitions.existing_partitions(self.conn))
+            self.assertEqual(self.message_ids(), [self.recent_id])
+
+            self.assertEqual(partitions.restore(self.conn, path),
+                             partition_name(self.old_month))
+
+        self.assertIn(self.old_month,
+                      partitions.existing_partitions(self.conn))
+        self.assertEqual(self.message_ids(),
+                         sorted([self.recent_id, self.old_id]))
@@ -0,0 +1,119 @@
+"""Request profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+from profiling import (HEADER, Sampler, collapsed, speedscope, make_token)
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplerTestCase(TestCase):
+    """Test stack sampling and output formats."""
+
+    def test_samples_current_thread(self):
+        sampler = Sampler(threading.get_ident(), interval=0.001)
+        sampler.start()
+        busy_loop(0.1)
+        stacks = sampler.stop()
+
+        self.assertTrue(stacks)
+        self.assertTrue(any(frame[0] == 'busy_loop'
+                            for stack in stacks for frame in stack))
+
+    def test_formats(self):
+        stacks = Counter({
+            (('main', 'app.py', 1), ('render', 'jinja.py', 2)): 3,
+            (('main', 'app.py', 1),): 1,
+        })
+
+        self.assertEqual(collapsed(stacks),
+                         "main (app.py:1) 1\n"
+                         "main (app.py:1);render (jinja.py:2) 3\n")
+
+        profile = speedscope(stacks, "GET /", 0.005)
+        self.assertEqual([f['name'] for f in profile['shared']['frames']],
+                         ['main', 'render'])
+        self.assertEqual(profile['profiles'][0]['samples'], [[0, 1], [0]])
+        self.assertEqual(profile['profiles'][0]['endValue'], 20)
+
+
+class ProfileRequestTestCase(TestCase):
+    """Test which requests get profiled."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['PROFILE_DIR'] = self.tmp.name
+        app.config['PROFILE_INTERVAL_MS'] = 1
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+        self.tmp.cleanup()
+
+    def files(self):
+        return sorted(os.listdir(self.tmp.name))
+
+    def test_signed_header(self):
+        with app.test_request_context():
+            token = make_token()
+
+        resp = self.client.get('/login', headers={HEADER: token})
+        self.assertEqual(resp.status_code, 200)
+
+        files = self.files()
+        self.assertEqual([f.split('.', 1)[1] for f in files],
+                         ['collapsed', 'meta.json', 'speedscope.json'])
+        self.assertIn(f"views_login-{os.getpid()}-", files[0])
+
+        meta_file = next(f for f in files if f.endswith('.meta.json'))
+        with open(os.path.join(self.tmp.name, meta_file)) as f:
+            meta = json.load(f)
+        self.assertEqual(meta['endpoint'], 'views.login')
+        self.assertEqual(meta['status'], 200)
+        self.assertIn('count', meta['queries'])
+
+    def test_bad_token_ignored(self):
+        self.client.get('/login', headers={HEADER: 'forged'})
+        self.assertEqual(self.files(), [])
+
+        self.client.get('/login')
+        self.assertEqual(self.files(), [])
+
+    def test_sample_rate(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 1
+        self.client.get('/login')
+        self.assertEqual(len(self.files()), 3)
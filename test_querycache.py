@@ -0,0 +1,261 @@
+"""Query-result cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_querycache.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import metrics
+import querycache
+from querycache import MemoryBackend, user_tag, message_tag
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def lookups(result):
+    counts = {tuple(labels): value
+              for labels, value in metrics.cache_requests.state()}
+    return counts.get(('query_test', result), 0)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test expiry, LRU eviction and tag versions."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = MemoryBackend(max_entries=2, clock=self.clock)
+
+    def test_ttl(self):
+        self.backend.set('a', 1, 10, {})
+        self.assertEqual(self.backend.get('a'), (True, 1))
+
+        self.clock.now += 10
+        self.assertEqual(self.backend.get('a'), (False, None))
+
+    def test_lru(self):
+        self.backend.set('a', 1, 10, {})
+        self.backend.set('b', 2, 10, {})
+        self.backend.get('a')
+        self.backend.set('c', 3, 10, {})
+
+        self.assertEqual(self.backend.get('b'), (False, None))
+        self.assertEqual(self.backend.get('a'), (True, 1))
+        self.assertEqual(len(self.backend), 2)
+
+    def test_invalidate(self):
+        self.backend.set('a', 1, 10, self.backend.versions(['user:1']))
+        self.backend.set('b', 2, 10, self.backend.versions(['user:2']))
+        self.backend.invalidate(['user:1'])
+
+        self.assertEqual(self.backend.get('a'), (False, None))
+        self.assertEqual(self.backend.get('b'), (True, 2))
+
+
+class CacheTestCase(TestCase):
+    """Test `get`: hits, racing invalidations and collapsed misses."""
+
+    def setUp(self):
+        querycache.reset()
+        app.config['QUERY_CACHE_TTL'] = 60
+
+    def tearDown(self):
+        app.config['QUERY_CACHE_TTL'] = 0
+        querycache.reset()
+
+    def test_hit_and_miss(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        misses = lookups('miss')
+        hits = lookups('hit')
+        self.assertEqual(querycache.get('test', (1,), compute), 1)
+        self.assertEqual(querycache.get('test', (1,), compute), 1)
+        self.assertEqual(querycache.get('test', (2,), compute), 2)
+
+        self.assertEqual(lookups('miss') - misses, 2)
+        self.assertEqual(lookups('hit') - hits, 1)
+
+    def test_disabled(self):
+        app.config['QUERY_CACHE_TTL'] = 0
+        calls = []
+        for _ in range(2):
+            querycache.get('test', (), lambda: calls.append(1))
+        self.assertEqual(len(calls), 2)
+
+    def test_invalidated_while_computing(self):
+        """A result computed across an invalidation isn't kept"""
+
+        def compute():
+            querycache.invalidate(user_tag(1))
+            return 'stale'
+
+        querycache.get('test', (), compute, [user_tag(1)])
+        self.assertEqual(
+            querycache.get('test', (), lambda: 'fresh', [user_tag(1)]),
+            'fresh')
+
+    def test_result_tag_invalidated_while_computing(self):
+        """Nor is one whose result tags were invalidated meanwhile"""
+
+        def compute():
+            querycache.invalidate(message_tag(3))
+            return [3]
+
+        def tags_of(ids):
+            return [message_tag(id) for id in ids]
+
+        querycache.get('test', (), compute, [], tags_of)
+        self.assertEqual(querycache.get('test', (), lambda: [4], [], tags_of),
+                         [4])
+
+    def test_result_tags(self):
+        querycache.get('test', (), lambda: [3], [],
+                       lambda ids: [message_tag(id) for id in ids])
+        querycache.invalidate(message_tag(3))
+        self.assertEqual(querycache.get('test', (), lambda: [], []), [])
+
+    def test_stampede(self):
+        """Concurrent misses for one key compute it once"""
+
+        calls = []
+        barrier = threading.Barrier(8)
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+
+        def request():
+            barrier.wait()
+            with app.app_context():
+                results.append(querycache.get('test', (), compute))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 8)
+
+
+class CachedViewsTestCase(TestCase):
+    """Test that the write views invalidate the pages they change."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        querycache.reset()
+        app.config['QUERY_CACHE_TTL'] = 60
+
+        self.client = app.test_client()
+        self.author = User.signup(username="author", email="a@test.com",
+                                  password="testuser", image_url=None)
+        self.reader = User.signup(username="reader", email="r@test.com",
+                                  password="testuser", image_url=None)
+        db.session.commit()
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+
+        self.msg = Message(text="Cached warble", user_id=self.author_id)
+        db.session.add(self.msg)
+        db.session.commit()
+        self.msg_id = self.msg.id
+
+    def tearDown(self):
+        app.config['QUERY_CACHE_TTL'] = 0
+        querycache.reset()
+        db.session.remove()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_cached_until_invalidated(self):
+        self.client.get(f"/messages/{self.msg_id}")
+
+        # a write that bypasses the views isn't seen...
+        Message.query.get(self.msg_id).text = "Changed behind our back"
+        db.session.commit()
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertIn(b"Cached warble", resp.data)
+
+        # ...until something invalidates the message
+        querycache.invalidate(message_tag(self.msg_id))
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertIn(b"Changed behind our back", resp.data)
+
+    def test_messages_add_and_destroy(self):
+        self.login(self.author_id)
+        self.client.get(f"/users/{self.author_id}")
+
+        self.client.post("/messages/new", data={"text": "Second warble"})
+        resp = self.client.get(f"/users/{self.author_id}")
+        self.assertIn(b"Second warble", resp.data)
+
+        self.client.post(f"/messages/{self.msg_id}/delete")
+        resp = self.client.get(f"/users/{self.author_id}")
+        self.assertNotIn(b"Cached warble", resp.data)
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_add_like(self):
+        self.login(self.reader_id)
+        self.client.get(f"/users/{self.reader_id}/likes")
+
+        self.client.post(f"/users/add_like/{self.msg_id}")
+        resp = self.client.get(f"/users/{self.reader_id}/likes")
+        self.assertIn(b"Cached warble", resp.data)
+
+    def test_profile(self):
+        """Renaming the author refreshes cards that show their name"""
+
+        self.login(self.reader_id)
+        self.client.post(f"/users/add_like/{self.msg_id}")
+        self.client.get(f"/users/{self.reader_id}/likes")
+
+        self.login(self.author_id)
+        self.client.post("/users/profile", data={
+            "username": "renamed", "email": "a@test.com",
+            "password": "testuser"})
+
+        resp = self.client.get(f"/users/{self.reader_id}/likes")
+        self.assertIn(b"renamed", resp.data)
@@ -0,0 +1,143 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+from unittest import TestCase
+
+from testdb import TransactionalTestCase
+from models import db, User
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, create_app
+import config
+import ratelimit
+from ratelimit import MemoryBackend, Policy, SLIDING_WINDOW
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test the token bucket and sliding window algorithms."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = MemoryBackend(clock=self.clock)
+
+    def test_token_bucket(self):
+        """Does a bucket allow a burst, then refill over time"""
+        policy = Policy('test', limit=3, per=30)
+
+        results = [self.backend.hit('k', policy).allowed for _ in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+
+        denied = self.backend.hit('k', policy)
+        self.assertEqual(denied.headers()['Retry-After'], '10')
+
+        self.clock.now += 10
+        self.assertTrue(self.backend.hit('k', policy).allowed)
+        self.assertFalse(self.backend.hit('k', policy).allowed)
+
+    def test_keys_independent(self):
+        policy = Policy('test', limit=1, per=60)
+
+        self.assertTrue(self.backend.hit('a', policy).allowed)
+        self.assertTrue(self.backend.hit('b', policy).allowed)
+        self.assertFalse(self.backend.hit('a', policy).allowed)
+
+    def test_sliding_window(self):
+        """Does the sliding window weigh in the previous window"""
+        policy = Policy('test', limit=4, per=60, algorithm=SLIDING_WINDOW)
+        self.clock.now = 60 * 100
+
+        for _ in range(4):
+            self.assertTrue(self.backend.hit('k', policy).allowed)
+        self.assertFalse(self.backend.hit('k', policy).allowed)
+
+        # halfway into the next window, half the old hits still count
+        self.clock.now += 90
+        self.assertTrue(self.backend.hit('k', policy).allowed)
+        self.assertTrue(self.backend.hit('k', policy).allowed)
+        self.assertFalse(self.backend.hit('k', policy).allowed)
+
+
+class RateLimitViewTestCase(TransactionalTestCase):
+    """Test route policies."""
+
+    def setUp(self):
+        super().setUp()
+        ratelimit.backend.reset()
+        ratelimit.rejections.clear()
+
+        self.client = app.test_client()
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        ratelimit.backend.reset()
+
+    def test_login_limited(self):
+        """Are repeated login attempts throttled with a 429"""
+        data = {'username': 'testuser', 'password': 'wrong-password'}
+        for _ in range(10):
+            resp = self.client.post('/login', data=data)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('RateLimit-Remaining', resp.headers)
+
+        resp = self.client.post('/login', data=data)
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp.headers)
+        self.assertEqual(ratelimit.rejections['login'], 1)
+
+        # viewing the form isn't limited
+        self.assertEqual(self.client.get('/login').status_code, 200)
+
+    def test_disabled(self):
+        app.config['RATELIMIT_ENABLED'] = False
+        try:
+            for _ in range(12):
+                resp = self.client.post('/login', data={})
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['RATELIMIT_ENABLED'] = True
+
+    def test_behind_proxy(self):
+        """Are clients behind a trusted proxy limited separately"""
+        profile = config.TestingConfig()
+        profile.TRUSTED_PROXIES = 1
+        client = create_app(profile).test_client()
+
+        def login(address):
+            return client.post('/login', data={},
+                               headers={'X-Forwarded-For': address})
+
+        for _ in range(10):
+            self.assertEqual(login('203.0.113.1').status_code, 200)
+        self.assertEqual(login('203.0.113.1').status_code, 429)
+        self.assertEqual(login('203.0.113.2').status_code, 200)
@@ -0,0 +1,119 @@
+"""Read model (card) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+
+from datetime import datetime, timedelta
+
+from testdb import TransactionalTestCase
+from models import db, User, Message
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+from readmodels import (USER_CARD_COLUMNS, MessageCard, UserCard,
+                        message_card, timeline_cards, user_card_from_row,
+                        following_count, follower_count, is_following)
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReadModelTestCase(TransactionalTestCase):
+    """Test that cards carry the same data as the ORM objects."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup(username="alice", email="alice@test.com",
+                                 password="testuser",
+                                 image_url="/static/images/alice.png")
+        self.bob = User.signup(username="bob", email="bob@test.com",
+                               password="testuser", image_url=None)
+        self.alice.bio = "Hi, I'm Alice"
+        db.session.commit()
+
+        start = datetime(2023, 1, 1)
+        self.messages = [
+            Message(text=f"message {i}", user_id=user.id,
+                    timestamp=start + timedelta(hours=i))
+            for i, user in enumerate([self.alice, self.bob, self.alice])]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+    def assertUserCard(self, card, user):
+        self.assertIsInstance(card, UserCard)
+        self.assertEqual(
+            (card.id, card.username, card.image_url, card.header_image_url,
+             card.bio),
+            (user.id, user.username, user.image_url, user.header_image_url,
+             user.bio))
+
+    def assertMessageCard(self, card, msg):
+        self.assertIsInstance(card, MessageCard)
+        self.assertEqual(
+            (card.id, card.text, card.timestamp, card.like_count),
+            (msg.id, msg.text, msg.timestamp, msg.like_count))
+        self.assertUserCard(card.user, msg.user)
+
+    def test_user_card_from_row(self):
+        row = db.session.execute(
+            db.select(*USER_CARD_COLUMNS).where(User.id == self.alice.id)
+        ).one()
+        card = user_card_from_row(row)
+
+        self.assertUserCard(card, self.alice)
+        self.assertEqual(card, self.alice)
+        self.assertNotEqual(card, self.bob)
+
+    def test_message_card(self):
+        msg = self.messages[0]
+        card = message_card(msg.id)
+
+        self.assertMessageCard(card, msg)
+        self.assertEqual(card, msg)
+        self.assertIsNone(message_card(msg.id + 1000))
+
+        with self.assertRaises(AttributeError):
+            card.text = "edited"
+
+    def test_timeline_cards_match_orm(self):
+        """Does the timeline return what the ORM query would, newest first"""
+        user_ids = [self.alice.id, self.bob.id]
+        cards = timeline_cards(user_ids)
+        expected = (Message.query
+                    .filter(Message.user_id.in_(user_ids))
+                    .order_by(Message.timestamp.desc())
+                    .all())
+
+        self.assertEqual([card.id for card in cards],
+                         [msg.id for msg in expected])
+        for card, msg in zip(cards, expected):
+            self.assertMessageCard(card, msg)
+
+        self.assertEqual([card.text for card in timeline_cards([self.bob.id])],
+                         ["message 1"])
+        self.assertEqual(len(timeline_cards(user_ids, limit=2)), 2)
+
+    def test_follow_counts(self):
+        self.alice.following.append(self.bob)
+        db.session.commit()
+
+        self.assertEqual(following_count(self.alice.id), 1)
+        self.assertEqual(follower_count(self.alice.id), 0)
+        self.assertEqual(follower_count(self.bob.id), 1)
+        self.assertTrue(is_following(self.alice.id, self.bob.id))
+        self.assertFalse(is_following(self.bob.id, self.alice.id))
@@ -0,0 +1,157 @@
+"""Realtime timeline (SSE) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_realtime.py
+
+
+from unittest import TestCase
+
+from testdb import TransactionalTestCase
+from models import db, User, Message
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from realtime import LocalBroker, broker, user_channel, timeline_stream
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BrokerTestCase(TestCase):
+    """Test the in-process pub/sub."""
+
+    def test_publish_subscribe(self):
+        """Do subscribers get events from their channels only"""
+        local = LocalBroker()
+        sub = local.subscribe(['user:1', 'user:2'])
+
+        local.publish('user:1', (1, 'a'))
+        local.publish('user:3', (2, 'b'))
+
+        self.assertEqual(sub.drain(0), ([(1, 'a')], False))
+
+        local.unsubscribe(sub)
+        self.assertEqual(local.publish('user:1', (3, 'c')), 0)
+
+    def test_overflow(self):
+        """Does a full buffer report an overflow instead of stale events"""
+        local = LocalBroker()
+        sub = local.subscribe(['user:1'], maxlen=2)
+        for i in range(3):
+            local.publish('user:1', (i, 'x'))
+
+        self.assertEqual(sub.drain(0), ([], True))
+        self.assertEqual(sub.drain(0), ([], False))
+
+
+class TimelineStreamTestCase(TransactionalTestCase):
+    """Test the SSE endpoint and publishing."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        db.session.commit()
+        self.testuser.following.append(self.author)
+        db.session.commit()
+
+        app.config['REALTIME_MAX_AGE'] = 0
+
+    def test_publish_on_add(self):
+        """Does posting a message push it to followers' streams"""
+        sub = broker.subscribe([user_channel(self.author.id)])
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.author.id
+                c.post("/messages/new", data={"text": "Hot off the press"})
+        finally:
+            broker.unsubscribe(sub)
+
+        events, _ = sub.drain(0)
+        self.assertEqual(len(events), 1)
+        message_id, data = events[0]
+        self.assertEqual(data['id'], message_id)
+        self.assertIn("Hot off the press", data['html'])
+
+    def test_resume_from_last_event_id(self):
+        """Are missed messages replayed after Last-Event-ID"""
+        old = Message(text="seen", user_id=self.author.id)
+        db.session.add(old)
+        db.session.commit()
+        new = Message(text="missed", user_id=self.author.id)
+        db.session.add(new)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get('/api/timeline/stream',
+                         headers={'Last-Event-ID': str(old.id)})
+            body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertIn(f"id: {new.id}\n", body)
+        self.assertIn("missed", body)
+        self.assertNotIn("seen", body)
+
+    def test_late_commit_not_dropped(self):
+        """Is a message published after one with a higher id still sent"""
+        with app.test_request_context():
+            stream = timeline_stream(self.testuser.id, heartbeat=0.01)
+            next(stream)
+
+            channel = user_channel(self.author.id)
+            broker.publish(channel, (1002, {'id': 1002, 'html': 'later id'}))
+            broker.publish(channel, (1001, {'id': 1001, 'html': 'earlier id'}))
+            broker.publish(channel, (1002, {'id': 1002, 'html': 'later id'}))
+            sent = [next(stream), next(stream)]
+            stream.close()
+
+        self.assertTrue(sent[0].startswith("id: 1002\n"))
+        self.assertTrue(sent[1].startswith("id: 1001\n"))
+
+    def test_resume_catches_late_commits(self):
+        """Does a resume look back for messages that committed late"""
+        late = Message(text="committed late", user_id=self.author.id)
+        db.session.add(late)
+        db.session.commit()
+        last = Message(text="already shown", user_id=self.author.id)
+        db.session.add(last)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            body = c.get('/api/timeline/stream',
+                         headers={'Last-Event-ID': str(last.id)}
+                         ).get_data(as_text=True)
+
+        self.assertIn(f"id: {late.id}\n", body)
+        self.assertNotIn(f"id: {last.id}\n", body)
+
+    def test_stream_logged_out(self):
+        resp = self.client.get('/api/timeline/stream')
+        self.assertEqual(resp.status_code, 401)
@@ -0,0 +1,240 @@
+"""Message sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from models import (db, User, Message, Likes, MessageTag, Mention,
+                    MessageViewers)
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, create_app, CURR_USER_KEY
+import config
+import sharding
+import viewers
+from readmodels import (timeline_cards, timeline_cards_since,
+                        timeline_count_since, tag_message_cards,
+                        message_count, liked_message_cards)
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_SHARDS = 3
+
+
+class ShardingTestCase(TestCase):
+    """Test placement, routing and scatter-gather across SQLite shards."""
+
+    def setUp(self):
+        Likes.query.delete()
+        MessageTag.query.delete()
+        MessageViewers.query.delete()
+        Mention.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        settings = config.TestingConfig()
+        settings.MESSAGE_SHARDS = [
+            f"sqlite:///{os.path.join(self.tmp.name, f'shard{i}.db')}"
+            for i in range(NUM_SHARDS)]
+        self.app = create_app(settings)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        self.shards = sharding.shards()
+        self.shards.create_all()
+
+        self.users = [User.signup(username=f"user{i}",
+                                  email=f"user{i}@test.com",
+                                  password="testuser", image_url=None)
+                      for i in range(4)]
+        db.session.commit()
+        self.ids = [u.id for u in self.users]
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+        for engine in self.shards.engines:
+            engine.dispose()
+        self.tmp.cleanup()
+
+    def post(self, user_id, text, age=0):
+        id = sharding.add_message(user_id, text,
+                                  datetime.utcnow() - timedelta(minutes=age))
+        db.session.commit()
+        return id
+
+    def shard_ids(self, index):
+        return [row[0] for row in self.shards.execute(
+            index, db.select(sharding.messages.c.id))]
+
+    def test_placement(self):
+        ids = [self.post(user_id, "hi") for user_id in self.ids]
+
+        self.assertEqual(ids, sorted(ids))
+        for user_id, id in zip(self.ids, ids):
+            index = user_id % NUM_SHARDS
+            self.assertEqual(id % NUM_SHARDS, index)
+            self.assertIn(id, self.shard_ids(index))
+        self.assertEqual(db.session.scalar(
+            db.select(db.func.count()).select_from(Message)), 0)
+
+    def test_timeline_merge(self):
+        posted = {}
+        for age in range(12):
+            user_id = self.ids[age % 4]
+            posted[self.post(user_id, f"{age} minutes ago", age)] = age
+
+        cards = timeline_cards(self.ids, limit=5)
+        self.assertEqual([c.text for c in cards],
+                         [f"{age} minutes ago" for age in range(5)])
+
+        newest_first = sorted(posted, key=posted.get)
+        since = timeline_cards_since(self.ids, newest_first[6], limit=100)
+        self.assertEqual([c.id for c in since],
+                         sorted(i for i in posted if i > newest_first[6]))
+        self.assertEqual(timeline_count_since(self.ids, 0, cap=7), 7)
+        self.assertEqual(message_count(self.ids[0]), 3)
+
+    def test_routes(self):
+        author, liker = self.ids[0], self.ids[1]
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = author
+
+        resp = client.post("/messages/new", data={"text": "Sharded #yes"})
+        self.assertEqual(resp.status_code, 302)
+        id, = self.shard_ids(author % NUM_SHARDS)
+
+        resp = client.get(f"/messages/{id}")
+        self.assertIn(b"Sharded", resp.data)
+        resp = client.get(f"/users/{author}")
+        self.assertIn(b"Sharded", resp.data)
+        self.assertEqual([c.id for c in tag_message_cards('yes')[0]], [id])
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = liker
+        client.post(f"/users/add_like/{id}")
+        self.assertEqual([c.like_count for c in liked_message_cards(liker)],
+                         [1])
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = author
+        resp = client.post(f"/messages/{id}/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.shard_ids(author % NUM_SHARDS), [])
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(MessageTag.query.count(), 0)
+
+    def test_delete_user(self):
+        """Are a deleted user's messages' likes and index rows removed"""
+        author, liker = self.ids[0], self.ids[1]
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = author
+        client.post("/messages/new",
+                    data={"text": "Sharded #yes @user2"})
+        id, = self.shard_ids(author % NUM_SHARDS)
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = liker
+        client.post(f"/users/add_like/{id}")
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Mention.query.count(), 1)
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = author
+        resp = client.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(self.shard_ids(author % NUM_SHARDS), [])
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+        self.assertEqual(liked_message_cards(liker), [])
+
+    def test_viewers_of_deleted_messages_dropped(self):
+        id = self.post(self.ids[0], "Seen")
+        counter = viewers.ViewerCounter()
+        counter.record(id, "user:1")
+        counter.record(id + NUM_SHARDS, "user:1")
+
+        self.assertEqual(counter.flush(), 1)
+        self.assertEqual([row.message_id for row in MessageViewers.query],
+                         [id])
+
+    def test_migrate(self):
+        old = Message(text="from before", user_id=self.ids[2])
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+        db.session.add(Likes(user_id=self.ids[0], message_id=old_id))
+        db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['shards', 'migrate'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        new_id = old_id * NUM_SHARDS + self.ids[2] % NUM_SHARDS
+        self.assertEqual(self.shard_ids(self.ids[2] % NUM_SHARDS), [new_id])
+        self.assertEqual(Likes.query.one().message_id, new_id)
+
+        # new messages sort after migrated ones
+        self.assertGreater(self.post(self.ids[2], "after"), new_id)
+
+    def test_migrate_renumbers_without_collisions(self):
+        """Do renumbered likes never clash with ones not yet renumbered"""
+        old = [Message(text=f"old {i}", user_id=self.ids[i % 2])
+               for i in range(6)]
+        db.session.add_all(old)
+        db.session.commit()
+        expected = sorted(msg.id * NUM_SHARDS + msg.user_id % NUM_SHARDS
+                          for msg in old)
+        db.session.add_all(MessageViewers(message_id=msg.id, sketch=b'')
+                           for msg in old)
+        db.session.add_all(Likes(user_id=self.ids[3], message_id=msg.id)
+                           for msg in old)
+        db.session.commit()
+
+        # fail after the shard copy, as if the process died
+        runner = self.app.test_cli_runner()
+        with mock.patch.object(sharding, '_advance_allocator',
+                               side_effect=RuntimeError):
+            result = runner.invoke(args=['shards', 'migrate'])
+        self.assertNotEqual(result.exit_code, 0)
+        db.session.rollback()
+
+        result = runner.invoke(args=['shards', 'migrate'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertEqual(sorted(like.message_id for like in Likes.query),
+                         expected)
+        self.assertEqual(sorted(row.message_id
+                                for row in MessageViewers.query), expected)
+        self.assertEqual(sorted(id for index in range(NUM_SHARDS)
+                                for id in self.shard_ids(index)), expected)
+
+        # and again, with nothing left to move
+        result = runner.invoke(args=['shards', 'migrate'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(sorted(like.message_id for like in Likes.query),
+                         expected)
@@ -0,0 +1,125 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+import slowlog
+from slowlog import normalize, fingerprint, params_shape, aggregate, read_log
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FingerprintTestCase(TestCase):
+    """Test statement normalization."""
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT *  FROM users\nWHERE id IN (%(id_1_1)s, "
+                      "%(id_1_2)s) AND name = 'o''neil' LIMIT 10"),
+            "SELECT * FROM users WHERE id IN (...) AND name = ? LIMIT ?")
+        self.assertEqual(normalize("SELECT x::int FROM t WHERE a = :a"),
+                         "SELECT x::int FROM t WHERE a = ?")
+
+    def test_in_lists_share_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT 1 FROM t WHERE id IN (?, ?)"),
+                         fingerprint("SELECT 1 FROM t WHERE id IN (?, ?, ?)"))
+        self.assertNotEqual(fingerprint("SELECT a FROM t"),
+                            fingerprint("SELECT b FROM t"))
+
+    def test_explainable(self):
+        self.assertTrue(slowlog.explainable("SELECT id FROM users"))
+        self.assertTrue(slowlog.explainable(
+            "WITH t AS (SELECT updated_at FROM users) SELECT * FROM t"))
+        self.assertFalse(slowlog.explainable(
+            "SELECT * FROM message_viewers WHERE message_id IN (?) "
+            "FOR UPDATE"))
+        self.assertFalse(slowlog.explainable("SELECT 1 FOR KEY SHARE"))
+        self.assertFalse(slowlog.explainable(
+            "WITH gone AS (DELETE FROM likes RETURNING *) SELECT * FROM gone"))
+        self.assertFalse(slowlog.explainable("DELETE FROM likes"))
+
+    def test_params_shape(self):
+        self.assertEqual(params_shape({'id': 1, 'ids': [1, 2]}),
+                         {'id': 'int', 'ids': 'list[2]'})
+        self.assertEqual(params_shape([('a',), ('b',)], executemany=True),
+                         {'executemany': 2, 'row': ['str']})
+
+
+class SlowLogTestCase(TestCase):
+    """Test recording, EXPLAIN capture and the report."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'slow.jsonl')
+        slowlog.recent.clear()
+        slowlog._settings.update(threshold_ms=0, explain_rate=1,
+                                 path=self.path)
+
+    def tearDown(self):
+        slowlog._settings.update(threshold_ms=None, explain_rate=0, path=None)
+        self.tmp.cleanup()
+
+    def test_records_route_and_plan(self):
+        with app.test_client() as client:
+            client.get('/users?q=nobody')
+
+        entries = [e for e in read_log(self.path)
+                   if e['endpoint'] == 'views.list_users']
+        self.assertTrue(entries)
+        self.assertEqual(entries[0]['path'], '/users')
+        self.assertTrue(entries[0]['plan'])
+        self.assertNotIn('nobody', str(entries[0]['params']))
+
+        # EXPLAINs are never logged themselves
+        self.assertFalse(any(e['statement'].startswith('EXPLAIN')
+                             for e in slowlog.recent))
+
+    def test_failed_explain_keeps_transaction(self):
+        """Is a failed EXPLAIN reported without breaking the caller"""
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1")
+            plan = slowlog._explain(conn, "SELECT * FROM no_such_table", ())
+            self.assertTrue(plan.startswith("EXPLAIN failed"))
+            self.assertEqual(conn.exec_driver_sql("SELECT 2").scalar(), 2)
+
+    def test_report(self):
+        for _ in range(3):
+            db.session.execute(db.select(User.id).where(User.id.in_([1, 2])))
+        db.session.rollback()
+
+        groups = aggregate(read_log(self.path))
+        group = next(g for g in groups if 'users.id IN (...)' in g['normalized'])
+        self.assertEqual(group['count'], 3)
+        self.assertEqual(group['routes'], {'(no request)': 3})
+
+        runner = app.test_cli_runner()
+        app.config['SLOW_QUERY_LOG'] = self.path
+        try:
+            result = runner.invoke(args=['slowlog', 'report'])
+        finally:
+            app.config['SLOW_QUERY_LOG'] = None
+        self.assertIn(group['fingerprint'], result.output)
+        self.assertIn('3 calls', result.output)
@@ -0,0 +1,123 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+from unittest import TestCase
+
+from testdb import TransactionalTestCase
+from models import db, User, Message
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from readmodels import tag_message_cards, mention_message_cards
+from tags import extract_tags, extract_mentions, linkify, backfill
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExtractTestCase(TestCase):
+    """Test tokenizing message text."""
+
+    def test_extract(self):
+        text = "#Flask and #flask, @Alice says hi to bob@example.com #py3"
+
+        self.assertEqual(extract_tags(text), ['flask', 'py3'])
+        self.assertEqual(extract_mentions(text), ['alice'])
+
+    def test_linkify_escapes(self):
+        html = linkify("<b>it's</b> #Fun @bob")
+
+        self.assertIn("&lt;b&gt;it&#39;s&lt;/b&gt;", html)
+        self.assertIn('<a href="/tags/fun">#Fun</a>', html)
+        self.assertIn('<a href="/users?q=bob">@bob</a>', html)
+        self.assertNotIn('/tags/39', html)
+
+
+class TagIndexTestCase(TransactionalTestCase):
+    """Test indexing on post, the feeds and the backfill."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.friend = User.signup(username="friend",
+                                  email="friend@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        db.session.commit()
+
+    def post(self, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            return c.post("/messages/new", data={"text": text})
+
+    def test_post_indexes(self):
+        self.post("Hello @Friend #Warbler")
+        self.post("Nothing to see here")
+
+        cards, next_before = tag_message_cards('warbler')
+        self.assertEqual([c.text for c in cards], ["Hello @Friend #Warbler"])
+        self.assertIsNone(next_before)
+
+        cards, _ = mention_message_cards(self.friend.id)
+        self.assertEqual(len(cards), 1)
+
+        resp = self.client.get("/tags/WARBLER")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<a href="/tags/warbler">#Warbler</a>',
+                      resp.get_data(as_text=True))
+
+        resp = self.client.get(f"/users/{self.friend.id}/mentions")
+        self.assertIn("Hello", resp.get_data(as_text=True))
+
+    def test_pages(self):
+        for i in range(5):
+            self.post(f"Number {i} #count")
+
+        cards, next_before = tag_message_cards('count', limit=2)
+        self.assertEqual([c.text for c in cards], ["Number 4 #count",
+                                                   "Number 3 #count"])
+
+        cards, next_before = tag_message_cards('count', next_before, limit=2)
+        self.assertEqual([c.text for c in cards], ["Number 2 #count",
+                                                   "Number 1 #count"])
+
+        cards, next_before = tag_message_cards('count', next_before, limit=2)
+        self.assertEqual([c.text for c in cards], ["Number 0 #count"])
+        self.assertIsNone(next_before)
+
+    def test_backfill(self):
+        for i in range(5):
+            db.session.add(Message(text=f"Old #news for @friend {i}",
+                                   user_id=self.testuser.id))
+        db.session.commit()
+        self.assertEqual(tag_message_cards('news'), ([], None))
+
+        self.assertEqual(backfill(batch_size=2), 5)
+        # running it again doesn't duplicate anything
+        self.assertEqual(backfill(batch_size=2), 5)
+
+        self.assertEqual(len(tag_message_cards('news')[0]), 5)
+        self.assertEqual(len(mention_message_cards(self.friend.id)[0]), 5)
@@ -0,0 +1,83 @@
+"""Test database helper tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_testdb.py
+
+
+import os
+import unittest
+from unittest import TestCase, mock
+
+from models import db, User
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DatabaseURLTestCase(TestCase):
+    """Test per-worker database URLs."""
+
+    def url(self, **env):
+        with mock.patch.dict(os.environ, env):
+            for name in ('TEST_DATABASE_URL', 'PYTEST_XDIST_WORKER',
+                         'WARBLER_TEST_WORKER'):
+                if name not in env:
+                    os.environ.pop(name, None)
+            return testdb.database_url()
+
+    def test_default_sqlite_per_worker(self):
+        self.assertTrue(self.url().endswith('warbler-test-main.db'))
+        self.assertTrue(self.url(PYTEST_XDIST_WORKER='gw3')
+                        .endswith('warbler-test-gw3.db'))
+
+    def test_postgres_per_worker(self):
+        self.assertEqual(
+            self.url(TEST_DATABASE_URL='postgresql:///warbler-test',
+                     WARBLER_TEST_WORKER='2'),
+            'postgresql:///warbler-test-2')
+
+    def test_memory_is_shared(self):
+        self.assertEqual(self.url(TEST_DATABASE_URL='sqlite://',
+                                  PYTEST_XDIST_WORKER='gw1'), 'sqlite://')
+
+
+class TransactionalTestCaseTestCase(TestCase):
+    """Test that TransactionalTestCase leaves nothing behind."""
+
+    def test_rolled_back(self):
+        class Inner(testdb.TransactionalTestCase):
+            def test_commit(self):
+                db.session.add(User(username="ghost", email="g@test.com",
+                                    password="HASHED_PASSWORD"))
+                db.session.commit()
+
+                # a failed flush only undoes its own savepoint
+                db.session.add(User(username="ghost", email="g@test.com",
+                                    password="HASHED_PASSWORD"))
+                with self.assertRaises(Exception):
+                    db.session.commit()
+                db.session.rollback()
+                self.assertEqual(User.query.count(), 1)
+
+        result = unittest.TestResult()
+        unittest.defaultTestLoader.loadTestsFromTestCase(Inner).run(result)
+
+        self.assertTrue(result.wasSuccessful(), result.errors + result.failures)
+        self.assertEqual(
+            User.query.filter_by(username="ghost").count(), 0)
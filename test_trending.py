@@ -0,0 +1,197 @@
+"""Trending counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from models import db, User, Message
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import trending
+from trending import CountMinSketch, TopK, Trending
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SketchTestCase(TestCase):
+    """Test the count-min sketch and top-K heap."""
+
+    def test_never_undercounts(self):
+        sketch = CountMinSketch(width=64, depth=3)
+        exact = {}
+        for i in range(2000):
+            key = str(i % 300)
+            sketch.add(key)
+            exact[key] = exact.get(key, 0) + 1
+
+        for key, count in exact.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+        self.assertEqual(sketch.total, 2000)
+
+    def test_top_k(self):
+        top = TopK(k=2)
+        for key, count in [('a', 1), ('b', 5), ('c', 3), ('a', 2), ('d', 4)]:
+            top.offer(key, count)
+
+        self.assertEqual(sorted(top), ['b', 'd'])
+
+
+class TrendingTestCase(TestCase):
+    """Test decayed rankings and snapshots."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.trending = Trending(clock=self.clock, half_life=600)
+
+    def test_ranks_by_likes(self):
+        for message_id, likes in [(1, 3), (2, 5), (3, 1)]:
+            for _ in range(likes):
+                self.trending.record_like(message_id, 99)
+
+        self.assertEqual([id for id, _ in self.trending.top_messages(2)],
+                         [2, 1])
+        self.assertEqual(self.trending.top_users(), [(99, 9)])
+
+    def test_decay(self):
+        """Do recent likes outrank more numerous older ones"""
+        for _ in range(4):
+            self.trending.record_like(1, 99)
+
+        self.clock.now += 1800
+        for _ in range(2):
+            self.trending.record_like(2, 99)
+
+        self.assertEqual([id for id, _ in self.trending.top_messages()],
+                         [2, 1])
+
+    def test_old_buckets_expire(self):
+        self.trending.record_post(5)
+        self.clock.now += trending.BUCKET_SECONDS * trending.NUM_BUCKETS
+
+        self.assertEqual(self.trending.top_users(), [])
+
+    def test_snapshot_restore(self):
+        self.trending.record_like(7, 8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trending.json')
+            self.trending.snapshot(path)
+
+            restored = Trending(clock=self.clock, half_life=600)
+            self.assertTrue(restored.restore(path))
+
+        self.assertEqual(restored.top_messages(), [(7, 1)])
+        self.assertFalse(restored.restore(path))
+
+    def test_snapshots_merge(self):
+        """Do workers sharing a snapshot path each add their own counts"""
+        other = Trending(clock=self.clock, half_life=600)
+        self.trending.record_like(7, 8)
+        other.record_like(7, 9)
+        other.record_like(5, 9)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trending.json')
+            self.trending.snapshot(path)
+            other.snapshot(path)
+            # nothing new to add: snapshotting again doesn't double count
+            other.snapshot(path)
+
+            restored = Trending(clock=self.clock, half_life=600)
+            self.assertTrue(restored.restore(path))
+
+        self.assertEqual(restored.top_messages(), [(7, 2), (5, 1)])
+        self.assertEqual(sorted(restored.top_users()), [(8, 1), (9, 2)])
+
+    def test_failed_snapshot_kept(self):
+        self.trending.record_like(7, 8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trending.json')
+            with mock.patch('os.replace', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    self.trending.snapshot(path)
+            self.trending.snapshot(path)
+
+            restored = Trending(clock=self.clock, half_life=600)
+            restored.restore(path)
+
+        self.assertEqual(restored.top_messages(), [(7, 1)])
+
+
+class TrendingViewsTestCase(TestCase):
+    """Test that likes and posts feed /trending."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        trending.reset()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        db.session.commit()
+
+        self.msg = Message(text="Everyone likes this", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+    def test_like_trends(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post(f"/users/add_like/{self.msg.id}")
+
+            resp = c.get("/trending")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Everyone likes this", html)
+            self.assertIn("@testuser", html)
+
+            data = c.get("/api/trending").json
+            self.assertEqual(data['messages'][0]['id'], self.msg.id)
+            self.assertEqual(data['users'][0]['id'], self.testuser.id)
+
+    def test_post_counts_as_activity(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+            c.post("/messages/new", data={"text": "Busy day"})
+
+        self.assertEqual([id for id, _ in trending.top_users()],
+                         [self.author.id])
@@ -5,17 +5,16 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
 
+from testdb import TransactionalTestCase
 from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+import testdb
+testdb.setup()
 
 
 # Now we can import app
@@ -32,16 +31,13 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionalTestCase):
     """Test models for user."""
 
     def setUp(self):
         """Create test client, add sample data."""
-        # db.session.rollback()
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -5,23 +5,23 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
 
+from testdb import TransactionalTestCase
 from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+import testdb
+testdb.setup()
 
 
 # Now we can import app
 
 from app import app
 from app import app, CURR_USER_KEY
+from readmodels import followers_page
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 # Create our tables (we do this here, so we only create the tables
@@ -33,14 +33,13 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(TransactionalTestCase):
     """Test views for users."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -137,4 +136,50 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Access unauthorized.', html)
-            
\ No newline at end of file
+            
+
+    def test_api_followers_pages(self):
+        """Do follower listings page through follows with a cursor"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            u3 = User.signup(username="testuser3",
+                            email="test3@test.com",
+                            password="testuser",
+                            image_url=None)
+            db.session.commit()
+            self.testuser2.followers.append(self.testuser)
+            db.session.commit()
+            self.testuser2.followers.append(u3)
+            db.session.commit()
+
+            first, cursor = followers_page(self.testuser2.id, limit=1)
+            second, end = followers_page(self.testuser2.id, cursor, limit=1)
+
+            self.assertEqual([u.username for u in first], ["testuser3"])
+            self.assertEqual([u.username for u in second], ["testuser"])
+            self.assertIsNone(end)
+
+            resp = c.get(f'/api/users/{self.testuser2.id}/followers')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.json['users']), 2)
+            self.assertIsNone(resp.json['next'])
+
+    def test_follow_counts_and_button(self):
+        """Does the profile header show follow counts and the follow state"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            self.testuser.following.append(self.testuser2)
+            db.session.commit()
+
+            resp = c.get(f'/users/{self.testuser2.id}/followers')
+            html = resp.get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{self.testuser2.id}/followers">1</a>',
+                          html)
+            self.assertIn(f'<a href="/users/{self.testuser2.id}/following">0</a>',
+                          html)
+            self.assertIn('Unfollow', html)
@@ -0,0 +1,174 @@
+"""Unique-viewer count tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_viewers.py
+
+
+from unittest import TestCase, mock
+
+from models import db, User, Message, MessageViewers
+
+# BEFORE we import our app, point it at this test worker's own database
+# (see testdb.py; we need to do this before we import our app, since that
+# will have already connected to the database)
+
+import testdb
+testdb.setup()
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import viewers
+from viewers import HyperLogLog
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HyperLogLogTestCase(TestCase):
+    """Test the sketch itself."""
+
+    def test_small_counts_exact(self):
+        """Are a few hundred viewers counted (almost) exactly"""
+        sketch = HyperLogLog()
+        for i in range(300):
+            sketch.add(f"user:{i}")
+            sketch.add(f"user:{i}")
+        self.assertAlmostEqual(sketch.count(), 300, delta=3)
+
+    def test_large_counts_within_bounds(self):
+        """Is a large count within a few standard errors"""
+        sketch = HyperLogLog()
+        for i in range(50_000):
+            sketch.add(f"ip:{i}")
+        self.assertLess(abs(sketch.count() - 50_000) / 50_000, 4 * 0.0163)
+
+    def test_merge_is_union(self):
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in range(2000):
+            a.add(str(i))
+        for i in range(1000, 3000):
+            b.add(str(i))
+        both = a.copy()
+        both.merge(b)
+        self.assertAlmostEqual(both.count(), 3000, delta=3000 * 0.05)
+
+        # merging again changes nothing
+        again = both.copy()
+        again.merge(b)
+        self.assertEqual(again.to_bytes(), both.to_bytes())
+
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(10))
+
+    def test_round_trip(self):
+        """Do sparse and dense blobs read back the same sketch"""
+        sketch = HyperLogLog()
+        sketch.add("user:1")
+        blob = sketch.to_bytes()
+        self.assertEqual(len(blob), 2 + 3)
+        self.assertEqual(HyperLogLog.from_bytes(blob).count(), 1)
+
+        for i in range(5000):
+            sketch.add(f"user:{i}")
+        blob = sketch.to_bytes()
+        self.assertEqual(len(blob), 2 + sketch.m)
+        self.assertEqual(HyperLogLog.from_bytes(blob).to_bytes(), blob)
+
+        with self.assertRaises(ValueError):
+            HyperLogLog.from_bytes(b'\x02\x0c\x00')
+
+
+class ViewerCountTestCase(TestCase):
+    """Test recording, flushing and showing viewer counts."""
+
+    def setUp(self):
+        MessageViewers.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        viewers.counter.take()
+
+        self.client = app.test_client()
+
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        db.session.commit()
+
+        self.msg = Message(text="Look at me", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+        self.msg_id = self.msg.id
+
+    def tearDown(self):
+        app.config['VIEWERS_FLUSH_SECONDS'] = 0
+
+    def stored(self):
+        db.session.expire_all()
+        blob = db.session.scalar(
+            db.select(MessageViewers.sketch)
+            .where(MessageViewers.message_id == self.msg_id))
+        return HyperLogLog.from_bytes(blob).count() if blob else 0
+
+    def test_flush_merges(self):
+        """Are views held in memory, counted, then merged into the row"""
+        counter = viewers.ViewerCounter()
+        viewers.counter, original = counter, viewers.counter
+        try:
+            for viewer in ("user:1", "user:2", "user:1"):
+                counter.record(self.msg_id, viewer)
+            counter.record(self.msg_id + 1000, "user:1")
+
+            self.assertEqual(self.stored(), 0)
+            self.assertEqual(viewers.count(self.msg_id), 2)
+
+            # the message that doesn't exist is dropped
+            self.assertEqual(counter.flush(), 1)
+            self.assertEqual(self.stored(), 2)
+
+            counter.record(self.msg_id, "user:2")
+            counter.record(self.msg_id, "user:3")
+            self.assertEqual(viewers.count(self.msg_id), 3)
+            self.assertEqual(counter.flush(), 1)
+            self.assertEqual(self.stored(), 3)
+            self.assertEqual(counter.flush(), 0)
+        finally:
+            viewers.counter = original
+
+    def test_show_counts_unique_viewers(self):
+        """Does the message page count each viewer once"""
+        with self.client as c:
+            c.get(f"/messages/{self.msg_id}")
+            c.get(f"/messages/{self.msg_id}")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+            resp = c.get(f"/messages/{self.msg_id}")
+
+        self.assertIn('<i class="fa fa-eye"></i> 2',
+                      resp.get_data(as_text=True))
+        self.assertEqual(self.stored(), 2)
+
+    def test_deleted_with_message(self):
+        viewers.counter.record(self.msg_id, "user:1")
+        viewers.flush()
+
+        Message.query.delete()
+        db.session.commit()
+        self.assertEqual(MessageViewers.query.count(), 0)
+
+    def test_one_flusher(self):
+        """Is the flusher thread (and exit flush) only started once"""
+        with mock.patch.object(viewers, '_flusher', None), \
+                mock.patch('threading.Thread') as thread, \
+                mock.patch('atexit.register') as at_exit:
+            for _ in range(2):
+                viewers._start_flusher(app, 60)
+
+        self.assertEqual(thread.call_count, 1)
+        self.assertEqual(at_exit.call_count, 1)
@@ -0,0 +1,152 @@
+"""Databases and fixtures for the test suite.
+
+Every test module starts with::
+
+    import testdb
+    testdb.setup()
+
+before it imports the app. `setup` points DATABASE_URL at this test
+worker's own database and selects the 'testing' profile. The database is:
+
+- by default, a SQLite file in the temp directory, recreated empty once
+  per process, so the suite needs no server;
+- with TEST_DATABASE_URL set (e.g. ``postgresql:///warbler-test``), that
+  database with the worker's name appended, created if it doesn't exist.
+
+A worker is a pytest-xdist worker (PYTEST_XDIST_WORKER), or whatever
+WARBLER_TEST_WORKER names for other runners. Parallel runs therefore never
+share a database::
+
+    python -m pytest -n auto
+
+`TransactionalTestCase` runs each test in a transaction that is rolled
+back afterwards, instead of deleting every table's rows in setUp.
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+_url = None
+
+
+def worker():
+    return (os.environ.get('PYTEST_XDIST_WORKER')
+            or os.environ.get('WARBLER_TEST_WORKER') or 'main')
+
+
+def database_url():
+    """This worker's test database URL."""
+
+    base = os.environ.get('TEST_DATABASE_URL')
+    if not base:
+        return "sqlite:///" + os.path.join(
+            tempfile.gettempdir(), f"warbler-test-{worker()}.db")
+
+    url = make_url(base)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return base
+        stem, ext = os.path.splitext(url.database)
+        return url.set(database=f"{stem}-{worker()}{ext}").render_as_string(
+            hide_password=False)
+
+    return url.set(database=f"{url.database}-{worker()}").render_as_string(
+        hide_password=False)
+
+
+def _create_postgres_database(url):
+    url = make_url(url)
+    engine = create_engine(url.set(database='postgres'),
+                           isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM pg_database WHERE datname = %(name)s",
+                {'name': url.database}).scalar()
+            if not exists:
+                conn.exec_driver_sql(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+def setup():
+    """Point the app at this worker's database (once per process)."""
+
+    global _url
+
+    if _url is None:
+        _url = database_url()
+        url = make_url(_url)
+        if url.get_backend_name() == 'sqlite' and url.database not in (
+                None, '', ':memory:'):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(url.database + suffix):
+                    os.remove(url.database + suffix)
+        elif url.get_backend_name() == 'postgresql':
+            _create_postgres_database(_url)
+
+    os.environ['DATABASE_URL'] = _url
+    os.environ.setdefault('WARBLER_ENV', 'testing')
+
+
+class TransactionalTestCase(TestCase):
+    """Each test runs inside a transaction, rolled back when it ends.
+
+    For the test, `db.session` is a session bound to one connection, whose
+    commits (the test's, or those of the views it calls) only release a
+    SAVEPOINT, so nothing reaches the database. Subclasses that define
+    setUp must call ``super().setUp()`` first.
+
+    Code that opens its own connections (background threads, a second app,
+    `db.engine.begin()`) doesn't see the test's rows; tests of such code
+    should clean up after themselves instead.
+
+    Tables are emptied once per class, since tests elsewhere in the run may
+    have committed rows.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from models import db
+
+        super().setUpClass()
+        with db.engine.begin() as conn:
+            for table in reversed(db.metadata.sorted_tables):
+                conn.execute(table.delete())
+
+    def setUp(self):
+        from models import db
+
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+        if self._connection.dialect.name == 'sqlite':
+            # pysqlite only begins transactions before DML, and would
+            # commit on RELEASE of an outermost SAVEPOINT; begin it ourselves
+            dbapi_connection = self._connection.connection.dbapi_connection
+            dbapi_connection.isolation_level = None
+            self._connection.exec_driver_sql("BEGIN")
+
+        # Flask-SQLAlchemy's sessions always pick the engine for a model's
+        # bind key, so swap in plain ones bound to our connection
+        self._session = db.session
+        self._session.remove()
+        db.session = scoped_session(
+            sessionmaker(bind=self._connection,
+                         join_transaction_mode='create_savepoint'),
+            scopefunc=self._session.registry.scopefunc)
+        self.addCleanup(self._roll_back)
+
+    def _roll_back(self):
+        from models import db
+
+        db.session.remove()
+        db.session = self._session
+
+        self._transaction.rollback()
+        if self._connection.dialect.name == 'sqlite':
+            self._connection.connection.dbapi_connection.isolation_level = ''
+        self._connection.close()
@@ -0,0 +1,430 @@
+"""Trending messages and active users for Warbler.
+
+Ranking "most liked lately" exactly would mean grouping the likes and
+messages tables on every page view. Instead the write paths feed events into
+in-memory streaming counters:
+
+- every like counts toward the liked message;
+- every post and like counts toward the user who made it.
+
+Time is cut into buckets of BUCKET_SECONDS. Each bucket holds a count-min
+sketch (approximate counts for any key in fixed memory) and a small top-K
+heap of the keys that looked heaviest while it was current. A ranking takes
+the union of the buckets' top-K keys as candidates and scores each as the
+sum of its per-bucket sketch estimates, weighted by 0.5 ** (bucket age /
+half life), so activity from an hour ago counts for less than activity from a
+minute ago. Buckets older than NUM_BUCKETS are dropped.
+
+Count-min estimates never undercount, and only overcount by about
+total / width with probability 1 - e ** -depth (see benchmarks/
+bench_trending.py for accuracy against exact counts). Counters only go up:
+an unlike doesn't retract the like's contribution before it decays.
+
+Counters are per-process. When TRENDING_SNAPSHOT_PATH is set, every
+SNAPSHOT_SECONDS (checked as events arrive) a background thread merges the
+events counted since the last snapshot into that file, which all workers
+share: it is read, merged and replaced under an exclusive lock on
+TRENDING_SNAPSHOT_PATH + '.lock'. Sketches merge by adding their cells, so
+the file holds every worker's counts, and each worker reads it back on
+first use so a restart doesn't start from zero.
+"""
+
+import fcntl
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from array import array
+from base64 import b64decode, b64encode
+from collections import deque
+from hashlib import blake2b
+from operator import add
+
+from flask import current_app
+
+import metrics
+
+BUCKET_SECONDS = 300
+NUM_BUCKETS = 24
+HALF_LIFE_SECONDS = 3600
+TOP_K = 64
+
+SNAPSHOT_SECONDS = 60
+
+# rankings are recomputed at most this often
+RANKING_TTL_SECONDS = 5
+
+
+class CountMinSketch:
+    """Approximate counts of string keys in `depth` rows of `width` cells."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = array('I', bytes(array('I').itemsize * width * depth))
+        self.total = 0
+
+    def _cells(self, key):
+        # Kirsch-Mitzenmacher, as in availability.BloomFilter: one cell per row
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (h1 + row * h2) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count `key`; returns its new estimate.
+
+        Uses the conservative update: only cells at the current minimum are
+        raised, which cuts overcounting without ever undercounting.
+        """
+
+        cells = self._cells(key)
+        estimate = min(self.table[cell] for cell in cells) + count
+        for cell in cells:
+            if self.table[cell] < estimate:
+                self.table[cell] = estimate
+        self.total += count
+        return estimate
+
+    def estimate(self, key, cells=None):
+        """Estimated count of `key` (`cells` may be passed from `_cells`)."""
+
+        table = self.table
+        return min(table[cell] for cell in cells or self._cells(key))
+
+    def merge(self, other):
+        """Add `other`'s counts (a sketch of the same shape) to ours."""
+
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can't merge sketches of different shapes")
+        self.table = array('I', map(add, self.table, other.table))
+        self.total += other.total
+
+    def to_dict(self):
+        return {'width': self.width, 'depth': self.depth, 'total': self.total,
+                'table': b64encode(self.table.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['width'], data['depth'])
+        sketch.table = array('I')
+        sketch.table.frombytes(b64decode(data['table']))
+        sketch.total = data['total']
+        return sketch
+
+
+class TopK:
+    """The `k` keys with the highest counts offered so far."""
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self.counts = {}
+        # (count, key) entries; stale ones are skipped when popped
+        self._heap = []
+
+    def offer(self, key, count):
+        if key not in self.counts and len(self.counts) >= self.k:
+            if count <= self._min()[0]:
+                return
+            _, evicted = heapq.heappop(self._heap)
+            del self.counts[evicted]
+
+        self.counts[key] = count
+        heapq.heappush(self._heap, (count, key))
+        if len(self._heap) > self.k * 4:
+            self._heap = [(c, key) for key, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _min(self):
+        while self._heap[0][0] != self.counts.get(self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def __iter__(self):
+        return iter(self.counts)
+
+
+class DecayingCounter:
+    """Time-bucketed sketches and top-K candidates for one kind of key."""
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, num_buckets=NUM_BUCKETS,
+                 half_life=HALF_LIFE_SECONDS, width=2048, depth=4, k=TOP_K):
+        self.bucket_seconds = bucket_seconds
+        self.half_life = half_life
+        self.width = width
+        self.depth = depth
+        self.k = k
+        # (bucket start, sketch, top-K), oldest first
+        self.buckets = deque(maxlen=num_buckets)
+
+    def _bucket(self, now):
+        start = int(now // self.bucket_seconds) * self.bucket_seconds
+        if not self.buckets or self.buckets[-1][0] < start:
+            self.buckets.append(
+                (start, CountMinSketch(self.width, self.depth), TopK(self.k)))
+        return self.buckets[-1]
+
+    def add(self, key, now, count=1):
+        _, sketch, top = self._bucket(now)
+        top.offer(key, sketch.add(key, count))
+
+    def top(self, n, now):
+        """[(key, score)] for the `n` highest decayed scores."""
+
+        horizon = now - self.bucket_seconds * self.buckets.maxlen
+        # age is measured from the end of a bucket; the current one is fresh
+        weighted = [(0.5 ** (max(0, now - start - self.bucket_seconds)
+                             / self.half_life), sketch)
+                    for start, sketch, _ in self.buckets if start > horizon]
+
+        candidates = set()
+        for start, _, top in self.buckets:
+            if start > horizon:
+                candidates.update(top)
+
+        if not weighted:
+            return []
+
+        # every bucket's sketch has the same shape, so hash each key once
+        cells_of = weighted[0][1]._cells
+        scores = []
+        for key in candidates:
+            cells = cells_of(key)
+            scores.append((key, sum(weight * sketch.estimate(key, cells)
+                                    for weight, sketch in weighted)))
+        return heapq.nlargest(n, scores, key=lambda pair: pair[1])
+
+    def merge(self, other):
+        """Add `other`'s buckets to ours, matching them by start time."""
+
+        buckets = {start: (start, sketch, top)
+                   for start, sketch, top in self.buckets}
+        for start, sketch, top in other.buckets:
+            if start not in buckets:
+                copy = CountMinSketch(sketch.width, sketch.depth)
+                buckets[start] = (start, copy, TopK(self.k))
+            _, merged, merged_top = buckets[start]
+            merged.merge(sketch)
+            for key in set(merged_top) | set(top):
+                merged_top.offer(key, merged.estimate(key))
+
+        self.buckets.clear()
+        self.buckets.extend(buckets[start] for start in sorted(buckets))
+
+    def to_list(self):
+        return [{'start': start, 'sketch': sketch.to_dict(),
+                 'top': top.counts}
+                for start, sketch, top in self.buckets]
+
+    def load_list(self, buckets):
+        self.buckets.clear()
+        for data in buckets:
+            top = TopK(self.k)
+            for key, count in data['top'].items():
+                top.offer(key, count)
+            self.buckets.append((data['start'],
+                                 CountMinSketch.from_dict(data['sketch']), top))
+
+
+class Trending:
+    """Streaming counters of liked messages and active users."""
+
+    def __init__(self, clock=time.time, **counter_options):
+        self.clock = clock
+        self._counter_options = counter_options
+        self.messages = DecayingCounter(**counter_options)
+        self.users = DecayingCounter(**counter_options)
+        # what was counted since the last snapshot, to merge into the file
+        self._unsaved = self._counters()
+        self._lock = threading.Lock()
+        # (counter name, n) -> (computed at, ranking)
+        self._rankings = {}
+
+    def _counters(self):
+        return {name: DecayingCounter(**self._counter_options)
+                for name in ('messages', 'users')}
+
+    def _add(self, name, key, now):
+        getattr(self, name).add(key, now)
+        self._unsaved[name].add(key, now)
+
+    def record_post(self, user_id):
+        with self._lock:
+            self._add('users', str(user_id), self.clock())
+
+    def record_like(self, message_id, user_id):
+        with self._lock:
+            now = self.clock()
+            self._add('messages', str(message_id), now)
+            self._add('users', str(user_id), now)
+
+    def _ranking(self, name, n):
+        with self._lock:
+            now = self.clock()
+            cached = self._rankings.get((name, n))
+            if cached and now - cached[0] < RANKING_TTL_SECONDS:
+                metrics.cache_hit('trending_ranking')
+                return cached[1]
+
+            metrics.cache_miss('trending_ranking')
+            counter = getattr(self, name)
+            ranking = [(int(key), score) for key, score in counter.top(n, now)]
+            self._rankings[(name, n)] = (now, ranking)
+            return ranking
+
+    def top_messages(self, n=10):
+        """[(message id, score)], highest first.
+
+        Rankings are cached for RANKING_TTL_SECONDS, so a burst of page
+        views costs one computation.
+        """
+
+        return self._ranking('messages', n)
+
+    def top_users(self, n=10):
+        """[(user id, score)], highest first (cached like `top_messages`)."""
+
+        return self._ranking('users', n)
+
+    def _load(self, path):
+        """Counters saved at `path`, or None if there are none."""
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        counters = self._counters()
+        for name, counter in counters.items():
+            counter.load_list(data[name])
+        return counters
+
+    def snapshot(self, path):
+        """Merge what was counted since the last snapshot into `path`.
+
+        Other processes sharing `path` merge theirs in too; the file is
+        replaced atomically, under an exclusive lock on `path` + '.lock'.
+        """
+
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, self._counters()
+
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                saved = self._load(path) or self._counters()
+                for name, counter in saved.items():
+                    counter.merge(unsaved[name])
+                data = json.dumps({name: counter.to_list()
+                                   for name, counter in saved.items()})
+
+                fd, tmp = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+        except Exception:
+            # keep the counts for the next snapshot
+            with self._lock:
+                for name, counter in unsaved.items():
+                    counter.merge(self._unsaved[name])
+                self._unsaved = unsaved
+            raise
+
+    def restore(self, path):
+        """Add the counters saved at `path`; False if there are none."""
+
+        saved = self._load(path)
+        if saved is None:
+            return False
+
+        with self._lock:
+            self.messages.merge(saved['messages'])
+            self.users.merge(saved['users'])
+            self._rankings.clear()
+        return True
+
+
+tracker = Trending()
+
+_restored = False
+_last_snapshot = time.monotonic()
+_snapshotting = threading.Lock()
+
+
+def _snapshot_path():
+    return current_app.config.get('TRENDING_SNAPSHOT_PATH')
+
+
+def _ensure_restored():
+    global _restored
+
+    if not _restored:
+        _restored = True
+        path = _snapshot_path()
+        if path:
+            tracker.restore(path)
+
+
+def _snapshot_with(app, path):
+    try:
+        tracker.snapshot(path)
+    except Exception:
+        app.logger.exception("Writing trending snapshot failed")
+    finally:
+        _snapshotting.release()
+
+
+def _maybe_snapshot():
+    """Start a snapshot thread if one is due and none is running."""
+
+    global _last_snapshot
+
+    path = _snapshot_path()
+    if not path or time.monotonic() - _last_snapshot < SNAPSHOT_SECONDS:
+        return
+    if not _snapshotting.acquire(blocking=False):
+        return
+    _last_snapshot = time.monotonic()
+    threading.Thread(target=_snapshot_with,
+                     args=(current_app._get_current_object(), path),
+                     name='trending-snapshot', daemon=True).start()
+
+
+def record_post(user_id):
+    """Count a new message by `user_id`."""
+
+    _ensure_restored()
+    tracker.record_post(user_id)
+    _maybe_snapshot()
+
+
+def record_like(message_id, user_id):
+    """Count `user_id` liking `message_id`."""
+
+    _ensure_restored()
+    tracker.record_like(message_id, user_id)
+    _maybe_snapshot()
+
+
+def top_messages(n=10):
+    _ensure_restored()
+    return tracker.top_messages(n)
+
+
+def top_users(n=10):
+    _ensure_restored()
+    return tracker.top_users(n)
+
+
+def reset():
+    """Forget all counts (for tests)."""
+
+    global tracker, _restored
+    tracker = Trending(clock=tracker.clock)
+    _restored = False
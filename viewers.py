@@ -0,0 +1,400 @@
+"""Unique-viewer counts for Warbler messages.
+
+Counting distinct viewers exactly would mean storing every (message, viewer)
+pair. Instead each message gets a HyperLogLog sketch: 2 ** PRECISION one-byte
+registers, where a viewer's 64-bit hash picks a register and the register
+keeps the longest run of leading zero bits it has seen. Sketches merge by
+taking the larger of each register, so adding the same viewer twice, or
+merging the same sketch twice, changes nothing.
+
+Error bounds, at the default PRECISION = 12 (4096 registers):
+
+- the standard error is 1.04 / sqrt(4096), about 1.6%: roughly two thirds of
+  estimates are within 1.6% of the true count, and 95% within 3.3%;
+- for small counts (while most registers are still empty) the estimate is
+  far tighter: practically exact for the tens or hundreds of viewers most
+  messages get;
+- `count` uses an estimator without the classic one's bias where it
+  switches from small- to large-range formulas, and 64-bit hashes leave no
+  large-range correction to make.
+
+benchmarks/bench_viewers.py measures this against exact counts, along with
+memory per message.
+
+Small sketches are sparse (only the non-zero registers): a message seen by a
+handful of people takes under 1 KiB in memory and 3 bytes per viewer in its
+blob. Past 64 registers in memory, or a third of them in a blob, a sketch is
+a dense 4 KiB array instead, however many more viewers it counts (a set of
+100,000 viewer keys would take megabytes).
+
+messages_show calls `record(message_id, viewer)`, which only adds to this
+process's in-memory sketch of views since the last flush. Every
+VIEWERS_FLUSH_SECONDS a background thread merges those into the
+`message_viewers` rows (read, merge, write back, in one transaction that
+locks the rows on PostgreSQL), and once more at exit. Counts shown merge the
+stored sketch with ours, so this process sees its own views at once and
+others' after their next flush.
+
+A viewer is a logged-in user's id, otherwise the client's IP address (see
+`viewer_key`). A crash loses unflushed views; since merging is idempotent, a
+flush that fails is simply retried with the next one.
+"""
+
+import atexit
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from flask import current_app, g
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Message, MessageViewers
+from ratelimit import client_ip
+import sharding
+
+PRECISION = 12
+FLUSH_SECONDS = 60
+
+# in memory a sparse register costs tens of bytes of dict, a dense one a
+# byte: go dense past this fraction of the registers
+SPARSE_IN_MEMORY = 64
+
+_SPARSE = 1
+_DENSE = 2
+
+
+def _sigma(x):
+    # x + sum(x ** (2 ** k) * 2 ** (k - 1)), for the empty registers
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous, z = z, z + x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    # correction for registers that hit the largest rank
+    if x in (0, 1):
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        y *= 0.5
+        previous, z = z, z - (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+class HyperLogLog:
+    """Approximate count of distinct strings in 2 ** precision registers."""
+
+    def __init__(self, precision=PRECISION):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"precision must be 4..16, not {precision}")
+        self.precision = precision
+        self.m = 1 << precision
+        # register -> rank while small, then a bytearray of every register
+        self._sparse = {}
+        self._dense = None
+
+    def _position(self, item):
+        h = int.from_bytes(blake2b(item.encode(), digest_size=8).digest(),
+                           'little')
+        bits = 64 - self.precision
+        rest = h & ((1 << bits) - 1)
+        return h >> bits, bits - rest.bit_length() + 1
+
+    def _raise(self, index, rank):
+        if self._dense is not None:
+            if rank > self._dense[index]:
+                self._dense[index] = rank
+            return
+        if rank > self._sparse.get(index, 0):
+            self._sparse[index] = rank
+            if len(self._sparse) > self.m // SPARSE_IN_MEMORY:
+                self._densify()
+
+    def _densify(self):
+        dense = bytearray(self.m)
+        for index, rank in self._sparse.items():
+            dense[index] = rank
+        self._dense, self._sparse = dense, {}
+
+    def _registers(self):
+        """(register, rank) for every non-zero register."""
+
+        if self._dense is None:
+            return self._sparse.items()
+        return ((index, rank) for index, rank in enumerate(self._dense)
+                if rank)
+
+    def add(self, item):
+        self._raise(*self._position(item))
+
+    def merge(self, other):
+        """Fold `other` into this sketch (the union of what both saw)."""
+
+        if other.precision != self.precision:
+            raise ValueError("can't merge sketches of different precision")
+        if self._dense is not None and other._dense is not None:
+            self._dense = bytearray(map(max, self._dense, other._dense))
+            return
+        for index, rank in list(other._registers()):
+            self._raise(index, rank)
+
+    def copy(self):
+        sketch = HyperLogLog(self.precision)
+        sketch.merge(self)
+        return sketch
+
+    def count(self):
+        """Estimated number of distinct items added.
+
+        Uses Ertl's improved estimator ("New cardinality estimation
+        algorithms for HyperLogLog sketches", 2017), which works from the
+        histogram of register values and stays unbiased from 0 to billions,
+        without the classic estimator's switch to linear counting (and its
+        bias around 2.5 * m) or empirical correction tables.
+        """
+
+        m = self.m
+        q = 64 - self.precision
+        if self._dense is None:
+            histogram = [0] * (q + 2)
+            histogram[0] = m - len(self._sparse)
+            for rank in self._sparse.values():
+                histogram[rank] += 1
+        else:
+            histogram = [self._dense.count(rank) for rank in range(q + 2)]
+
+        if histogram[0] == m:
+            return 0
+        z = m * _tau(1 - histogram[q + 1] / m)
+        for rank in range(q, 0, -1):
+            z = 0.5 * (z + histogram[rank])
+        z += m * _sigma(histogram[0] / m)
+        return round(m * m / (2 * math.log(2) * z))
+
+    def to_bytes(self):
+        """Compact blob: sparse (3 bytes per register) or dense (1 each)."""
+
+        registers = sorted(self._registers())
+        if 3 * len(registers) < self.m:
+            return bytes([_SPARSE, self.precision]) + b''.join(
+                index.to_bytes(2, 'big') + bytes([rank])
+                for index, rank in registers)
+        dense = self._dense
+        if dense is None:
+            dense = bytearray(self.m)
+            for index, rank in registers:
+                dense[index] = rank
+        return bytes([_DENSE, self.precision]) + bytes(dense)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        if len(blob) < 2 or blob[0] not in (_SPARSE, _DENSE):
+            raise ValueError("not a HyperLogLog sketch")
+        sketch = cls(blob[1])
+        body = blob[2:]
+        if blob[0] == _DENSE:
+            if len(body) != sketch.m:
+                raise ValueError("truncated HyperLogLog sketch")
+            sketch._dense = bytearray(body)
+        else:
+            if len(body) % 3:
+                raise ValueError("truncated HyperLogLog sketch")
+            for offset in range(0, len(body), 3):
+                sketch._raise(int.from_bytes(body[offset:offset + 2], 'big'),
+                              body[offset + 2])
+        return sketch
+
+
+class ViewerCounter:
+    """Sketches of each message's viewers since the last flush."""
+
+    def __init__(self, precision=PRECISION):
+        self.precision = precision
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.flushes = 0
+
+    def record(self, message_id, viewer):
+        with self._lock:
+            sketch = self._pending.get(message_id)
+            if sketch is None:
+                sketch = self._pending[message_id] = HyperLogLog(
+                    self.precision)
+            sketch.add(viewer)
+
+    def pending(self, message_id):
+        """A copy of the unflushed sketch for `message_id`, or None."""
+
+        with self._lock:
+            sketch = self._pending.get(message_id)
+            return sketch.copy() if sketch is not None else None
+
+    def take(self):
+        """Remove and return the pending sketches, as {message id: sketch}."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        """Put back sketches from a failed flush."""
+
+        with self._lock:
+            for message_id, sketch in pending.items():
+                if message_id in self._pending:
+                    sketch.merge(self._pending[message_id])
+                self._pending[message_id] = sketch
+
+    def flush(self):
+        """Merge pending sketches into message_viewers; returns rows written.
+
+        Sketches of messages deleted in the meantime are dropped.
+        """
+
+        pending = self.take()
+        if not pending:
+            return 0
+
+        table = MessageViewers.__table__
+        ids = sorted(pending)
+        try:
+            if sharding.enabled():
+                ids = sorted(sharding.rows_by_ids(ids))
+            # own transaction, so we never commit a request's session
+            with db.engine.begin() as conn:
+                if not sharding.enabled():
+                    ids = conn.execute(
+                        db.select(Message.id).where(Message.id.in_(ids))
+                        .order_by(Message.id)).scalars().all()
+                stored = dict(conn.execute(
+                    db.select(table.c.message_id, table.c.sketch)
+                    .where(table.c.message_id.in_(ids))
+                    .with_for_update()).all())
+
+                updates, inserts = [], []
+                for message_id in ids:
+                    sketch = pending[message_id]
+                    if message_id in stored:
+                        merged = HyperLogLog.from_bytes(stored[message_id])
+                        merged.merge(sketch)
+                        updates.append({'b_message_id': message_id,
+                                        'sketch': merged.to_bytes()})
+                    else:
+                        inserts.append({'message_id': message_id,
+                                        'sketch': sketch.to_bytes()})
+
+                if updates:
+                    conn.execute(
+                        table.update()
+                        .where(table.c.message_id
+                               == db.bindparam('b_message_id'))
+                        .values(sketch=db.bindparam('sketch')),
+                        updates)
+                if inserts:
+                    conn.execute(table.insert(), inserts)
+        except IntegrityError:
+            # another process inserted the same row first, or the message
+            # was just deleted; the next flush updates, or drops it
+            self.restore({message_id: pending[message_id]
+                          for message_id in ids})
+            raise
+        except Exception:
+            self.restore(pending)
+            raise
+
+        self.flushes += 1
+        return len(ids)
+
+
+counter = ViewerCounter()
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_with(app):
+    with app.app_context():
+        try:
+            counter.flush()
+        except Exception:
+            app.logger.exception("Flushing viewer sketches failed")
+
+
+def _start_flusher(app, interval):
+    """Flush every `interval` seconds from a daemon thread, and at exit.
+
+    Only the first call starts one.
+    """
+
+    global _flusher
+
+    def run():
+        while True:
+            time.sleep(interval)
+            _flush_with(app)
+
+    with _flusher_lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=run, name='viewers-flusher',
+                                    daemon=True)
+        _flusher.start()
+        atexit.register(_flush_with, app)
+
+
+def viewer_key():
+    """Who is viewing: the logged-in user, else the client address."""
+
+    if g.get('user'):
+        return f"user:{g.user.id}"
+    return f"ip:{client_ip()}"
+
+
+def record(message_id, viewer):
+    """Count a view of `message_id` by `viewer` (a string, see viewer_key).
+
+    With VIEWERS_FLUSH_SECONDS = 0 this writes through immediately; a failed
+    write is logged rather than failing the page.
+    """
+
+    interval = current_app.config.get('VIEWERS_FLUSH_SECONDS', FLUSH_SECONDS)
+    counter.record(message_id, viewer)
+
+    if not interval:
+        try:
+            counter.flush()
+        except Exception:
+            current_app.logger.exception("Flushing viewer sketches failed")
+    elif _flusher is None:
+        _start_flusher(current_app._get_current_object(), interval)
+
+
+def sketch(message_id):
+    """The message's stored sketch merged with our unflushed views."""
+
+    blob = db.session.scalar(
+        db.select(MessageViewers.sketch)
+        .where(MessageViewers.message_id == message_id))
+    merged = (HyperLogLog.from_bytes(blob) if blob is not None
+              else HyperLogLog(counter.precision))
+    pending = counter.pending(message_id)
+    if pending is not None:
+        merged.merge(pending)
+    return merged
+
+
+def count(message_id):
+    """Estimated unique viewers of `message_id`."""
+
+    return sketch(message_id).count()
+
+
+def flush():
+    return counter.flush()
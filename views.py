@@ -0,0 +1,574 @@
+"""HTML views for Warbler: signup/login, users, messages and the homepage."""
+
+from flask import (Blueprint, render_template, request, flash, redirect,
+                   session, g, abort, send_file, current_app, Response)
+from itsdangerous import BadSignature
+from sqlalchemy.exc import IntegrityError
+
+from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
+from models import db, User, Message, Likes
+from readmodels import (following_ids, liked_message_ids, timeline_cards,
+                        user_cards, followers_page, following_page,
+                        followed_among, message_card, message_cards_by_ids,
+                        user_cards_by_ids,
+                        tag_message_cards, mention_message_cards,
+                        cached_message_card, cached_user_message_cards,
+                        cached_liked_message_cards, cached_message_count,
+                        cached_liked_count, cached_following_count,
+                        cached_follower_count, cached_is_following)
+from availability import username_available, email_available
+from ratelimit import rate_limit
+from realtime import publish_message
+import trending
+import likecounts
+import viewers
+import metrics
+import sharding
+from querycache import invalidate, user_tag, message_tag
+from tags import index_message, linkify, normalize_tag, MAX_TAG_LENGTH
+from assets import asset_url, send_asset
+from images import (THUMBNAIL_SIZES, THUMBNAIL_MAX_AGE, FORMATS,
+                    ImageSourceError, thumbnail_url, source_for_token,
+                    thumbnail_file, preferred_format)
+from app import CURR_USER_KEY
+
+bp = Blueprint('views', __name__)
+bp.add_app_template_filter(thumbnail_url, 'thumbnail')
+bp.add_app_template_filter(linkify)
+bp.add_app_template_global(asset_url)
+bp.add_app_template_global(cached_message_count, 'message_count')
+bp.add_app_template_global(cached_liked_count, 'liked_count')
+bp.add_app_template_global(cached_following_count, 'following_count')
+bp.add_app_template_global(cached_follower_count, 'follower_count')
+bp.add_app_template_global(cached_is_following, 'is_following')
+
+
+##############################################################################
+# User signup/login/logout
+
+
+@bp.before_app_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global."""
+
+    if CURR_USER_KEY in session:
+        g.user = User.query.get(session[CURR_USER_KEY])
+
+    else:
+        g.user = None
+
+
+def do_login(user):
+    """Log in user."""
+
+    session[CURR_USER_KEY] = user.id
+
+
+def do_logout():
+    """Logout user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+
+
+@bp.route('/signup', methods=["GET", "POST"])
+@rate_limit('signup', limit=5, per=60, key='ip', methods=('POST',))
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If the there already is a user with that username: flash message
+    and re-present form.
+    """
+
+    form = UserAddForm()
+
+    if form.validate_on_submit():
+        # check before User.signup pays for the bcrypt hash
+        if not username_available(form.username.data):
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        if not email_available(form.email.data):
+            flash("Email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        try:
+            user = User.signup(
+                username=form.username.data,
+                password=form.password.data,
+                email=form.email.data,
+                image_url=form.image_url.data or User.image_url.default.arg,
+            )
+            db.session.commit()
+
+        except IntegrityError:
+            # lost a race with another signup for the same name
+            db.session.rollback()
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        do_login(user)
+
+        return redirect("/")
+
+    else:
+        return render_template('users/signup.html', form=form)
+
+
+@bp.route('/login', methods=["GET", "POST"])
+@rate_limit('login', limit=10, per=60, key='ip', methods=('POST',))
+def login():
+    """Handle user login."""
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        user = User.authenticate(form.username.data,
+                                 form.password.data)
+
+        if user:
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            return redirect("/")
+
+        flash("Invalid credentials.", 'danger')
+
+    return render_template('users/login.html', form=form)
+
+
+@bp.route('/logout')
+def logout():
+    """Handle logout of user."""
+
+    do_logout()
+    flash('Logged out', 'success')
+    return redirect('/login')
+
+
+##############################################################################
+# General user routes:
+
+@bp.route('/users')
+def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username.
+    """
+
+    search = request.args.get('q')
+    users = user_cards(search)
+
+    return render_template('users/index.html', users=users)
+
+@bp.route('/users/add_like/<int:message_id>', methods=["POST"])
+@rate_limit('like', limit=60, per=60, key='user')
+def add_like(message_id):
+    if not g.user:
+        flash("Must be logged in", "danger")
+        return redirect("/")
+
+    # a card rather than the ORM object: the message may be on a shard
+    liked = message_card(message_id)
+    if liked is None:
+        abort(404)
+
+    if liked.user.id != g.user.id:
+        like = Likes.query.filter_by(user_id=g.user.id,
+                                     message_id=message_id).first()
+        if like is None:
+            db.session.add(Likes(user_id=g.user.id, message_id=message_id))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # a concurrent request liked it first
+                db.session.rollback()
+                return redirect('/')
+            invalidate(message_tag(message_id), user_tag(g.user.id))
+            likecounts.record(message_id, 1)
+            trending.record_like(message_id, g.user.id)
+            return redirect('/')
+        db.session.delete(like)
+        db.session.commit()
+        invalidate(message_tag(message_id), user_tag(g.user.id))
+        likecounts.record(message_id, -1)
+    
+    return redirect('/')
+
+@bp.route('/users/<int:user_id>/likes')
+def likes(user_id):
+    """Show user's liked messages"""
+
+    user = User.query.get_or_404(user_id)
+    messages = cached_liked_message_cards(user_id)
+
+    return render_template('/users/liked.html', messages=messages, user=user)
+
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def mentions(user_id):
+    """Messages that @mention this user, newest first."""
+
+    user = User.query.get_or_404(user_id)
+    messages, next_before = mention_message_cards(
+        user_id, request.args.get('before', type=int))
+
+    return render_template('users/mentions.html', user=user,
+                           messages=messages, next_before=next_before)
+
+
+@bp.route('/users/<int:user_id>')
+def users_show(user_id):
+    """Show user profile."""
+
+    user = User.query.get_or_404(user_id)
+
+    # snagging messages in order from the database;
+    # user.messages won't be in order by default
+    messages = cached_user_message_cards(user_id)
+    return render_template('users/show.html', user=user, messages=messages)
+
+
+@bp.route('/users/<int:user_id>/following')
+def show_following(user_id):
+    """Show list of people this user is following."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.query.get_or_404(user_id)
+    users, next_cursor = following_page(user_id, request.args.get('after'))
+    followed = followed_among(g.user.id, [u.id for u in users])
+
+    return render_template('users/following.html', user=user, users=users,
+                           followed=followed, next_cursor=next_cursor)
+
+
+@bp.route('/users/<int:user_id>/followers')
+def users_followers(user_id):
+    """Show list of followers of this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.query.get_or_404(user_id)
+    users, next_cursor = followers_page(user_id, request.args.get('after'))
+    followed = followed_among(g.user.id, [u.id for u in users])
+
+    return render_template('users/followers.html', user=user, users=users,
+                           followed=followed, next_cursor=next_cursor)
+
+
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
+@rate_limit('follow', limit=30, per=60, key='user')
+def add_follow(follow_id):
+    """Add a follow for the currently-logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    followed_user = User.query.get_or_404(follow_id)
+    g.user.following.append(followed_user)
+    db.session.commit()
+    invalidate(user_tag(g.user.id), user_tag(follow_id))
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+def stop_following(follow_id):
+    """Have currently-logged-in-user stop following this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    followed_user = User.query.get(follow_id)
+    g.user.following.remove(followed_user)
+    db.session.commit()
+    invalidate(user_tag(g.user.id), user_tag(follow_id))
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
+def profile():
+    """Update profile for current user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = UserUpdateForm(obj=g.user)
+
+    if form.validate_on_submit():
+        if not username_available(form.username.data, g.user):
+            flash("Username already taken", 'danger')
+            return render_template('/users/edit.html', form=form)
+
+        if not email_available(form.email.data, g.user):
+            flash("Email already taken", 'danger')
+            return render_template('/users/edit.html', form=form)
+
+        user = User.authenticate(g.user.username,
+                                 form.password.data)
+        if user:
+            g.user.username = form.username.data
+            g.user.email = form.email.data
+            g.user.image_url = form.image_url.data
+            g.user.header_image_url = form.header_image_url.data
+            g.user.bio = form.bio.data
+
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # taken through another worker, or in a concurrent rename
+                db.session.rollback()
+                flash("Username or email already taken", 'danger')
+                return render_template('/users/edit.html', form=form)
+            # their name and avatar are on every card of theirs
+            invalidate(user_tag(g.user.id))
+            flash(f'{g.user.username} updated', 'success')
+            return redirect(f'/users/{g.user.id}')
+        
+        flash('Invalid credentials', 'danger')
+        return redirect('/')
+
+    return render_template('/users/edit.html', form=form)
+
+
+@bp.route('/users/delete', methods=["POST"])
+def delete_user():
+    """Delete user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    do_logout()
+
+    if sharding.enabled():
+        sharding.delete_user_messages(g.user.id)
+    user_id = g.user.id
+    db.session.delete(g.user)
+    db.session.commit()
+    invalidate(user_tag(user_id))
+
+    return redirect("/signup")
+
+
+##############################################################################
+# Messages routes:
+
+@bp.route('/messages/new', methods=["GET", "POST"])
+@rate_limit('post', limit=20, per=60, key='user',
+            algorithm='sliding_window', methods=('POST',))
+def messages_add():
+    """Add a message:
+
+    Show form if GET. If valid, update message and redirect to user page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        if sharding.enabled():
+            msg = message_card(sharding.add_message(g.user.id,
+                                                    form.text.data))
+        else:
+            msg = Message(text=form.text.data)
+            g.user.messages.append(msg)
+            db.session.flush()
+        index_message(msg)
+        db.session.commit()
+        invalidate(user_tag(g.user.id), message_tag(msg.id))
+        publish_message(message_card(msg.id))
+        trending.record_post(g.user.id)
+
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template('messages/new.html', form=form)
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
+def messages_show(message_id):
+    """Show a message."""
+
+    msg = cached_message_card(message_id)
+    if msg is None:
+        abort(404)
+
+    viewers.record(message_id, viewers.viewer_key())
+
+    return render_template('messages/show.html', message=msg,
+                           like_count=msg.like_count,
+                           viewer_count=viewers.count(message_id))
+
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
+def messages_destroy(message_id):
+    """Delete a message."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = message_card(message_id)
+    if msg is None:
+        abort(404)
+
+    if msg.user.id == g.user.id:
+        if sharding.enabled():
+            sharding.delete_message(message_id)
+        else:
+            db.session.delete(Message.query.get(message_id))
+        db.session.commit()
+        invalidate(message_tag(message_id), user_tag(g.user.id))
+
+        return redirect(f"/users/{g.user.id}")
+    
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+
+@bp.route('/tags/<tag>')
+def tags_show(tag):
+    """Messages with a #hashtag, newest first."""
+
+    tag = normalize_tag(tag)
+    if len(tag) > MAX_TAG_LENGTH:
+        abort(404)
+
+    messages, next_before = tag_message_cards(
+        tag, request.args.get('before', type=int))
+    likes = liked_message_ids(g.user.id) if g.user else set()
+
+    return render_template('tags/show.html', tag=tag, messages=messages,
+                           likes=likes, next_before=next_before)
+
+
+@bp.route('/trending')
+def trending_page():
+    """Most-liked messages and most active users of the last few hours."""
+
+    messages = message_cards_by_ids(
+        [id for id, _ in trending.top_messages(20)])
+    users = user_cards_by_ids([id for id, _ in trending.top_users(10)])
+    likes = liked_message_ids(g.user.id) if g.user else set()
+
+    return render_template('trending.html', messages=messages, users=users,
+                           likes=likes)
+
+
+##############################################################################
+# Static assets and images
+
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a fingerprinted file built by `flask assets build`."""
+
+    return send_asset(filename, request.headers.get('Accept-Encoding', ''))
+
+
+
+@bp.route('/images/<int:size>/<token>')
+def image_thumbnail(size, token):
+    """Serve a cached, resized copy of a user's avatar or header image."""
+
+    if size not in THUMBNAIL_SIZES:
+        abort(404)
+
+    try:
+        source_url = source_for_token(token)
+    except BadSignature:
+        abort(404)
+
+    ext = preferred_format(request.headers.get('Accept', ''))
+    try:
+        path = thumbnail_file(source_url, size, ext)
+    except ImageSourceError:
+        # can't shrink it; let the browser try the original
+        return redirect(source_url)
+
+    # the same token can show a different image later: revalidate, by ETag
+    resp = send_file(path, mimetype=FORMATS[ext][0],
+                     max_age=THUMBNAIL_MAX_AGE)
+    resp.vary.add('Accept')
+    return resp
+
+
+##############################################################################
+# Operations
+
+
+@bp.route('/metrics')
+def metrics_page():
+    """Prometheus scrape endpoint."""
+
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(404)
+
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+##############################################################################
+# Homepage and error pages
+
+
+@bp.route('/')
+def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed_users
+    """
+
+    if g.user:
+        following = following_ids(g.user.id) + [g.user.id]
+        messages = timeline_cards(following)
+        likes = liked_message_ids(g.user.id)
+
+        return render_template('home.html', messages=messages, likes=likes)
+
+    else:
+        return render_template('home-anon.html')
+
+
+##############################################################################
+# Turn off all caching in Flask
+#   (useful for dev; in production, this kind of stuff is typically
+#   handled elsewhere)
+#
+# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+
+@bp.after_app_request
+def add_header(req):
+    """Add non-caching headers on every request.
+
+    Responses a view has given a lifetime (content-addressed assets,
+    thumbnails) keep their own caching headers.
+    """
+
+    if req.cache_control.immutable or req.cache_control.max_age:
+        return req
+
+    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    req.headers["Pragma"] = "no-cache"
+    req.headers["Expires"] = "0"
+    req.headers['Cache-Control'] = 'public, max-age=0'
+    return req